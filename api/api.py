@@ -1,30 +1,58 @@
+import asyncio
+import json
 import os
+import time
 import utils
 import logging
 
+from contextlib import aclosing, asynccontextmanager
 from datetime import timedelta
 from dotenv import load_dotenv
 from typing import Annotated, List
 
-from fastapi import Depends, FastAPI, HTTPException, status, BackgroundTasks
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, WebSocket, WebSocketDisconnect, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from jwt.exceptions import InvalidTokenError
+from botocore.exceptions import ClientError
 from pydantic import EmailStr
-from redis import ConnectionPool, Redis
+from redis.asyncio import ConnectionPool, Redis
+from redis.exceptions import RedisError
 
 from aws_services.bedrock import BedrockService
+from aws_services.clients import ClientFactory
 from aws_services.dynamodb import DynamoDBService
 from aws_services.rds import AuroraPostgres
+from aws_services.scheduler import BedrockScheduler, is_throttling
 from models.authentication import Authentication
-from models.session import Session, TokenData, Token
+from models.session import Session, Token
 from models.user import User, UserInDB, RegisterUser
-from models.chat import ChatMessage, ChatService
+from models.chat import ChatMessage, ChatService, ChatTurn, ConflictError
+from models.provisioning import UserProvisioner
+from models.write_behind import WriteBehindQueue
+from cache import CircuitBreaker, \
+                  GuardedRedis, \
+                  ResponseCache, \
+                  SingleFlight, \
+                  UserCache, \
+                  jittered
+from blobs import BlobStore, LocalObjectStore, image_refs
+from codec import CacheCodec, dumps
+from context_window import CHARS_PER_TOKEN, ContextWindow, with_summary
+from metrics import BEDROCK_TOKENS_PER_SECOND, \
+                    BEDROCK_TTFT, \
+                    JWT_DECODE, \
+                    PROFILER, \
+                    REGISTRY, \
+                    USER_LOOKUP
+from serialization import MessageEncoder
 
 from prompt import INSTRUCTION_CLAUDE_VERSION, \
                 INSTRUCTION_DAISII_VERSION, \
-                INSTRUCTION_TITAN_VERSION
+                INSTRUCTION_TITAN_VERSION, \
+                PromptRenderer, \
+                current_time, \
+                render_instruction
 from config import CLAUDE, DAISII, TITAN
 
 
@@ -32,7 +60,25 @@ load_dotenv()
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Nothing here waits on AWS, clients are built and warmed in the background
+    app.state.ready = False
+    app.state.user_cache_listener = asyncio.create_task(user_cache.listen())
+    await write_queue.start()
+    app.state.warm_up = asyncio.create_task(warm_up())
+    yield
+    app.state.warm_up.cancel()
+    # Replies saved after their request ended go through the write queue
+    if background_tasks:
+        await asyncio.wait(set(background_tasks), timeout=background_drain_timeout)
+    await write_queue.stop()
+    app.state.user_cache_listener.cancel()
+    await redis_client.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -42,65 +88,267 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Message-Seq"],
 )
 
-# Initialize services
+# Initialize services, their AWS clients are built on first use
+aws_clients = ClientFactory(
+    max_attempts=int(os.environ.get("AWS_MAX_ATTEMPTS", 3))
+)
 bedrock_service = BedrockService(
-    os.environ.get("BEDROCK_REGION")
+    os.environ.get("BEDROCK_REGION"),
+    int(os.environ.get("BEDROCK_MAX_STREAMS", 256)),
+    ResponseCache(
+        max_bytes=int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+        ttl=float(os.environ.get("RESPONSE_CACHE_TTL", 300)),
+        disabled_models=[
+            model.strip()
+            for model in os.environ.get("RESPONSE_CACHE_DISABLED_MODELS", "").split(",")
+            if model.strip()
+        ]
+    ),
+    int(os.environ.get("RESPONSE_CACHE_CHUNK_CHARS", 16)),
+    aws_clients
+)
+bedrock_scheduler = BedrockScheduler(
+    limits={
+        CLAUDE: int(os.environ.get("BEDROCK_LIMIT_CLAUDE", 32)),
+        DAISII: int(os.environ.get("BEDROCK_LIMIT_DAISII", 16)),
+        TITAN: int(os.environ.get("BEDROCK_LIMIT_TITAN", 16)),
+    },
+    max_queue=int(os.environ.get("BEDROCK_QUEUE_SIZE", 100)),
+    queue_timeout=float(os.environ.get("BEDROCK_QUEUE_TIMEOUT", 10))
 )
 dynamodb_service = DynamoDBService(
     os.environ.get("DYNAMODB_REGION"), 
-    os.environ.get("DYNAMODB_TABLE_NAME")
+    os.environ.get("DYNAMODB_TABLE_NAME"),
+    aws_clients,
+    int(os.environ.get("DYNAMODB_MAX_CONNECTIONS", 32))
 )
 user_database = AuroraPostgres(
-    os.environ.get('AURORA_DATABASE_REGION')
+    os.environ.get('AURORA_DATABASE_REGION'),
+    clients=aws_clients,
+    max_connections=int(os.environ.get("AURORA_DATABASE_MAX_CONNECTIONS", 10))
 )
 session = Session(
     os.environ.get("SECRET_KEY"),
-    os.environ.get("ALGORITHM")
+    os.environ.get("ALGORITHM"),
+    int(os.environ.get("TOKEN_CACHE_SIZE", 10000))
+)
+authentication = Authentication(
+    int(os.environ["BCRYPT_WORKERS"]) if os.environ.get("BCRYPT_WORKERS") else None,
+    int(os.environ["BCRYPT_MAX_PENDING"]) if os.environ.get("BCRYPT_MAX_PENDING") else None
 )
-authentication = Authentication()
 
 # Add Redis for caching
 pool = ConnectionPool(
     host=os.environ.get("REDIS_HOST"),
     port=int(os.environ.get("REDIS_PORT", 6379)),
+    max_connections=int(os.environ.get("REDIS_MAX_CONNECTIONS", 50)),
     socket_connect_timeout=10
 )
-redis_client = Redis(connection_pool=pool)
-chat_service = ChatService(redis_client, dynamodb_service)
+# Commands fail fast once Redis has failed a few times in a row, callers
+# then serve from local caches or the databases until a probe succeeds
+redis_connection = Redis(connection_pool=pool)
+redis_breaker = CircuitBreaker(
+    redis_connection.ping,
+    failure_threshold=int(os.environ.get("REDIS_BREAKER_FAILURES", 3)),
+    timeout=int(os.environ.get("REDIS_TIMEOUT_MS", 2000)) / 1000,
+    probe_interval=int(os.environ.get("REDIS_PROBE_INTERVAL_MS", 1000)) / 1000
+)
+redis_client = GuardedRedis(redis_connection, redis_breaker)
+write_queue = WriteBehindQueue(
+    dynamodb_service,
+    os.environ.get("WRITE_BEHIND_LOG_DIR", "write_behind"),
+    flush_interval=int(os.environ.get("WRITE_BEHIND_FLUSH_MS", 200)) / 1000,
+    fsync=os.environ.get("WRITE_BEHIND_FSYNC", "false").lower() == "true"
+)
+# Cache misses are loaded once per key, optionally once across workers
+cache_lock = os.environ.get("CACHE_LOCK", "false").lower() == "true"
+user_loads = SingleFlight(redis_client if cache_lock else None)
+chat_service = ChatService(
+    redis_client,
+    dynamodb_service,
+    write_queue,
+    SingleFlight(redis_client if cache_lock else None),
+    codec=CacheCodec(
+        os.environ.get("CHAT_CACHE_ENCODING", "json"),
+        os.environ.get("CHAT_CACHE_COMPRESSION", "zstd"),
+        int(os.environ.get("CHAT_CACHE_COMPRESS_BYTES", 1024))
+    )
+)
+redis_breaker.on_close(chat_service.recovered)
+context_window = ContextWindow(
+    redis_client,
+    budgets={
+        CLAUDE: int(os.environ.get("CONTEXT_BUDGET_CLAUDE", 8000)),
+        DAISII: int(os.environ.get("CONTEXT_BUDGET_DAISII", 6000)),
+        TITAN: int(os.environ.get("CONTEXT_BUDGET_TITAN", 6000)),
+    },
+    summarize=os.environ.get("CONTEXT_SUMMARY", "false").lower() == "true"
+)
+prompt_renderer = PromptRenderer()
+# Images are stored once by hash, messages only reference them
+if os.environ.get("BLOB_STORE_BACKEND", "local") == "s3":
+    blob_backend = aws_clients.client("s3", os.environ.get("BLOB_STORE_REGION"))
+else:
+    blob_backend = LocalObjectStore(os.environ.get("BLOB_STORE_DIR", "blobs"))
+blob_store = BlobStore(
+    blob_backend,
+    os.environ.get("BLOB_STORE_BUCKET", "daisii-blobs"),
+    max_cached_bytes=int(os.environ.get("BLOB_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+)
+message_encoder = MessageEncoder(images=blob_store.get)
+stream_flush_chars = int(os.environ.get("STREAM_FLUSH_CHARS", 64))
+stream_flush_delay = int(os.environ.get("STREAM_FLUSH_MS", 30)) / 1000
+# Saves of cancelled replies and other work outliving its request
+background_tasks = set()
+background_drain_timeout = float(os.environ.get("BACKGROUND_DRAIN_TIMEOUT", 30))
+# WebSocket chat: concurrent streams and unsent messages per connection
+ws_max_streams = int(os.environ.get("WS_MAX_STREAMS", 4))
+ws_send_queue = int(os.environ.get("WS_SEND_QUEUE", 16))
+ws_auth_timeout = float(os.environ.get("WS_AUTH_TIMEOUT", 10))
+user_cache = UserCache(
+    redis_client,
+    max_size=int(os.environ.get("USER_CACHE_SIZE", 10000)),
+    ttl=float(os.environ.get("USER_CACHE_TTL", 60)),
+    negative_ttl=float(os.environ.get("USER_CACHE_NEGATIVE_TTL", 10))
+)
+user_provisioner = UserProvisioner(
+    user_database,
+    authentication.pwd_context,
+    user_cache,
+    int(os.environ["PROVISION_WORKERS"]) if os.environ.get("PROVISION_WORKERS") else None,
+    int(os.environ.get("PROVISION_BATCH_SIZE", 100))
+)
+admin_emails = {
+    email.strip().lower()
+    for email in os.environ.get("ADMIN_EMAILS", "").split(",")
+    if email.strip()
+}
+
+# Component state, read when /metrics is scraped
+REGISTRY.stats("daisii_write_behind", "Write-behind queue of chat history", write_queue.stats)
+REGISTRY.stats("daisii_response_cache", "Cached Bedrock replies", bedrock_service.response_cache.stats)
+REGISTRY.stats("daisii_blob_store", "Stored images and their in-memory cache", blob_store.stats)
+REGISTRY.stats("daisii_bcrypt_pool", "Password hashing pool", authentication.stats)
+REGISTRY.stats("daisii_redis_breaker", "Circuit breaker in front of Redis", redis_breaker.stats)
+REGISTRY.stats(
+    "daisii_bedrock_scheduler", "Concurrent Bedrock streams per model",
+    bedrock_scheduler.stats, label="model"
+)
+REGISTRY.stats("daisii_aws_pool", "AWS client connection pools", aws_clients.stats, label="service")
+REGISTRY.stats(
+    "daisii_cache_loads", "Coalesced cache misses",
+    lambda: {"user": user_loads.stats(), "chat": chat_service.loads.stats()},
+    label="cache"
+)
+lookup_timers = {source: USER_LOOKUP.labels(source) for source in ("local", "redis", "rds")}
+
+
+async def warm_up():
+    """
+    Build the AWS clients and open their first connections, then report ready.
+    """
+    warm_connections = (
+        (lambda: bedrock_service.bedrock_runtime, "BEDROCK_WARM_CONNECTIONS", 4),
+        (lambda: dynamodb_service.dynamodb.meta.client, "DYNAMODB_WARM_CONNECTIONS", 2),
+        (lambda: user_database.db, "AURORA_DATABASE_WARM_CONNECTIONS", 1),
+    )
+
+    def warm(client, variable, default):
+        try:
+            aws_clients.warm(client(), int(os.environ.get(variable, default)))
+        except Exception as e:
+            logging.error(f"Error while warming up connections: {str(e)}")
+
+    await asyncio.gather(*(
+        asyncio.to_thread(warm, *connections) for connections in warm_connections
+    ))
+    try:
+        await redis_client.ping()
+    except Exception as e:
+        logging.error(f"Error while warming up Redis: {str(e)}")
+    app.state.ready = True
+
+
+@app.get("/ready")
+async def ready():
+    """
+    Readiness probe, healthy once the connection pools are warm.
+    """
+    if not getattr(app.state, "ready", False):
+        return JSONResponse(status_code=503, content={"status": "starting"})
+    return {
+        "status": "ready",
+        "pools": aws_clients.stats(),
+        "redis": redis_breaker.stats()
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Prometheus metrics of this worker.
+    """
+    return Response(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 
 async def get_user(
     rds: AuroraPostgres, 
     email: EmailStr
 ):  
-    # Create a cache and check for user
+    lookup_started = time.perf_counter()
+    # Worker-local cache first, it also remembers missing users
+    cached_user = user_cache.get(email)
+    if cached_user is not None:
+        lookup_timers["local"].observe(time.perf_counter() - lookup_started)
+        return cached_user
+
+    # Then the shared Redis cache
     cache_key = f"user:{email}"
-    cached_user = redis_client.get(cache_key)
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.get(cache_key)
+            pipe.ttl(cache_key)
+            cached_user, ttl = await pipe.execute()
+    except RedisError:
+        # Redis is down, the worker-local cache above carries the load
+        cached_user = None
+
+    async def load_user():
+        try:
+            user = await rds.get_user(email)
+        except ClientError as e:
+            raise HTTPException(
+                    status_code=401,
+                    detail=f"Incorrect email. Error: {str(e)}"
+                )
+        if user:
+            try:
+                await redis_client.setex(cache_key, jittered(3600), user.model_dump_json())
+            except RedisError:
+                pass
+        return user or False
+
+    async def cached():
+        cached_user = await redis_client.get(cache_key)
+        return UserInDB.model_validate_json(cached_user) if cached_user else None
     
     if cached_user:
-        return UserInDB.model_validate_json(cached_user)
-    
-    #  If not search the database
-    result = await rds.get_user(email)
-    if result["status"] == "Error":
-        raise HTTPException(
-                status_code=401,
-                detail=f"Incorrect email. Error: {result['message']}"
-            )
-    if result["message"]:
-        user = UserInDB(
-            id=result["message"][0][0]["stringValue"],
-            email=result["message"][0][1]["stringValue"],
-            username=result["message"][0][2]["stringValue"],
-            password=result["message"][0][3]["stringValue"],
-            disabled=result["message"][0][4]["booleanValue"]
-        )
-        redis_client.setex(cache_key, 3600, user.model_dump_json())
+        user = UserInDB.model_validate_json(cached_user)
+        # Reload popular users shortly before they expire
+        if user_loads.should_refresh(ttl):
+            user_loads.refresh(cache_key, load_user)
+        user_cache.set(email, user)
+        lookup_timers["redis"].observe(time.perf_counter() - lookup_started)
         return user
-    else:
-        return False
+
+    #  If not search the database, concurrent misses share one query
+    user = await user_loads.do(cache_key, load_user, cached)
+    user_cache.set(email, user)
+    lookup_timers["rds"].observe(time.perf_counter() - lookup_started)
+    return user
 
 
 async def authenticate_user(
@@ -112,7 +360,7 @@ async def authenticate_user(
     user = await get_user(rds, email)
     if not user:
         return False
-    if not authen.verify_password(
+    if not await authen.verify_password(
         plain_password, 
         user.password
     ):
@@ -129,13 +377,10 @@ async def get_current_user(
         headers={"WWW-Authenticate": "Bearer"},
     )
     
-    try:
-        payload = session.decode(token)
-        email: EmailStr = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-        token_data = TokenData(email=email)
-    except InvalidTokenError:
+    decode_started = time.perf_counter()
+    token_data = session.get_token_data(token)
+    JWT_DECODE.observe(time.perf_counter() - decode_started)
+    if token_data is None:
         raise credentials_exception
     
     user = await get_user(
@@ -143,7 +388,7 @@ async def get_current_user(
         email=token_data.email
     )
     
-    if user is None:
+    if not user:
         raise credentials_exception
     return user
 
@@ -156,6 +401,14 @@ async def get_current_active_user(
     return current_user
 
 
+async def get_admin_user(
+    current_user: Annotated[UserInDB, Depends(get_current_active_user)],
+) -> UserInDB:
+    if current_user.email.lower() not in admin_emails:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return current_user
+
+
 @app.post("/token")
 async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()]
@@ -198,24 +451,29 @@ async def register_user(
         user.verify_passwords_match()
 
         # Hash the password before saving it
-        hashed_password = authentication.get_password_hash(user.password)
+        hashed_password = await authentication.get_password_hash(user.password)
 
         # Register the user in the database
-        result = await user_database.create_new_user(
-            user.email, 
-            user.username, 
-            hashed_password
-        )
-        
-        if result["status"] == "Error":
+        try:
+            await user_database.create_new_user(
+                user.email,
+                user.username,
+                hashed_password
+            )
+        except ClientError as e:
             raise HTTPException(
                 status_code=500,
-                detail=result["message"]
+                detail=str(e)
             )
 
+        # Forget any cached "no such user" for this email on every worker
+        await user_cache.invalidate(user.email)
+
         return {
             "message": f"User {user.email} registered successfully"
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error in register_user endpoint: {str(e)}")
         raise HTTPException(
@@ -224,26 +482,111 @@ async def register_user(
         )
 
 
+@app.post("/admin/profiler")
+async def start_profiler(
+    interval_ms: int = Query(5, ge=1, le=1000),
+    admin: UserInDB = Depends(get_admin_user)
+):
+    """
+    Start sampling the stacks of this worker, replacing the last profile.
+    """
+    PROFILER.start(interval_ms / 1000)
+    return {"running": True, "interval_ms": interval_ms}
+
+
+@app.delete("/admin/profiler")
+async def stop_profiler(admin: UserInDB = Depends(get_admin_user)):
+    await asyncio.to_thread(PROFILER.stop)
+    return {"running": False, "samples": PROFILER.samples}
+
+
+@app.get("/admin/profiler")
+async def get_profile(admin: UserInDB = Depends(get_admin_user)):
+    """
+    Sampled stacks in the folded format, for flamegraph.pl or speedscope.
+    """
+    return Response(PROFILER.folded(), media_type="text/plain")
+
+
+@app.post("/admin/users")
+async def provision_users(
+    request: Request,
+    admin: UserInDB = Depends(get_admin_user)
+):
+    """
+    Register users in bulk from a CSV (text/csv) or NDJSON
+    (application/x-ndjson) body, reporting the rows that failed.
+    """
+    content_type = request.headers.get("content-type", "")
+    if "csv" in content_type:
+        body_format = "csv"
+    elif "ndjson" in content_type or "jsonl" in content_type:
+        body_format = "ndjson"
+    else:
+        raise HTTPException(
+            status_code=415,
+            detail="Send users as text/csv or application/x-ndjson"
+        )
+
+    try:
+        return await user_provisioner.provision(await request.body(), body_format)
+    except ValueError as e:
+        # The body as a whole could not be read, rows are reported one by one
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logging.error(f"Error in provision_users endpoint: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail="Internal server error"
+        )
+
+
 @app.post("/chat/create/{conversation_id}")
 async def create_new_conversation(
     conversation_id: str,
     user: UserInDB = Depends(get_current_active_user)
 ):
-    await dynamodb_service.create_table(
+    await asyncio.to_thread(
+        dynamodb_service.create_conversation,
         user.id,
         conversation_id
     )
-    return {"message": "Table created successfully"}
+    return {"message": "Conversation created successfully"}
 
 
 @app.get("/chat/{conversation_id}")
 async def get_chat_history(
     conversation_id: str,
+    before: Annotated[int | None, Query(ge=1)] = None,
+    limit: Annotated[int, Query(ge=1, le=1000)] = 50,
+    stream: bool = False,
     user: UserInDB = Depends(get_current_active_user)
 ):
+    """
+    Return the newest `limit` messages older than the `before` cursor.
+
+    With `stream=true` the messages are sent newest first as NDJSON lines
+    `{"seq": ..., "message": ...}`, followed by a `{"before": ...}` line.
+    """
     try:
-        chat_history = await chat_service.get_chat_history(user.id, conversation_id)
-        return chat_history
+        if stream:
+            async def generate():
+                oldest = None
+                async for seq, message in chat_service.iter_messages(
+                    user.id, conversation_id, before, limit
+                ):
+                    if isinstance(message, bytes):
+                        message = message.decode()
+                    yield f'{{"seq":{seq},"message":{message}}}\n'
+                    oldest = seq
+                yield json.dumps({"before": oldest or None}) + "\n"
+
+            return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+        chat_history = await chat_service.get_chat_history_page_json(
+            user.id, conversation_id, before, limit
+        )
+        return Response(content=chat_history, media_type="application/json")
     except Exception as e:
         logging.error(f"Error in get_chat_history endpoint: {str(e)}")
         raise HTTPException(
@@ -252,69 +595,480 @@ async def get_chat_history(
         )
 
 
+async def invoke_model(model, user, conversation_id, messages, start, summary, now):
+    """
+    Render the prompt of `model` and start its Bedrock stream.
+    """
+    if model == CLAUDE:
+        instruction = render_instruction(INSTRUCTION_CLAUDE_VERSION, user.username, now)
+        # Only the images of messages not encoded yet are read from the store,
+        # and held by this request so the LRU cannot evict them before use
+        images = await blob_store.load(image_refs(
+            message_encoder.pending((user.id, conversation_id), messages, start)
+        ))
+        stream = await bedrock_service.invoke_model_claude(
+            with_summary(instruction, summary),
+            messages=message_encoder.claude(
+                (user.id, conversation_id), messages, start,
+                images=lambda ref: images.get(ref) or blob_store.get(ref)
+            ),
+            max_token=1024,
+            temp=0,
+            p=0.99,
+            k=0,
+            volatile=(now,)
+        )
+    elif model == DAISII:
+        instruction = render_instruction(INSTRUCTION_DAISII_VERSION, user.username, now)
+        prompt = prompt_renderer.llama(
+            (user.id, conversation_id),
+            with_summary(instruction, summary),
+            messages,
+            start
+        )
+        stream = await bedrock_service.invoke_model_llama(
+            prompt, 1024, 0, 0.99, volatile=(now,)
+        )
+    elif model == TITAN:
+        instruction = render_instruction(INSTRUCTION_TITAN_VERSION, user.username, now)
+        prompt = prompt_renderer.titan(
+            (user.id, conversation_id),
+            with_summary(instruction, summary),
+            messages,
+            start
+        )
+        stream = await bedrock_service.invoke_model_titan(
+            prompt, 1024, 0, 0.99, volatile=(now,)
+        )
+    return stream
+
+
+def record_generation(model, stream, invoked, first_token, response):
+    BEDROCK_TTFT.labels(model).observe(first_token - invoked)
+    generating = time.perf_counter() - first_token
+    if generating > 0:
+        # Bedrock reports the output tokens on its last event, estimate otherwise
+        tokens = stream.output_tokens or len(response) / CHARS_PER_TOKEN[model]
+        BEDROCK_TOKENS_PER_SECOND.labels(model).observe(tokens / generating)
+
+
+def in_background(coroutine):
+    """
+    Run `coroutine` outside the current request, shutdown waits for it.
+    """
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def start_reply(model, user, conversation_id, messages):
+    """
+    Wait for a slot of `model` and start its Bedrock stream on the
+    conversation. Return the stream, the slot and the invoke time.
+    """
+    # Only the recent part of the conversation that fits the budget is sent
+    context, summary = await context_window.fit(
+        model, user.id, conversation_id, messages
+    )
+    start = len(messages) - len(context)
+    # The time changes every request, replies are cached regardless of it
+    now = current_time()
+
+    # Wait for a free slot of the model, or get a 429 when it is saturated
+    slot = await bedrock_scheduler.acquire(model, user.id)
+    invoked = time.perf_counter()
+    try:
+        stream = await invoke_model(model, user, conversation_id, messages, start, summary, now)
+    except Exception as e:
+        if is_throttling(e):
+            slot.release("throttled")
+            raise HTTPException(
+                status_code=429,
+                detail="The model is busy. Please try again",
+                headers={"Retry-After": "1"}
+            )
+        slot.release("neutral")
+        raise
+    if isinstance(stream, utils.ReplayStream):
+        # Cached replies do not use Bedrock capacity
+        slot.release("neutral")
+    return stream, slot, invoked
+
+
+async def save_reply(user, conversation_id, messages, reply, finish=None):
+    try:
+        # Update messages with assistant's response
+        messages.append(ChatMessage(
+            role="assistant",
+            content=reply
+        ))
+
+        # Save the user message of this turn and the reply, DynamoDB is
+        # written behind
+        await chat_service.save_chat_history(
+            user.id,
+            conversation_id,
+            messages[-2:]
+        )
+    finally:
+        if finish is not None:
+            await finish()
+
+
+async def reply_chunks(model, user, conversation_id, messages, stream, slot, invoked, finish=None):
+    """
+    Yield the text of a started reply, then save it with the messages not
+    stored yet. `finish` is awaited once, after the save or on failure.
+
+    When the consumer stops early, because the client cancelled or went
+    away, the Bedrock stream is closed at once and the text generated so
+    far is saved as the reply.
+    """
+    parts = []
+    outcome = "neutral"
+    first_token = None
+    generated = False
+    try:
+        async with aclosing(utils.process_stream(
+            stream, model, stream_flush_chars, stream_flush_delay
+        )) as chunks:
+            async for chunk in chunks:
+                if first_token is None:
+                    first_token = time.perf_counter()
+                parts.append(chunk)
+                yield chunk
+        # Free the slot before persisting, Bedrock is done with us
+        outcome = "success"
+        slot.release(outcome)
+        generated = True
+        full_response = "".join(parts)
+        if first_token is not None and not isinstance(stream, utils.ReplayStream):
+            record_generation(model, stream, invoked, first_token, full_response)
+        bedrock_service.cache_response(stream, full_response)
+        # Shielded, a client leaving now does not lose the reply
+        await asyncio.shield(in_background(
+            save_reply(user, conversation_id, messages, full_response, finish)
+        ))
+    except (asyncio.CancelledError, GeneratorExit):
+        if not generated:
+            if parts:
+                await asyncio.shield(in_background(
+                    save_reply(user, conversation_id, messages, "".join(parts), finish)
+                ))
+            elif finish is not None:
+                await asyncio.shield(in_background(finish()))
+        raise
+    except Exception as e:
+        if is_throttling(e):
+            outcome = "throttled"
+        if not generated and finish is not None:
+            in_background(finish())
+        raise
+    finally:
+        slot.release(outcome)
+
+
+async def stream_reply(model, user, conversation_id, messages, finish=None, headers=None):
+    """
+    Invoke `model` on the conversation and stream its reply, then save the
+    reply with any messages not stored yet.
+    """
+    stream, slot, invoked = await start_reply(model, user, conversation_id, messages)
+
+    async def generate():
+        try:
+            async with aclosing(reply_chunks(
+                model, user, conversation_id, messages, stream, slot, invoked, finish
+            )) as chunks:
+                async for chunk in chunks:
+                    yield chunk
+        except Exception as e:
+            logging.error(f"Error while streaming response: {str(e)}")
+            raise HTTPException(status_code=500, detail="Error while streaming response")
+
+    return StreamingResponse(generate(), media_type="text/markdown", headers=headers)
+
+
+@app.get("/images/{ref}")
+async def get_image(
+    ref: str,
+    user: UserInDB = Depends(get_current_active_user)
+):
+    """
+    An image of the user's conversations, by the reference history returns
+    in place of its payload.
+    """
+    try:
+        data, media_type = await blob_store.open(user.id, ref)
+    except ValueError:
+        # Another user's image is as unknown as a missing one
+        raise HTTPException(status_code=404, detail="Image not found")
+    except Exception as e:
+        logging.error(f"Error in get_image endpoint: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail="Internal server error"
+        )
+    # Content addressed, the bytes behind a reference never change
+    return Response(
+        content=data,
+        media_type=media_type,
+        headers={"Cache-Control": "private, max-age=31536000, immutable"}
+    )
+
+
 @app.post("/chat/{conversation_id}")
 async def chat(
     conversation_id: str,
     messages: List[ChatMessage],
     model: str,
-    background_tasks: BackgroundTasks,
     user: UserInDB = Depends(get_current_active_user)
 ):
     try:
-        messages = eval(messages.model_dump_json())
-        
-        if model == CLAUDE:
-            stream = await bedrock_service.invoke_model_claude(
-                INSTRUCTION_CLAUDE_VERSION, 
-                messages=messages, 
-                max_token=1024, 
-                temp=0, 
-                p=0.99, 
-                k=0
+        if model not in (CLAUDE, DAISII, TITAN):
+            logging.error("Invalid model specified from parameter")
+            raise HTTPException(status_code=400, detail="Invalid model specified")
+
+        # Inline images are stored once and replaced by references
+        try:
+            await blob_store.externalize(user.id, messages)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        return await stream_reply(model, user, conversation_id, messages)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error in chat endpoint: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+
+@app.post("/chat/{conversation_id}/turn")
+async def chat_turn(
+    conversation_id: str,
+    turn: ChatTurn,
+    model: str,
+    user: UserInDB = Depends(get_current_active_user)
+):
+    """
+    Send only the new user message, the history is read from the server.
+
+    Answers 409 with the newest sequence number when `last_seq` is not the
+    last stored message, or while another turn is being answered. The
+    reply streams like POST /chat/{conversation_id}, with the sequence
+    number of the user message in `X-Message-Seq` (the reply is the next).
+    """
+    try:
+        if model not in (CLAUDE, DAISII, TITAN):
+            logging.error("Invalid model specified from parameter")
+            raise HTTPException(status_code=400, detail="Invalid model specified")
+
+        try:
+            await blob_store.externalize(user.id, [turn.message])
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        try:
+            messages, token = await chat_service.begin_turn(
+                user.id, conversation_id, turn.last_seq
             )
-        elif model == DAISII:
-            prompt = bedrock_service.format_llama_prompt(
-                messages, INSTRUCTION_DAISII_VERSION
+        except ConflictError as e:
+            raise HTTPException(
+                status_code=409,
+                detail={"message": str(e), "last_seq": e.last_seq}
             )
-            stream = await bedrock_service.invoke_model_llama(prompt, 1024, 0, 0.99)
-        elif model == TITAN:
-            prompt = bedrock_service.format_titan_prompt(
-                messages, INSTRUCTION_TITAN_VERSION
+
+        async def finish():
+            await chat_service.end_turn(user.id, conversation_id, token)
+
+        messages.append(turn.message)
+        try:
+            return await stream_reply(
+                model, user, conversation_id, messages, finish,
+                headers={"X-Message-Seq": str(len(messages) - 1)}
             )
-            stream = await bedrock_service.invoke_model_titan(prompt, 1024, 0, 0.99)
-        else:
-            logging.error(f"Invalid model specified from parameter")
-            raise HTTPException(status_code=400, detail="Invalid model specified")
-        
-        async def generate(model_type):
-            full_response = ""
+        except BaseException:
+            await finish()
+            raise
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error in chat_turn endpoint: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+
+@app.websocket("/ws/chat")
+async def chat_socket(websocket: WebSocket):
+    """
+    Chat turns over one connection.
+
+    The client first sends {"type": "auth", "token"} and gets
+    {"type": "ready"}. The token and the user are checked again for each
+    turn, the connection is closed like a failed auth (4401 for an expired
+    token, 4400 for a disabled user) once they are not valid anymore. Each {"type": "chat", "id", "conversation_id",
+    "model", "message", "last_seq"} is answered like
+    POST /chat/{conversation_id}/turn, as {"type": "start", "id", "seq"},
+    {"type": "delta", "id", "text"}... and {"type": "done", "id", "seq",
+    "cancelled"}, or {"type": "error", "id", "status", "detail"}. Up to
+    WS_MAX_STREAMS turns stream at once, interleaved by id.
+
+    {"type": "cancel", "id"} stops a turn: its Bedrock stream is closed
+    and the text generated so far is saved as the reply, which is what
+    happens to every open turn when the connection drops.
+
+    Outgoing messages wait in a queue of WS_SEND_QUEUE. While a slow
+    client has it full, the streams stop reading from Bedrock.
+    """
+    await websocket.accept()
+    try:
+        auth = await asyncio.wait_for(websocket.receive_json(), ws_auth_timeout)
+        if not isinstance(auth, dict) or auth.get("type") != "auth":
+            raise ValueError("Expected an auth message")
+        token = str(auth.get("token"))
+        user = await get_current_active_user(await get_current_user(token))
+    except WebSocketDisconnect:
+        return
+    except HTTPException as e:
+        await websocket.close(code=4000 + e.status_code, reason=str(e.detail))
+        return
+    except (asyncio.TimeoutError, ValueError):
+        await websocket.close(code=4401, reason="Could not validate credentials")
+        return
+
+    outgoing = asyncio.Queue(maxsize=ws_send_queue)
+    streams = {}
+    cancelling = set()
+    closed = False
+
+    async def send(message):
+        if not closed:
+            await outgoing.put(message)
+
+    async def send_all():
+        while True:
+            message = await outgoing.get()
+            await websocket.send_text(dumps(message).decode())
+
+    async def turn(user, request_id, conversation_id, model, chat_turn):
+        seq = None
+        replied = False
+        try:
+            if model not in (CLAUDE, DAISII, TITAN):
+                raise HTTPException(status_code=400, detail="Invalid model specified")
+
             try:
-                async for chunk in utils.process_stream(stream, model_type):
-                    yield chunk
-                    full_response += chunk
-                
-                # Update messages with assistant's response
-                messages.append(ChatMessage(
-                    role="assistant",
-                    content=full_response
-                ))
-                
-                # Save chat history in background
-                await chat_service.save_chat_history(
-                    user.id,
-                    conversation_id,
-                    messages,
-                    background_tasks
+                await blob_store.externalize(user.id, [chat_turn.message])
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+
+            try:
+                messages, token = await chat_service.begin_turn(
+                    user.id, conversation_id, chat_turn.last_seq
+                )
+            except ConflictError as e:
+                raise HTTPException(
+                    status_code=409,
+                    detail={"message": str(e), "last_seq": e.last_seq}
                 )
-                            
-            except Exception as e:
-                logging.error(f"Error while streaming response: {str(e)}")
-                raise HTTPException(status_code=500, detail="Error while streaming response")
 
-        return StreamingResponse(generate(model), media_type="text/markdown")
-    except Exception as e:
-        logging.error(f"Error in chat endpoint: {str(e)}")
-        raise HTTPException(status_code=500, detail="Internal server error")
+            async def finish():
+                await chat_service.end_turn(user.id, conversation_id, token)
+
+            messages.append(chat_turn.message)
+            seq = len(messages) - 1
+            try:
+                await send({"type": "start", "id": request_id, "seq": seq})
+                stream, slot, invoked = await start_reply(model, user, conversation_id, messages)
+            except BaseException:
+                await asyncio.shield(in_background(finish()))
+                raise
+
+            async with aclosing(reply_chunks(
+                model, user, conversation_id, messages, stream, slot, invoked, finish
+            )) as chunks:
+                async for text in chunks:
+                    replied = True
+                    await send({"type": "delta", "id": request_id, "text": text})
+            await send({"type": "done", "id": request_id, "seq": seq + 1, "cancelled": False})
+        except asyncio.CancelledError:
+            if request_id not in cancelling:
+                raise
+            # Cancelled by the client, the partial reply is saved by now
+            await send({
+                "type": "done",
+                "id": request_id,
+                "seq": seq + 1 if replied else None,
+                "cancelled": True
+            })
+        except HTTPException as e:
+            await send({"type": "error", "id": request_id, "status": e.status_code, "detail": e.detail})
+        except Exception as e:
+            logging.error(f"Error while streaming response: {str(e)}")
+            await send({
+                "type": "error",
+                "id": request_id,
+                "status": 500,
+                "detail": "Error while streaming response"
+            })
+        finally:
+            streams.pop(request_id, None)
+            cancelling.discard(request_id)
+
+    sender = asyncio.create_task(send_all())
+    await send({"type": "ready"})
+    try:
+        while True:
+            try:
+                message = await websocket.receive_json()
+                if not isinstance(message, dict):
+                    raise ValueError("Expected an object")
+                kind, request_id = message.get("type"), message.get("id")
+                if kind == "cancel":
+                    if request_id in streams:
+                        cancelling.add(request_id)
+                        streams[request_id].cancel()
+                    continue
+                if kind != "chat":
+                    raise ValueError(f"Unknown message type {kind}")
+                chat_turn = ChatTurn.model_validate(message)
+                conversation_id = message.get("conversation_id")
+                if not isinstance(request_id, str) or not isinstance(conversation_id, str):
+                    raise ValueError("id and conversation_id are required")
+            except ValueError as e:
+                await send({"type": "error", "id": None, "status": 400, "detail": str(e)})
+                continue
+
+            # The token may have expired, or the user been disabled, since
+            # the connection was authenticated. Both lookups are cached.
+            try:
+                user = await get_current_active_user(await get_current_user(token))
+            except HTTPException as e:
+                await websocket.close(code=4000 + e.status_code, reason=str(e.detail))
+                break
+
+            if request_id in streams:
+                await send({"type": "error", "id": request_id, "status": 400, "detail": "Duplicate id"})
+            elif len(streams) >= ws_max_streams:
+                await send({
+                    "type": "error",
+                    "id": request_id,
+                    "status": 429,
+                    "detail": "Too many streams on this connection"
+                })
+            else:
+                streams[request_id] = asyncio.create_task(
+                    turn(user, request_id, conversation_id, message.get("model"), chat_turn)
+                )
+    except WebSocketDisconnect:
+        pass
+    finally:
+        closed = True
+        sender.cancel()
+        # Open turns are cancelled, their partial replies are saved
+        for task in streams.values():
+            task.cancel()
+        await asyncio.gather(sender, *streams.values(), return_exceptions=True)
 
 
 if __name__ == "__main__":
@@ -1,55 +1,134 @@
-import boto3
-import json
+import asyncio
 
-from typing import Any
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property, partial
+from typing import Iterable, List
+
+from aws_services.clients import ClientFactory
+from cache import ResponseCache
+from codec import dumps
+from config import CLAUDE, DAISII, TITAN
+from models.chat import json_array
+from utils import AsyncEventStream, ReplayStream
 
 
 class BedrockService:
-    def __init__(self, region_name: str):
-        self.bedrock_runtime = boto3.client('bedrock-runtime', region_name=region_name)
+    def __init__(
+        self,
+        region_name: str,
+        max_streams: int = 256,
+        response_cache: ResponseCache | None = None,
+        replay_chunk_size: int = 16,
+        clients: ClientFactory | None = None
+    ):
+        self.region_name = region_name
+        self.max_streams = max_streams
+        self.clients = clients or ClientFactory()
+        self.response_cache = response_cache or ResponseCache(max_bytes=0)
+        self.replay_chunk_size = replay_chunk_size
+        # boto3 is blocking: the invoke call and every read of the response
+        # stream run on this pool so the event loop never waits on Bedrock.
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_streams,
+            thread_name_prefix="bedrock-stream"
+        )
+
+
+    @cached_property
+    def bedrock_runtime(self):
+        # An open stream holds its connection until it is fully read
+        return self.clients.client(
+            'bedrock-runtime', self.region_name, max_pool_connections=self.max_streams
+        )
+
+
+    async def invoke_stream(
+        self,
+        model: str,
+        model_id: str,
+        body: bytes,
+        temperature: float,
+        volatile: Iterable[str] = ()
+    ) -> AsyncEventStream | ReplayStream:
+        """
+        Start a streamed completion, or replay it when an identical
+        deterministic request was answered before.
+        """
+        cache_key = None
+        if self.response_cache.enabled(model, temperature):
+            cache_key = self.response_cache.key(model_id, body, volatile)
+            text = self.response_cache.get(cache_key)
+            if text is not None:
+                return ReplayStream(text, self.replay_chunk_size)
+
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(
+            self.executor,
+            partial(
+                self.bedrock_runtime.invoke_model_with_response_stream,
+                modelId=model_id,
+                accept="application/json",
+                contentType="application/json",
+                body=body,
+            )
+        )
+        stream = AsyncEventStream(response['body'], self.executor)
+        stream.cache_key = cache_key
+        return stream
+
 
-    async def invoke_model_claude(self, instruction, messages, max_token, temp, p, k):
-        body = json.dumps({
+    def cache_response(self, stream, text: str):
+        """
+        Remember the full text of a completed stream for replay.
+        """
+        if stream.cache_key is not None:
+            self.response_cache.put(stream.cache_key, text)
+
+
+    async def invoke_model_claude(self, instruction, messages: List[bytes], max_token, temp, p, k, volatile=()):
+        """
+        `messages` are already in the wire format, see serialization.MessageEncoder.
+        """
+        body = dumps({
             "anthropic_version": "bedrock-2023-05-31",
             "max_tokens": max_token,
             "system": instruction,
-            "messages": messages,
             "temperature": temp,
             "top_p": p,
             "top_k": k,
             "stop_sequences": []
         })
+        # Splice the encoded messages in instead of encoding them again
+        body = body[:-1] + b',"messages":' + json_array(messages) + b"}"
 
-        response = self.bedrock_runtime.invoke_model_with_response_stream(
-            modelId="anthropic.claude-3-haiku-20240307-v1:0",
-            accept="application/json",
-            contentType="application/json",
-            body=body,
+        return await self.invoke_stream(
+            CLAUDE,
+            "anthropic.claude-3-haiku-20240307-v1:0",
+            body,
+            temp,
+            volatile
         )
-        
-        return response['body']
     
     
-    async def invoke_model_llama(self, instruction, max_token, temp, p):
-        body = json.dumps({
+    async def invoke_model_llama(self, instruction, max_token, temp, p, volatile=()):
+        body = dumps({
             "prompt": instruction,
             "max_gen_len": max_token,
             "temperature": temp,
             "top_p": p,
         })
         
-        response = self.bedrock_runtime.invoke_model_with_response_stream(
-            modelId="us.meta.llama3-2-3b-instruct-v1:0",
-            accept="application/json",
-            contentType="application/json",
-            body=body,
+        return await self.invoke_stream(
+            DAISII,
+            "us.meta.llama3-2-3b-instruct-v1:0",
+            body,
+            temp,
+            volatile
         )
-        
-        return response['body']
     
     
-    async def invoke_model_titan(self, instruction, max_token, temp, p):
-        body = json.dumps({
+    async def invoke_model_titan(self, instruction, max_token, temp, p, volatile=()):
+        body = dumps({
             "inputText": instruction,
             "textGenerationConfig": {
                 "maxTokenCount": max_token,
@@ -59,25 +138,10 @@ class BedrockService:
             }
         })
 
-        response = self.bedrock_runtime.invoke_model_with_response_stream(
-            modelId="amazon.titan-text-premier-v1:0",
-            accept="application/json",
-            contentType="application/json",
-            body=body,
+        return await self.invoke_stream(
+            TITAN,
+            "amazon.titan-text-premier-v1:0",
+            body,
+            temp,
+            volatile
         )
-
-        return response['body']
-    
-    
-    def format_llama_prompt(self, user_messages, instruction):
-        return f""""<|start_header_id|>system<|end_header_id|>
-        {instruction}
-        <|eot_id|><|start_header_id|>user<|end_header_id|>
-        
-        {user_messages}<|eot_id|><|start_header_id|>assistant<|end_header_id|>"""
-
-    
-    def format_titan_prompt(self, user_messages, instruction):
-        return f"""{instruction}
-        {user_messages}
-        """
\ No newline at end of file
@@ -0,0 +1,170 @@
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+import boto3
+
+from botocore.config import Config
+
+from metrics import AWS_CALLS
+
+
+class ClientFactory:
+    """
+    Builds and shares the boto3 clients of the app.
+
+    Clients are created on first use, so importing the app does not touch
+    AWS. Each one gets a connection pool sized for the concurrency of the
+    service using it (botocore defaults to 10 connections, and further
+    calls queue inside urllib3), TCP keep-alive so idle connections survive
+    NAT and load balancer timeouts, and adaptive retries that back off
+    client side when AWS throttles.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 3,
+        connect_timeout: float = 5,
+        read_timeout: float = 60
+    ):
+        self.max_attempts = max_attempts
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.session = boto3.Session()
+        self._clients = {}
+        self._counters = {}
+        # boto3 sessions are not thread safe and clients are built from workers
+        self._lock = threading.Lock()
+
+
+    def config(self, max_pool_connections: int) -> Config:
+        return Config(
+            max_pool_connections=max_pool_connections,
+            tcp_keepalive=True,
+            connect_timeout=self.connect_timeout,
+            read_timeout=self.read_timeout,
+            retries={"mode": "adaptive", "max_attempts": self.max_attempts}
+        )
+
+
+    def client(self, service: str, region_name: str, max_pool_connections: int = 10):
+        with self._lock:
+            key = ("client", service, region_name)
+            if key not in self._clients:
+                client = self.session.client(
+                    service,
+                    region_name=region_name,
+                    config=self.config(max_pool_connections)
+                )
+                self._instrument(service, client)
+                self._clients[key] = client
+            return self._clients[key]
+
+
+    def resource(self, service: str, region_name: str, max_pool_connections: int = 10):
+        with self._lock:
+            key = ("resource", service, region_name)
+            if key not in self._clients:
+                resource = self.session.resource(
+                    service,
+                    region_name=region_name,
+                    config=self.config(max_pool_connections)
+                )
+                self._instrument(service, resource.meta.client)
+                self._clients[key] = resource
+            return self._clients[key]
+
+
+    def _instrument(self, name: str, client):
+        counters = {"calls": 0, "attempts": 0, "errors": 0}
+        self._counters[name] = (client, counters)
+
+        def count(counter):
+            def handler(**kwargs):
+                counters[counter] += 1
+            return handler
+
+        # before-call fires once per API call, before-send once per attempt
+        events = client.meta.events
+        events.register("before-call", count("calls"))
+        events.register("before-send", count("attempts"))
+        events.register("after-call-error", count("errors"))
+
+        # The request context is per call, it carries the start to the end
+        timers = {}
+
+        def started(model, context, **kwargs):
+            context["metrics_started"] = time.perf_counter()
+            timer = timers.get(model.name)
+            if timer is None:
+                timer = timers[model.name] = AWS_CALLS.labels(name, model.name)
+            context["metrics_timer"] = timer
+
+        def finished(context, **kwargs):
+            if "metrics_started" in context:
+                context["metrics_timer"].observe(time.perf_counter() - context.pop("metrics_started"))
+
+        events.register("before-call", started)
+        events.register("after-call", finished)
+        events.register("after-call-error", finished)
+
+
+    @staticmethod
+    def _pools(client):
+        # botocore does not expose its urllib3 pools, read them best effort
+        try:
+            manager = client._endpoint.http_session._manager
+            return list(manager.pools._container.values())
+        except AttributeError:
+            return []
+
+
+    def warm(self, client, connections: int):
+        """
+        Open up to `connections` connections to the client's endpoint, so the
+        first requests do not pay for the TCP and TLS handshakes.
+        """
+        if connections <= 0:
+            return
+        manager = client._endpoint.http_session._manager
+        pool = manager.connection_from_url(client.meta.endpoint_url)
+        opened = [pool._get_conn() for _ in range(min(connections, pool.pool.maxsize))]
+        try:
+            with ThreadPoolExecutor(max_workers=len(opened)) as executor:
+                list(executor.map(
+                    lambda conn: conn.connect() if conn.sock is None else None,
+                    opened
+                ))
+        finally:
+            for conn in opened:
+                pool._put_conn(conn)
+        logging.info(f"Opened {len(opened)} connections to {client.meta.endpoint_url}")
+
+
+    def stats(self) -> Dict:
+        """
+        Pool utilization and call counters per service.
+
+        `in_use` includes connections held by open response streams, which
+        is what limits concurrent Bedrock streams.
+        """
+        stats = {}
+        for name, (client, counters) in self._counters.items():
+            in_use = idle = 0
+            for pool in self._pools(client):
+                in_use += pool.pool.maxsize - pool.pool.qsize()
+                idle += sum(
+                    1 for conn in list(pool.pool.queue)
+                    if conn is not None and conn.sock is not None
+                )
+            stats[name] = {
+                "max_connections": client.meta.config.max_pool_connections,
+                "in_use": in_use,
+                "idle": idle,
+                "retries": counters["attempts"] - counters["calls"],
+                **counters,
+            }
+        return stats
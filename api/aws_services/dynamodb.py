@@ -1,63 +1,201 @@
-import boto3
+from functools import cached_property
+
 from boto3.dynamodb.conditions import Key
 
+from aws_services.clients import ClientFactory
+
 
 class DynamoDBService:
-    def __init__(self, region_name: str, table: str):
-        self.dynamodb = boto3.resource('dynamodb', region_name=region_name)
+    """
+    Chat history in a single table.
+
+    Items are partitioned by `user_id`. The sort key `sk` holds one
+    metadata item per conversation (`<conversation_id>#meta`) and one item
+    per message (`<conversation_id>#msg#<seq>`), so creating a conversation
+    is a single write and a conversation is read with one key condition.
+    """
+
+    def __init__(
+        self,
+        region_name: str,
+        table: str,
+        clients: ClientFactory | None = None,
+        max_connections: int = 32
+    ):
+        self.region_name = region_name
         self.table_name = table
-        self.table = self.dynamodb.Table(table)
+        self.clients = clients or ClientFactory()
+        self.max_connections = max_connections
+
+
+    @cached_property
+    def dynamodb(self):
+        return self.clients.resource(
+            'dynamodb', self.region_name, max_pool_connections=self.max_connections
+        )
+
+
+    @cached_property
+    def table(self):
+        return self.dynamodb.Table(self.table_name)
 
 
-    def create_table(self, conversation_id):
-        table_name = f"{self.table_name}_{conversation_id}"
+    @staticmethod
+    def meta_key(conversation_id):
+        return f"{conversation_id}#meta"
+
+
+    @staticmethod
+    def message_prefix(conversation_id):
+        return f"{conversation_id}#msg#"
+
+
+    @staticmethod
+    def message_key(conversation_id, seq):
+        # Zero padded so the string sort key orders like the sequence number
+        return f"{conversation_id}#msg#{seq:010d}"
+
+
+    def create_table(self):
+        """
+        Create the chat history table. Run once per environment, see migrate.py.
+        """
         try:
             table = self.dynamodb.create_table(
-                TableName=table_name,
+                TableName=self.table_name,
                 KeySchema=[
                     {
-                        'AttributeName': 'conversation_id',
+                        'AttributeName': 'user_id',
                         'KeyType': 'HASH'
+                    },
+                    {
+                        'AttributeName': 'sk',
+                        'KeyType': 'RANGE'
                     }
                 ],
                 AttributeDefinitions=[
                     {
-                        'AttributeName': 'conversation_id',
+                        'AttributeName': 'user_id',
+                        'AttributeType': 'S'
+                    },
+                    {
+                        'AttributeName': 'sk',
                         'AttributeType': 'S'
                     }
                 ],
-                ProvisionedThroughput={
-                    'ReadCapacityUnits': 5,
-                    'WriteCapacityUnits': 5
-                }
+                BillingMode='PAY_PER_REQUEST'
             )
-            table.meta.client.get_waiter('table_exists').wait(TableName=table_name)
-            self.table = self.dynamodb.Table(table_name)
+            table.meta.client.get_waiter('table_exists').wait(TableName=self.table_name)
         except self.dynamodb.meta.client.exceptions.ResourceInUseException:
-            # If the table already exists, just use it
-            self.table = self.dynamodb.Table(table_name)
+            # The table already exists, it must not be a legacy one
+            if not self.has_current_schema(self.table_name):
+                raise RuntimeError(
+                    f"Table {self.table_name} has the legacy key schema, set "
+                    "DYNAMODB_TABLE_NAME to a new table and migrate it with "
+                    "migrate.py dynamodb-split-tables --source " + self.table_name
+                )
+
+
+    def has_current_schema(self, table_name):
+        """
+        Whether `table_name` is keyed by (user_id, sk) like the chat history table.
+        """
+        table = self.dynamodb.meta.client.describe_table(TableName=table_name)['Table']
+        return {
+            (key['AttributeName'], key['KeyType']) for key in table['KeySchema']
+        } == {('user_id', 'HASH'), ('sk', 'RANGE')}
+
+
+    def create_conversation(self, userid, conversation_id):
+        """
+        Record a new conversation. Creating an existing one is a no-op.
+        """
+        try:
+            self.table.put_item(
+                Item={
+                    'user_id': userid,
+                    'sk': self.meta_key(conversation_id),
+                    'conversation_id': conversation_id
+                },
+                ConditionExpression='attribute_not_exists(sk)'
+            )
+        except self.dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+            pass
 
 
     def get_chat_history(self, userid, conversation_id):
-        response = self.table.query(
-            KeyConditionExpression=Key('conversation_id').eq(conversation_id)
-        )
-        return response.get('Items', [])
+        """
+        Return the conversation's message items in sequence order.
+        """
+        query = {
+            'KeyConditionExpression': Key('user_id').eq(userid)
+                & Key('sk').begins_with(self.message_prefix(conversation_id))
+        }
+        items = []
+        while True:
+            response = self.table.query(**query)
+            items.extend(response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                return items
+            query['ExclusiveStartKey'] = response['LastEvaluatedKey']
 
 
-    async def save_chat_history(self, conversation_id, userid, messages):
-        result = self.table.put_item(
-            Item={
-                'userid': userid,
+    def get_chat_history_page(self, userid, conversation_id, before=None, limit=50, start_key=None):
+        """
+        Return up to `limit` message items older than `before`, newest first,
+        and the key to continue from when DynamoDB stopped early.
+        """
+        prefix = self.message_prefix(conversation_id)
+        if before is None:
+            sort_key = Key('sk').begins_with(prefix)
+        else:
+            sort_key = Key('sk').between(prefix, self.message_key(conversation_id, before - 1))
+        query = {
+            'KeyConditionExpression': Key('user_id').eq(userid) & sort_key,
+            'ScanIndexForward': False,
+            'Limit': limit
+        }
+        if start_key is not None:
+            query['ExclusiveStartKey'] = start_key
+        response = self.table.query(**query)
+        return response.get('Items', []), response.get('LastEvaluatedKey')
+
+
+    def message_items(self, conversation_id, userid, start_seq, messages):
+        """
+        Build one item per message, numbered from `start_seq`.
+        """
+        return [
+            {
+                'user_id': userid,
+                'sk': self.message_key(conversation_id, seq),
                 'conversation_id': conversation_id,
-                'messages': messages
+                'seq': seq,
+                'message': message
+            }
+            for seq, message in enumerate(messages, start_seq)
+        ]
+
+
+    def append_messages(self, conversation_id, userid, start_seq, messages):
+        """
+        Write one item per message, numbered from `start_seq`.
+
+        Items are keyed by sequence number, so replaying a write is harmless.
+        """
+        with self.table.batch_writer() as batch:
+            for item in self.message_items(conversation_id, userid, start_seq, messages):
+                batch.put_item(Item=item)
+
+
+    def batch_write(self, items):
+        """
+        Put up to 25 items in one request and return the unprocessed ones.
+        """
+        response = self.dynamodb.batch_write_item(
+            RequestItems={
+                self.table_name: [{'PutRequest': {'Item': item}} for item in items]
             }
         )
-        
-    
-if __name__ == "__main__":
-    dynamodb_service = DynamoDBService("us-east-1", "daisy-chat-history")
-    # conversation_id = uuid.uuid4().hex
-    # dynamodb_service.create_table(conversation_id)
-    dynamodb_service.save_chat_history("e34509c50d3d421990aa861b52c0881d", [{"role": "user", "content": "What is your name?"}])
-    print(dynamodb_service.get_chat_history("e34509c50d3d421990aa861b52c0881d"))
\ No newline at end of file
+        unprocessed = response.get('UnprocessedItems', {}).get(self.table_name, [])
+        return [request['PutRequest']['Item'] for request in unprocessed]
@@ -1,26 +1,143 @@
-import boto3
+import asyncio
+import json
 import os
 import logging
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property, partial
+from typing import Any, Dict, Iterable, List, Tuple
+
 from botocore.exceptions import ClientError
 
+from aws_services.clients import ClientFactory
+from models.user import UserInDB
+
+
+USER_COLUMNS = "userID::text AS id, email, username, password, disabled"
+
+
+def to_parameters(values: Dict[str, Any]) -> List[Dict]:
+    """
+    Map Python values to RDS Data API SQL parameters.
+    """
+    parameters = []
+    for name, value in values.items():
+        if value is None:
+            field = {'isNull': True}
+        elif isinstance(value, bool):
+            field = {'booleanValue': value}
+        elif isinstance(value, int):
+            field = {'longValue': value}
+        elif isinstance(value, float):
+            field = {'doubleValue': value}
+        else:
+            field = {'stringValue': str(value)}
+        parameters.append({'name': name, 'value': field})
+    return parameters
+
 
 class AuroraPostgres:
-    
-    def __init__(self, region_name):
+    """
+    Users in Aurora PostgreSQL, through the RDS Data API.
+
+    Data API calls are blocking HTTPS requests, they run on a dedicated
+    pool as wide as the client's connection pool so the event loop never
+    waits on the database. Rows come back as dicts keyed by column name
+    (`formatRecordsAs=JSON`), so queries name their columns instead of
+    relying on their position.
+
+    The schema is created by `python migrate.py rds-schema`, not here.
+    """
+
+    def __init__(
+        self,
+        region_name: str,
+        resource_arn: str | None = None,
+        secret_arn: str | None = None,
+        database: str | None = None,
+        clients: ClientFactory | None = None,
+        max_connections: int = 10
+    ):
+        self.region_name = region_name
+        self.resource_arn = resource_arn or os.environ.get('AURORA_DATABASE_RESOURCE_ARN')
+        self.secret_arn = secret_arn or os.environ.get('AURORA_DATABASE_SECRET_ARN')
+        self.database = database or os.environ.get('AURORA_DATABASE_NAME')
+        self.clients = clients or ClientFactory()
+        self.max_connections = max_connections
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_connections,
+            thread_name_prefix="rds-data"
+        )
+
+
+    @cached_property
+    def db(self):
+        return self.clients.client(
+            'rds-data', self.region_name, max_pool_connections=self.max_connections
+        )
+
+
+    def _execute(self, sql: str, parameters: Dict[str, Any] | None = None, **kwargs) -> Dict:
+        return self.db.execute_statement(
+            resourceArn=self.resource_arn,
+            secretArn=self.secret_arn,
+            database=self.database,
+            sql=sql,
+            parameters=to_parameters(parameters or {}),
+            **kwargs
+        )
+
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+
+    async def query(self, sql: str, **parameters) -> List[Dict]:
+        """
+        Run a SELECT and return its rows as dicts.
+        """
+        result = await self._run(self._execute, sql, parameters, formatRecordsAs='JSON')
+        return json.loads(result.get('formattedRecords') or '[]')
+
+
+    async def execute(self, sql: str, **parameters) -> int:
         """
-        Initialize the Aurora PostgreSQL database connection.
+        Run a statement and return the number of rows it changed.
         """
-        session = boto3.Session(region_name=region_name)
-        self.db = session.client('rds-data')
-        self.create_table_if_not_exists()
-        
-    
-    def create_table_if_not_exists(self):
+        result = await self._run(self._execute, sql, parameters)
+        return result.get('numberOfRecordsUpdated', 0)
+
+
+    async def execute_batch(self, sql: str, rows: Iterable[Dict[str, Any]]) -> List[Dict]:
+        """
+        Run one statement for many parameter sets in a single request and
+        return the result of each set.
+
+        The Data API runs a batch in one transaction, so either every row is
+        written or the call fails as a whole.
         """
-        Create the user database if it doesn't exist yet.
+        parameter_sets = [to_parameters(row) for row in rows]
+        if not parameter_sets:
+            return []
+        result = await self._run(
+            self.db.batch_execute_statement,
+            resourceArn=self.resource_arn,
+            secretArn=self.secret_arn,
+            database=self.database,
+            sql=sql,
+            parameterSets=parameter_sets
+        )
+        return result.get('updateResults', [])
+
+
+    def create_schema(self):
         """
-        create_table_sql = """
+        Create the user table if it doesn't exist yet. Run once per
+        environment, see migrate.py.
+        """
+        self._execute("""CREATE EXTENSION IF NOT EXISTS "uuid-ossp";""")
+        self._execute("""
             CREATE TABLE IF NOT EXISTS users (
                 userID uuid DEFAULT uuid_generate_v4(),
                 email VARCHAR(255) UNIQUE,
@@ -28,80 +145,69 @@ class AuroraPostgres:
                 password VARCHAR(255),
                 disabled BOOLEAN DEFAULT FALSE
             );
+        """)
+
+
+    async def create_new_user(self, email: str, username: str, password: str) -> str:
+        """
+        Insert new user into the Aurora PostgreSQL database and return its id.
         """
-        
         try:
-            result = self.db.execute_statement(
-                secretArn=os.environ.get('AURORA_DATABASE_SECRET_ARN'),
-                database=os.environ.get('AURORA_DATABASE_NAME'),
-                resourceArn=os.environ.get('AURORA_DATABASE_RESOURCE_ARN'),
-                sql="""CREATE EXTENSION IF NOT EXISTS "uuid-ossp";"""
-            ) 
-            result = self.db.execute_statement(
-                secretArn=os.environ.get('AURORA_DATABASE_SECRET_ARN'),
-                database=os.environ.get('AURORA_DATABASE_NAME'),
-                resourceArn=os.environ.get('AURORA_DATABASE_RESOURCE_ARN'),
-                sql=create_table_sql
-            ) 
-            
+            rows = await self.query(
+                """
+                INSERT INTO users (email, username, password)
+                VALUES (:email, :username, :password)
+                RETURNING userID::text AS id
+                """,
+                email=email,
+                username=username,
+                password=password
+            )
         except ClientError as e:
             logging.error(e)
-            return {"status": "Error", "message": str(e)}
-        return {"status": "Success", "message": result}
-    
-    
-    async def create_new_user(self, email: str, username: str, password: str):
-        """
-        Insert new user into the Aurora PostgreSQL database.
-        """
-        
-        insert_sql = """
-            INSERT INTO users (email, username, password)
-            VALUES (:email, :username, :password)
+            raise
+        return rows[0]['id']
+
+
+    async def create_users(self, users: Iterable[Tuple[str, str, str]]) -> List[str | None]:
         """
+        Insert many (email, username, password hash) users in one request.
 
+        Return the id of each new user, or None where the email is already
+        registered.
+        """
         try:
-            result = self.db.execute_statement(
-                secretArn=os.environ.get('AURORA_DATABASE_SECRET_ARN'),
-                database=os.environ.get('AURORA_DATABASE_NAME'),
-                resourceArn=os.environ.get('AURORA_DATABASE_RESOURCE_ARN'),
-                sql=insert_sql,
-                parameters=[
-                    {'name': 'email', 'value': {'stringValue': email}},
-                    {'name': 'username', 'value': {'stringValue': username}},
-                    {'name': 'password', 'value': {'stringValue': password}}
-                ]
+            results = await self.execute_batch(
+                """
+                INSERT INTO users (email, username, password)
+                VALUES (:email, :username, :password)
+                ON CONFLICT (email) DO NOTHING
+                RETURNING userID::text AS id
+                """,
+                (
+                    {'email': email, 'username': username, 'password': password}
+                    for email, username, password in users
+                )
             )
-
         except ClientError as e:
             logging.error(e)
-            return {"status": "Error", "message": str(e)}
-        return {"status": "Success", "message": result}
+            raise
+        return [
+            result['generatedFields'][0]['stringValue'] if result.get('generatedFields') else None
+            for result in results
+        ]
 
 
-    async def get_user(self, email: str):
+    async def get_user(self, email: str) -> UserInDB | None:
         """
         Get user from the Aurora PostgreSQL database.
         """
-
-        select_sql = """
-            SELECT * FROM users WHERE email = :email
-        """
-
         try:
-            result = self.db.execute_statement(
-                secretArn=os.environ.get('AURORA_DATABASE_SECRET_ARN'),
-                database=os.environ.get('AURORA_DATABASE_NAME'),
-                resourceArn=os.environ.get('AURORA_DATABASE_RESOURCE_ARN'),
-                sql=select_sql,
-                parameters=[
-                    {'name': 'email', 'value': {'stringValue': email}}
-                ]
+            rows = await self.query(
+                f"SELECT {USER_COLUMNS} FROM users WHERE email = :email",
+                email=email
             )
-            
-            # Assuming `records` is part of the result structure that returns the data.
-            return {"status": "Success", "message": result['records']}
-
         except ClientError as e:
             logging.error(e)
-            return {"status": "Error", "message": str(e)}
+            raise
+        return UserInDB.model_validate(rows[0]) if rows else None
@@ -0,0 +1,223 @@
+import asyncio
+import math
+import time
+
+from collections import OrderedDict, deque
+from typing import Dict
+
+from botocore.exceptions import ClientError
+from fastapi import HTTPException
+
+
+THROTTLING_ERRORS = {
+    "ThrottlingException",
+    "throttlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+}
+
+
+def is_throttling(error: Exception) -> bool:
+    """
+    Whether a Bedrock error (including mid-stream errors) means "slow down".
+    """
+    return (
+        isinstance(error, ClientError)
+        and error.response.get("Error", {}).get("Code") in THROTTLING_ERRORS
+    )
+
+
+class Slot:
+    """
+    Permission to run one Bedrock stream. Release it exactly once.
+    """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.started = time.monotonic()
+        self.released = False
+
+
+    def release(self, outcome: str = "success"):
+        """
+        `outcome` is "success", "throttled", or "neutral" (no signal, e.g. a
+        cached reply or a client error) and drives the adaptive limit.
+        """
+        if not self.released:
+            self.released = True
+            self.limiter.release(outcome, time.monotonic() - self.started)
+
+
+class ModelLimiter:
+    """
+    Adaptive concurrency limit for one model with a fair wait queue.
+
+    The limit grows by one per window of successful streams and halves on
+    throttling (AIMD), between `min_limit` and `max_limit`. Requests over
+    the limit wait in per-user queues that are served round robin, so one
+    busy user cannot starve the others. When the queue is full or a
+    request waits longer than `queue_timeout`, it is rejected with 429.
+    """
+
+    def __init__(
+        self,
+        max_limit: int,
+        min_limit: int = 1,
+        max_queue: int = 100,
+        queue_timeout: float = 10.0
+    ):
+        self.limit = float(max_limit)
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self.waiters = OrderedDict()
+        # Running estimate of how long a stream holds its slot
+        self.avg_duration = 5.0
+        self.throttled = 0
+        self.rejected = 0
+
+
+    def _rejection(self) -> HTTPException:
+        self.rejected += 1
+        retry_after = math.ceil(
+            self.avg_duration * (self.queued + 1) / max(1, int(self.limit))
+        )
+        return HTTPException(
+            status_code=429,
+            detail="The model is busy. Please try again",
+            headers={"Retry-After": str(max(1, retry_after))}
+        )
+
+
+    def _remove(self, user_id, waiter):
+        queue = self.waiters.get(user_id)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            self.queued -= 1
+            if not queue:
+                del self.waiters[user_id]
+
+
+    def _grant(self):
+        while self.queued and self.in_flight < int(self.limit):
+            user_id, queue = next(iter(self.waiters.items()))
+            waiter = queue.popleft()
+            self.queued -= 1
+            if queue:
+                self.waiters.move_to_end(user_id)
+            else:
+                del self.waiters[user_id]
+            self.in_flight += 1
+            waiter.set_result(None)
+
+
+    async def acquire(self, user_id: str) -> Slot:
+        if not self.queued and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return Slot(self)
+        if self.queued >= self.max_queue:
+            raise self._rejection()
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(user_id, deque()).append(waiter)
+        self.queued += 1
+        try:
+            await asyncio.wait((waiter,), timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            if waiter.done():
+                Slot(self).release("neutral")
+            else:
+                self._remove(user_id, waiter)
+            raise
+        if not waiter.done():
+            self._remove(user_id, waiter)
+            raise self._rejection()
+        return Slot(self)
+
+
+    def release(self, outcome: str, duration: float):
+        self.in_flight -= 1
+        if outcome == "throttled":
+            self.throttled += 1
+            self.limit = max(self.min_limit, self.limit / 2)
+        elif outcome == "success":
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.avg_duration = 0.9 * self.avg_duration + 0.1 * duration
+        self._grant()
+
+
+    def stats(self) -> Dict:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "throttled": self.throttled,
+            "rejected": self.rejected,
+        }
+
+
+class BedrockScheduler:
+    """
+    One `ModelLimiter` per model (Claude, Daisii, Titan).
+    """
+
+    def __init__(
+        self,
+        limits: Dict[str, int],
+        max_queue: int = 100,
+        queue_timeout: float = 10.0
+    ):
+        self.limiters = {
+            model: ModelLimiter(limit, max_queue=max_queue, queue_timeout=queue_timeout)
+            for model, limit in limits.items()
+        }
+
+
+    async def acquire(self, model: str, user_id: str) -> Slot:
+        return await self.limiters[model].acquire(user_id)
+
+
+    def stats(self) -> Dict:
+        return {model: limiter.stats() for model, limiter in self.limiters.items()}
+
+
+if __name__ == "__main__":
+    import random
+
+    async def simulate(requests: int = 400, capacity: int = 8):
+        """
+        Drive a fake Bedrock that throttles above `capacity` concurrent streams.
+        """
+        limiter = ModelLimiter(max_limit=32, max_queue=requests, queue_timeout=60)
+        active = 0
+        outcomes = {"success": 0, "throttled": 0, "rejected": 0}
+
+        async def call(user_id):
+            nonlocal active
+            try:
+                slot = await limiter.acquire(user_id)
+            except HTTPException:
+                outcomes["rejected"] += 1
+                return
+            active += 1
+            try:
+                if active > capacity:
+                    await asyncio.sleep(0.001)
+                    outcome = "throttled"
+                else:
+                    await asyncio.sleep(random.uniform(0.01, 0.03))
+                    outcome = "success"
+            finally:
+                active -= 1
+            outcomes[outcome] += 1
+            slot.release(outcome)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(call(f"user{i % 10}") for i in range(requests)))
+        print(f"{requests} requests in {time.perf_counter() - start:.2f}s: {outcomes}")
+        print(f"final limit {limiter.stats()['limit']} for a capacity of {capacity}")
+
+    asyncio.run(simulate())
@@ -0,0 +1,84 @@
+"""
+Size and speed of the cached message formats.
+
+    python -m benchmarks.cache_codec [--messages 200] [--runs 5]
+
+Encodes a conversation shaped like production, short questions, longer
+answers, tool calls and an image every few turns, with every encoding
+and compression `CacheCodec` supports, next to the JSON stored before
+the codec.
+"""
+import argparse
+import base64
+import os
+import time
+
+from typing import List
+
+from codec import CacheCodec
+from models.chat import ChatMessage
+
+
+def history(messages: int, image_every: int = 10) -> List[bytes]:
+    image = base64.b64encode(os.urandom(64 * 1024)).decode()
+    documents = []
+    for i in range(messages):
+        if i % 2:
+            message = {"role": "assistant", "content": f"Here is answer {i}. " + "The details follow. " * 30}
+        elif i % image_every == 0:
+            message = {"role": "user", "content": [
+                {"type": "text", "text": f"What is in picture {i}?"},
+                {"type": "image", "source": {"media_type": "image/png", "data": image}},
+            ]}
+        elif i % 7 == 0:
+            message = {"role": "user", "content": [
+                {"type": "tool_use", "tool_use_id": f"t{i}", "tool_name": "search", "input": {"q": "daisii"}},
+                {"type": "tool_result", "tool_use_id": f"t{i}", "is_error": False,
+                 "content": [{"type": "text", "text": "result " * 50}]},
+            ]}
+        else:
+            message = {"role": "user", "content": f"Question {i}: " + "how does this work? " * 8}
+        documents.append(ChatMessage.model_validate(message).model_dump_json().encode())
+    return documents
+
+
+def timed(func, runs: int) -> float:
+    func()
+    start = time.perf_counter()
+    for _ in range(runs):
+        func()
+    return (time.perf_counter() - start) / runs * 1000
+
+
+def main(messages: int = 200, runs: int = 5):
+    codecs = [("legacy json", None)]
+    for encoding in ("json", "msgpack"):
+        for compression in ("none", "zlib", "zstd", "lz4"):
+            codecs.append((f"{encoding} + {compression}", CacheCodec(encoding, compression)))
+
+    for label, documents in (
+        (f"{messages} messages, text only", history(messages, image_every=10 ** 9)),
+        (f"{messages} messages, image every 10", history(messages)),
+    ):
+        raw = sum(len(d) for d in documents)
+        print(f"{label}: {raw / 1024:.0f} KiB of JSON")
+        print(f"  {'codec':<18} {'stored KiB':>10} {'ratio':>6} {'encode ms':>10} {'decode ms':>10}")
+        for name, codec in codecs:
+            if codec is None:
+                entries, encode, decode = documents, 0.0, 0.0
+            else:
+                entries = codec.encode_many(documents)
+                assert codec.decode_many(entries) == documents or codec.encoding == "msgpack"
+                encode = timed(lambda: codec.encode_many(documents), runs)
+                decode = timed(lambda: codec.decode_many(entries), runs)
+            stored = sum(len(e) for e in entries)
+            print(f"  {name:<18} {stored / 1024:>10.0f} {raw / stored:>6.2f} {encode:>10.2f} {decode:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    main(args.messages, args.runs)
@@ -0,0 +1,71 @@
+"""
+Encoding a long conversation for a Claude request.
+
+    python -m benchmarks.encoding [--messages 500] [--runs 5]
+
+The conversation alternates questions and answers, every fifth question
+carries a 150 KB image. Compares the previous encodings with the single
+pass of `serialization.encode_claude_message`, and with `MessageEncoder`
+when only the newest message is new.
+"""
+import argparse
+import base64
+import json
+import os
+import time
+
+from models.chat import ChatMessage, json_array
+from serialization import MessageEncoder, encode_claude_message
+
+
+def conversation(count: int):
+    image = base64.b64encode(os.urandom(150 * 1024)).decode()
+    messages = []
+    for i in range(count):
+        if i % 2:
+            messages.append(ChatMessage(role="assistant", content=f"Answer {i} " * 40))
+        elif i % 10 == 0:
+            messages.append(ChatMessage.model_validate({
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": f"What is in picture {i}?"},
+                    {"type": "image", "source": {"media_type": "image/png", "data": image}}
+                ]
+            }))
+        else:
+            messages.append(ChatMessage(role="user", content=f"Question {i} " * 20))
+    return messages
+
+
+def timed(label, func, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        size = len(func())
+    print(f"{label:<34} {(time.perf_counter() - start) / runs * 1000:8.2f} ms  {size / 1e6:.1f} MB")
+
+
+def main(count: int = 500, runs: int = 5):
+    messages = conversation(count)
+    timed("eval(model_dump_json) + json.dumps", lambda: json.dumps(
+        [eval(m.model_dump_json()) for m in messages]
+    ), runs)
+    timed("model_dump + json.dumps", lambda: json.dumps(
+        [m.model_dump(mode="json") for m in messages]
+    ), runs)
+    timed("single pass encode", lambda: json_array(
+        [encode_claude_message(m) for m in messages]
+    ), runs)
+    encoder = MessageEncoder()
+    encoder.claude("conversation", messages[:-1])
+    timed("cached, one new message", lambda: json_array(
+        encoder.claude("conversation", messages)
+    ), runs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    main(args.messages, args.runs)
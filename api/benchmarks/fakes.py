@@ -0,0 +1,319 @@
+"""
+Local stand-ins for Bedrock, Redis, DynamoDB and Aurora, and an API
+server running against them.
+
+    python -m benchmarks.fakes [--port 8765] [--tokens-per-second 50]
+    python server.py --app benchmarks.fakes:create_app --factory
+
+Redis is fakeredis unless REDIS_HOST is set, DynamoDB is moto, and Aurora
+is an RDS Data API client backed by SQLite. Bedrock replays recorded
+event streams, from `--recordings` (one <model>.jsonl file of event
+payloads per model) or synthesized, at the given token rate.
+
+Requires the packages in benchmarks/requirements.txt.
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from typing import Dict, List
+
+from botocore.exceptions import ClientError
+
+from config import CLAUDE, DAISII, TITAN
+
+
+BENCHMARK_PASSWORD = "benchmark"
+
+WORDS = ["Xin", " chào", "!", " Here", " is", " the", " answer", ":", "\n", "-"]
+
+
+def recorded_events(model_type: str, tokens: int) -> List[bytes]:
+    """
+    Event payloads shaped like real Bedrock streams of each model family,
+    ending with the invocation metrics Bedrock appends to the last event.
+    """
+    texts = [WORDS[i % len(WORDS)] for i in range(tokens)]
+    metrics = {"inputTokenCount": 120, "outputTokenCount": tokens}
+    if model_type == CLAUDE:
+        payloads = [
+            {"type": "message_start", "message": {"id": "msg", "role": "assistant", "usage": {"input_tokens": 120}}},
+            {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+            *({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": t}} for t in texts),
+            {"type": "content_block_stop", "index": 0},
+            {"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": tokens}},
+            {"type": "message_stop", "amazon-bedrock-invocationMetrics": metrics},
+        ]
+    elif model_type == DAISII:
+        payloads = [
+            {"generation": t, "prompt_token_count": None, "generation_token_count": i, "stop_reason": None}
+            for i, t in enumerate(texts)
+        ]
+        payloads.append({"generation": "", "stop_reason": "stop", "amazon-bedrock-invocationMetrics": metrics})
+    else:
+        payloads = [
+            {"outputText": t, "index": 0, "totalOutputTextTokenCount": i, "completionReason": None}
+            for i, t in enumerate(texts)
+        ]
+        payloads.append({"outputText": "", "completionReason": "FINISH", "amazon-bedrock-invocationMetrics": metrics})
+    return [json.dumps(payload).encode() for payload in payloads]
+
+
+def load_recordings(directory: str) -> Dict[str, List[bytes]]:
+    recordings = {}
+    for model_type in (CLAUDE, DAISII, TITAN):
+        path = os.path.join(directory, f"{model_type.lower()}.jsonl")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                recordings[model_type] = [line.strip() for line in f if line.strip()]
+    return recordings
+
+
+class ReplayedStream:
+    """
+    Blocking iterator of recorded events, paced like a model generating
+    `tokens_per_second`. It is read on the Bedrock stream pool, like the
+    botocore EventStream it stands in for.
+    """
+
+    def __init__(self, events: List[bytes], first_token: float, tokens_per_second: float):
+        self.events = events
+        self.first_token = first_token
+        self.interval = 1 / tokens_per_second if tokens_per_second else 0
+        self.closed = False
+
+
+    def __iter__(self):
+        time.sleep(self.first_token)
+        for event in self.events:
+            if self.closed:
+                return
+            yield {"chunk": {"bytes": event}}
+            time.sleep(self.interval)
+
+
+    def close(self):
+        self.closed = True
+
+
+class FakeBedrockRuntime:
+    """
+    Stands in for the bedrock-runtime client.
+    """
+
+    MODEL_TYPES = {"anthropic": CLAUDE, "meta": DAISII, "titan": TITAN}
+
+    def __init__(
+        self,
+        tokens_per_second: float = 50,
+        first_token: float = 0.2,
+        tokens: int = 60,
+        recordings: Dict[str, List[bytes]] | None = None
+    ):
+        self.tokens_per_second = tokens_per_second
+        self.first_token = first_token
+        self.recordings = {
+            model_type: recorded_events(model_type, tokens)
+            for model_type in (CLAUDE, DAISII, TITAN)
+        }
+        self.recordings.update(recordings or {})
+        self.invocations = 0
+
+
+    def invoke_model_with_response_stream(self, modelId: str, **kwargs) -> Dict:
+        self.invocations += 1
+        model_type = next(
+            model_type for prefix, model_type in self.MODEL_TYPES.items() if prefix in modelId
+        )
+        return {"body": ReplayedStream(
+            self.recordings[model_type], self.first_token, self.tokens_per_second
+        )}
+
+
+class FakeRdsData:
+    """
+    Stands in for the rds-data client, running the statements on SQLite.
+
+    Only the PostgreSQL the app uses is translated: `::text` casts, and
+    ids generated by the table default instead of uuid-ossp.
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                userID TEXT DEFAULT (lower(hex(randomblob(16)))),
+                email TEXT UNIQUE,
+                username TEXT,
+                password TEXT,
+                disabled BOOLEAN DEFAULT FALSE
+            )
+        """)
+        # The Data API pool calls in from several threads
+        self.lock = threading.Lock()
+
+
+    @staticmethod
+    def _sql(sql: str) -> str:
+        return re.sub(r"::\w+", "", sql)
+
+
+    @staticmethod
+    def _parameters(parameters: List[Dict]) -> Dict:
+        return {
+            parameter["name"]: None if "isNull" in parameter["value"]
+            else next(iter(parameter["value"].values()))
+            for parameter in parameters
+        }
+
+
+    @staticmethod
+    def _error(e: sqlite3.Error, operation: str) -> ClientError:
+        return ClientError(
+            {"Error": {"Code": "BadRequestException", "Message": str(e)}},
+            operation
+        )
+
+
+    def execute_statement(self, sql: str, parameters: List[Dict] = (), formatRecordsAs=None, **kwargs) -> Dict:
+        with self.lock:
+            try:
+                cursor = self.db.execute(self._sql(sql), self._parameters(parameters))
+                rows = cursor.fetchall() if cursor.description else []
+                self.db.commit()
+            except sqlite3.Error as e:
+                self.db.rollback()
+                raise self._error(e, "ExecuteStatement")
+        result = {"numberOfRecordsUpdated": max(cursor.rowcount, 0)}
+        if formatRecordsAs == "JSON":
+            columns = [column[0] for column in cursor.description or ()]
+            result["formattedRecords"] = json.dumps([
+                {
+                    column: bool(value) if column == "disabled" else value
+                    for column, value in zip(columns, row)
+                }
+                for row in rows
+            ])
+        return result
+
+
+    def batch_execute_statement(self, sql: str, parameterSets: List[List[Dict]], **kwargs) -> Dict:
+        results = []
+        with self.lock:
+            try:
+                for parameters in parameterSets:
+                    cursor = self.db.execute(self._sql(sql), self._parameters(parameters))
+                    rows = cursor.fetchall() if cursor.description else []
+                    results.append({
+                        "generatedFields": [{"stringValue": value} for value in rows[0]] if rows else []
+                    })
+                self.db.commit()
+            except sqlite3.Error as e:
+                self.db.rollback()
+                raise self._error(e, "BatchExecuteStatement")
+        return {"updateResults": results}
+
+
+    def seed_users(self, count: int, password_hash: str):
+        """
+        Register bench0@example.com... with the same password.
+        """
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO users (email, username, password) VALUES (?, ?, ?)",
+                ((f"bench{i}@example.com", f"bench{i}", password_hash) for i in range(count))
+            )
+            self.db.commit()
+
+
+def install(
+    tokens_per_second: float = 50,
+    first_token: float = 0.2,
+    tokens: int = 60,
+    recordings: str | None = None,
+    users: int = 64
+):
+    """
+    Import the app with every backend replaced by a local stand-in and
+    return the api module. Must run before anything else imports api.
+    """
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    for variable in ("AWS_DEFAULT_REGION", "BEDROCK_REGION", "DYNAMODB_REGION", "AURORA_DATABASE_REGION"):
+        os.environ.setdefault(variable, "us-east-1")
+    os.environ.setdefault("DYNAMODB_TABLE_NAME", "benchmark-chat")
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    os.environ.setdefault("ALGORITHM", "HS256")
+    os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "60")
+    os.environ.setdefault("WRITE_BEHIND_LOG_DIR", tempfile.mkdtemp(prefix="write_behind"))
+    os.environ.setdefault("BLOB_STORE_DIR", tempfile.mkdtemp(prefix="blobs"))
+    for variable in ("BEDROCK_WARM_CONNECTIONS", "DYNAMODB_WARM_CONNECTIONS", "AURORA_DATABASE_WARM_CONNECTIONS"):
+        os.environ[variable] = "0"
+
+    from moto import mock_aws
+    mock_aws().start()
+
+    if not os.environ.get("REDIS_HOST"):
+        import fakeredis
+        import redis.asyncio
+        server = fakeredis.FakeServer()
+        redis.asyncio.Redis = lambda *args, **kwargs: fakeredis.FakeAsyncRedis(server=server)
+
+    import api
+    api.bedrock_service.bedrock_runtime = FakeBedrockRuntime(
+        tokens_per_second,
+        first_token,
+        tokens,
+        load_recordings(recordings) if recordings else None
+    )
+    api.user_database.db = FakeRdsData()
+    api.user_database.db.seed_users(users, api.authentication.pwd_context.hash(BENCHMARK_PASSWORD))
+    api.dynamodb_service.create_table()
+    return api
+
+
+def create_app():
+    """
+    App factory for server.py workers, configured by FAKE_TOKENS_PER_SECOND,
+    FAKE_FIRST_TOKEN_MS, FAKE_TOKENS, FAKE_RECORDINGS and FAKE_USERS.
+
+    Every worker has its own stand-ins, so they only share chat history
+    when REDIS_HOST points to a real Redis.
+    """
+    return install(
+        float(os.environ.get("FAKE_TOKENS_PER_SECOND", 50)),
+        float(os.environ.get("FAKE_FIRST_TOKEN_MS", 200)) / 1000,
+        int(os.environ.get("FAKE_TOKENS", 60)),
+        os.environ.get("FAKE_RECORDINGS") or None,
+        int(os.environ.get("FAKE_USERS", 64))
+    ).app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--first-token-ms", type=float, default=200)
+    parser.add_argument("--tokens", type=int, default=60, help="tokens per synthesized reply")
+    parser.add_argument("--recordings", help="directory of <model>.jsonl event payloads")
+    parser.add_argument("--users", type=int, default=64, help="bench<i>@example.com users to register")
+    args = parser.parse_args()
+
+    import uvicorn
+
+    api = install(
+        args.tokens_per_second,
+        args.first_token_ms / 1000,
+        args.tokens,
+        args.recordings,
+        args.users
+    )
+    print(f"Serving on http://{args.host}:{args.port}", file=sys.stderr)
+    uvicorn.run(api.app, host=args.host, port=args.port, log_level="warning")
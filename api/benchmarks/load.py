@@ -0,0 +1,281 @@
+"""
+Load test of the API against local stand-ins of its backends.
+
+    python -m benchmarks.load [--concurrency 16] [--requests 200] [--model Claude]
+                              [--save results.json] [--baseline results.json]
+
+Starts `benchmarks.fakes` in a subprocess (or targets --url), logs in
+every virtual user with /token, then drives POST /chat/{id} and
+GET /chat/{id}. Each worker keeps one conversation and sends the whole
+history like the web client does, or with --mode turn only the new
+message to POST /chat/{id}/turn. Reports throughput, p50/p99 latency
+and, for streamed replies, p50/p99 time to first byte.
+
+--save writes the results as JSON, --baseline compares against an
+earlier saved run.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from typing import Dict, List
+
+import httpx
+
+from benchmarks.fakes import BENCHMARK_PASSWORD
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+class Phase:
+    """
+    Timings of one kind of request.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = []
+        self.first_bytes = []
+        self.errors = {}
+        self.started = self.finished = 0.0
+
+
+    def error(self, reason: str):
+        self.errors[reason] = self.errors.get(reason, 0) + 1
+
+
+    def summary(self) -> Dict:
+        elapsed = self.finished - self.started
+        summary = {
+            "requests": len(self.latencies),
+            "errors": sum(self.errors.values()),
+            "throughput": len(self.latencies) / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(self.latencies, 50) * 1000,
+            "p99_ms": percentile(self.latencies, 99) * 1000,
+        }
+        if self.first_bytes:
+            summary["ttfb_p50_ms"] = percentile(self.first_bytes, 50) * 1000
+            summary["ttfb_p99_ms"] = percentile(self.first_bytes, 99) * 1000
+        if self.errors:
+            summary["error_reasons"] = self.errors
+        return summary
+
+
+async def run_phase(phase: Phase, concurrency: int, requests: int, request):
+    """
+    Call `request(phase, worker, number)` `requests` times from
+    `concurrency` workers.
+    """
+    numbers = iter(range(requests))
+
+    async def worker(worker_id: int):
+        for number in numbers:
+            try:
+                await request(phase, worker_id, number)
+            except httpx.HTTPError as e:
+                phase.error(type(e).__name__)
+
+    phase.started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    phase.finished = time.perf_counter()
+
+
+async def benchmark(url: str, args) -> Dict[str, Dict]:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=args.timeout) as client:
+        models = itertools.cycle(args.model.split(","))
+        tokens = [None] * args.users
+        histories = [[] for _ in range(args.concurrency)]
+        last_seqs = [None] * args.concurrency
+
+        async def login(phase, worker_id, number):
+            start = time.perf_counter()
+            response = await client.post("/token", data={
+                "username": f"bench{number}@example.com",
+                "password": BENCHMARK_PASSWORD,
+            })
+            if response.status_code != 200:
+                phase.error(str(response.status_code))
+                return
+            phase.latencies.append(time.perf_counter() - start)
+            tokens[number] = response.json()["access_token"]
+
+        def headers(worker_id):
+            return {"Authorization": f"Bearer {tokens[worker_id % args.users]}"}
+
+        async def chat(phase, worker_id, number):
+            history = histories[worker_id]
+            message = {"role": "user", "content": f"Question {number}, what is the answer?"}
+            messages = history + [message]
+            if args.mode == "turn":
+                path = f"/chat/bench-{worker_id}/turn"
+                body = {"message": message, "last_seq": last_seqs[worker_id]}
+            else:
+                path, body = f"/chat/bench-{worker_id}", messages
+            start = time.perf_counter()
+            first_byte = None
+            parts = []
+            async with client.stream(
+                "POST",
+                path,
+                params={"model": next(models)},
+                json=body,
+                headers=headers(worker_id)
+            ) as response:
+                async for chunk in response.aiter_bytes():
+                    if first_byte is None:
+                        first_byte = time.perf_counter()
+                    parts.append(chunk)
+            if response.status_code != 200:
+                phase.error(str(response.status_code))
+                return
+            phase.latencies.append(time.perf_counter() - start)
+            phase.first_bytes.append((first_byte or time.perf_counter()) - start)
+            history[:] = messages + [{"role": "assistant", "content": b"".join(parts).decode()}]
+            last_seqs[worker_id] = len(history) - 1
+
+        async def history(phase, worker_id, number):
+            start = time.perf_counter()
+            response = await client.get(f"/chat/bench-{worker_id}", headers=headers(worker_id))
+            if response.status_code != 200:
+                phase.error(str(response.status_code))
+                return
+            phase.latencies.append(time.perf_counter() - start)
+
+        phases = {}
+        for name, concurrency, requests, request in (
+            ("token", min(args.concurrency, args.users), args.users, login),
+            ("chat", args.concurrency, args.requests, chat),
+            ("history", args.concurrency, args.requests, history),
+        ):
+            phase = Phase(name)
+            await run_phase(phase, concurrency, requests, request)
+            phases[name] = phase.summary()
+        return phases
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args) -> tuple:
+    port = free_port()
+    command = [
+        sys.executable, "-m", "benchmarks.fakes",
+        "--port", str(port),
+        "--tokens-per-second", str(args.tokens_per_second),
+        "--first-token-ms", str(args.first_token_ms),
+        "--tokens", str(args.tokens),
+        "--users", str(args.users),
+    ]
+    if args.recordings:
+        command += ["--recordings", args.recordings]
+    server = subprocess.Popen(
+        command,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with {server.returncode}")
+        try:
+            if httpx.get(f"{url}/ready", timeout=1).status_code == 200:
+                return server, url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("Server did not become ready")
+
+
+def stop_server(server: subprocess.Popen):
+    # SIGINT runs the lifespan shutdown, which drains the write-behind queue
+    server.send_signal(signal.SIGINT)
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+def report(results: Dict[str, Dict], baseline: Dict[str, Dict] | None = None):
+    columns = ("throughput", "p50_ms", "p99_ms", "ttfb_p50_ms", "ttfb_p99_ms")
+    print(f"{'phase':<8} {'requests':>8} {'errors':>6}" + "".join(f" {c:>12}" for c in columns))
+    for name, summary in results.items():
+        row = f"{name:<8} {summary['requests']:>8} {summary['errors']:>6}"
+        for column in columns:
+            value = summary.get(column)
+            row += f" {value:>12.1f}" if value is not None else f" {'':>12}"
+        print(row)
+        if baseline and name in baseline:
+            row = f"{'  vs':<8} {'':>8} {'':>6}"
+            for column in columns:
+                value, before = summary.get(column), baseline[name].get(column)
+                if value is None or not before:
+                    row += f" {'':>12}"
+                else:
+                    row += f" {(value - before) / before * 100:>+11.1f}%"
+            print(row)
+        for reason, count in summary.get("error_reasons", {}).items():
+            print(f"  {count} x {reason}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", help="benchmark a running server instead of starting one")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200, help="chat and history requests each")
+    parser.add_argument("--users", type=int, default=16, help="users logging in, reused by the workers")
+    parser.add_argument("--model", default="Claude", help="model, or comma separated models to rotate")
+    parser.add_argument("--mode", choices=("full", "turn"), default="full", help="send the whole history or only the new message")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--first-token-ms", type=float, default=200)
+    parser.add_argument("--tokens", type=int, default=60)
+    parser.add_argument("--recordings", help="directory of <model>.jsonl event payloads")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with results saved by --save")
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        server, url = start_server(args)
+    try:
+        results = asyncio.run(benchmark(url, args))
+    finally:
+        if server is not None:
+            stop_server(server)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    report(results, baseline)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "config": {
+                    key: value for key, value in vars(args).items()
+                    if key not in ("save", "baseline")
+                },
+                "results": results,
+            }, f, indent=2)
@@ -0,0 +1,49 @@
+"""
+Logins against a chat stream on the same event loop.
+
+    python -m benchmarks.login [--logins 50]
+
+Verifies the same bcrypt password `--logins` times at once through
+`Authentication`, while a task standing in for a chat stream expects to
+run every 10 ms. Reports the login throughput and how late the stream
+ticks were.
+"""
+import argparse
+import asyncio
+import time
+
+from models.authentication import Authentication
+
+
+async def login_storm(logins: int = 50):
+    authen = Authentication(max_pending=logins)
+    hashed = authen.pwd_context.hash("benchmark")
+    lags = []
+
+    async def stream():
+        # Stands in for a chat stream that expects to run every 10 ms
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - start - 0.01)
+
+    ticker = asyncio.create_task(stream())
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        authen.verify_password("benchmark", hashed) for _ in range(logins)
+    ))
+    elapsed = time.perf_counter() - start
+    ticker.cancel()
+
+    lags.sort()
+    print(f"{logins} logins in {elapsed:.2f}s ({logins / elapsed:.1f}/s)")
+    print(f"stream tick lag p50={lags[len(lags) // 2] * 1000:.2f}ms "
+          f"max={lags[-1] * 1000:.2f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--logins", type=int, default=50)
+    args = parser.parse_args()
+
+    asyncio.run(login_storm(args.logins))
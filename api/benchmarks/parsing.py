@@ -0,0 +1,81 @@
+"""
+Validating stored chat messages.
+
+    python -m benchmarks.parsing [--messages 1000] [--runs 20]
+
+Compares the previous untagged content union with the tagged one, per
+message and in one `parse_messages` call, and with splicing the stored
+documents as they are.
+"""
+import argparse
+import json
+import time
+
+from typing import List
+
+from pydantic import BaseModel
+
+from models.chat import (
+    ChatMessage,
+    ImageContent,
+    TextContent,
+    ToolResultContent,
+    ToolUseContent,
+    json_array,
+    parse_messages,
+)
+
+
+class UntaggedChatMessage(BaseModel):
+    # The previous shape: pydantic tries every member for each block
+    role: str
+    content: List[TextContent | ImageContent | ToolUseContent | ToolResultContent] | str
+
+
+def documents(count: int) -> List[bytes]:
+    documents = []
+    for i in range(count):
+        if i % 4 == 0:
+            message = {"role": "user", "content": "Hello there " * 20}
+        elif i % 4 == 1:
+            message = {"role": "assistant", "content": [{"type": "text", "text": "Sure. " * 30}]}
+        elif i % 4 == 2:
+            message = {"role": "assistant", "content": [
+                {"type": "tool_use", "tool_use_id": "t1", "tool_name": "search", "input": {"q": "daisii"}},
+                {"type": "tool_result", "tool_use_id": "t1", "is_error": False,
+                 "content": [{"type": "text", "text": "result"}]}
+            ]}
+        else:
+            message = {"role": "user", "content": [
+                {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": "iVBOR" * 200}},
+                {"type": "text", "text": "What is this?"}
+            ]}
+        documents.append(json.dumps(message).encode())
+    return documents
+
+
+def timed(label, func, count, runs):
+    func()
+    start = time.perf_counter()
+    for _ in range(runs):
+        func()
+    print(f"{label:<36} {(time.perf_counter() - start) / runs * 1000:7.2f} ms / {count} messages")
+
+
+def main(count: int = 1000, runs: int = 20):
+    stored = documents(count)
+    timed("untagged union, per message",
+          lambda: [UntaggedChatMessage.model_validate_json(d) for d in stored], count, runs)
+    timed("tagged union, per message",
+          lambda: [ChatMessage.model_validate_json(d) for d in stored], count, runs)
+    timed("tagged union, one TypeAdapter call", lambda: parse_messages(stored), count, runs)
+    timed("trusted passthrough", lambda: json_array(stored), count, runs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    main(args.messages, args.runs)
@@ -0,0 +1,125 @@
+"""
+Throughput of server.py by number of workers, against local stand-ins of
+the backends.
+
+    python -m benchmarks.scaling [--workers 1,2,4] [--concurrency 64]
+                                 [--requests 400] [--save scaling.json]
+
+For each worker count, starts server.py with `benchmarks.fakes:create_app`
+and runs the phases of `benchmarks.load` against it. Bedrock answers
+instantly by default, so the numbers measure the API itself rather than
+the model. Each worker has its own fakeredis and moto unless REDIS_HOST
+is set, so turns send the full history. Speedups are bounded by the
+cores of the machine, workers beyond it only add contention.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.load import benchmark, free_port, stop_server
+
+
+def start_workers(workers: int, args) -> tuple:
+    port = free_port()
+    api_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment = dict(
+        os.environ,
+        FAKE_TOKENS_PER_SECOND=str(args.tokens_per_second),
+        FAKE_FIRST_TOKEN_MS=str(args.first_token_ms),
+        FAKE_TOKENS=str(args.tokens),
+        FAKE_USERS=str(args.users),
+        WRITE_BEHIND_LOG_DIR=tempfile.mkdtemp(prefix="write_behind"),
+    )
+    # Every user logs in at once, logins queue for bcrypt instead of failing
+    environment.setdefault("BCRYPT_MAX_PENDING", str(args.users))
+    server = subprocess.Popen(
+        [
+            sys.executable, "server.py",
+            "--app", "benchmarks.fakes:create_app", "--factory",
+            "--workers", str(workers),
+            "--host", "127.0.0.1",
+            "--port", str(port),
+            "--log-level", "warning",
+        ],
+        cwd=api_directory,
+        env=environment
+    )
+    url = f"http://127.0.0.1:{port}"
+    # Probes reach whichever worker accepts first, so several in a row must pass
+    deadline = time.monotonic() + 60 + 10 * workers
+    ready = 0
+    while time.monotonic() < deadline and ready < workers * 4:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with {server.returncode}")
+        try:
+            if httpx.get(f"{url}/ready", timeout=1).status_code == 200:
+                ready += 1
+                continue
+        except httpx.HTTPError:
+            pass
+        ready = 0
+        time.sleep(0.2)
+    if ready < workers * 4:
+        server.kill()
+        raise RuntimeError("Server did not become ready")
+    return server, url
+
+
+def report(results: dict):
+    phases = list(next(iter(results.values())))
+    print(f"{'workers':>7}" + "".join(f" {phase + ' req/s':>14} {'p99 ms':>8}" for phase in phases))
+    single = results[min(results)]
+    for workers, phases_of in results.items():
+        row = f"{workers:>7}"
+        for phase in phases:
+            summary = phases_of[phase]
+            speedup = summary["throughput"] / single[phase]["throughput"] if single[phase]["throughput"] else 0
+            row += f" {summary['throughput']:>7.1f} x{speedup:<4.2f} {summary['p99_ms']:>8.1f}"
+        print(row)
+        for phase in phases:
+            if phases_of[phase]["errors"]:
+                print(f"  {phase}: {phases_of[phase]['errors']} errors {phases_of[phase].get('error_reasons')}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", default="1,2,4", help="comma separated worker counts")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=400, help="chat and history requests each")
+    parser.add_argument("--users", type=int, default=64, help="users logging in, reused by the workers")
+    parser.add_argument("--model", default="Claude", help="model, or comma separated models to rotate")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--tokens-per-second", type=float, default=0, help="0 streams replies instantly")
+    parser.add_argument("--first-token-ms", type=float, default=0)
+    parser.add_argument("--tokens", type=int, default=60)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    args = parser.parse_args()
+    # Full history turns, the stand-ins of one worker do not see the others' turns
+    args.mode = "full"
+
+    results = {}
+    for workers in (int(count) for count in args.workers.split(",")):
+        server, url = start_workers(workers, args)
+        try:
+            results[workers] = asyncio.run(benchmark(url, args))
+        finally:
+            stop_server(server)
+    report(results)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "cpus": os.cpu_count(),
+                "config": {key: value for key, value in vars(args).items() if key != "save"},
+                "results": results,
+            }, f, indent=2)
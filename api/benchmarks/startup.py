@@ -0,0 +1,70 @@
+"""
+Import and startup time of the API.
+
+    python -m benchmarks.startup [--runs 5] [--warm]
+
+Each run is a fresh interpreter. "import" is the time to import api.py,
+"startup" the time until the app accepts requests, and "ready" until
+/ready is healthy. Without --warm no connections are opened, so the
+numbers do not depend on the network.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+
+MEASURE = """
+import asyncio, time
+started = time.perf_counter()
+import api
+imported = time.perf_counter()
+
+async def main():
+    async with api.app.router.lifespan_context(api.app):
+        serving = time.perf_counter()
+        while not api.app.state.ready:
+            await asyncio.sleep(0.001)
+        ready = time.perf_counter()
+    print(imported - started, serving - imported, ready - imported)
+
+asyncio.run(main())
+"""
+
+
+def measure(warm: bool) -> tuple:
+    env = dict(os.environ)
+    env.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    env["WRITE_BEHIND_LOG_DIR"] = tempfile.mkdtemp(prefix="write_behind")
+    if not warm:
+        for variable in (
+            "BEDROCK_WARM_CONNECTIONS",
+            "DYNAMODB_WARM_CONNECTIONS",
+            "AURORA_DATABASE_WARM_CONNECTIONS"
+        ):
+            env[variable] = "0"
+    output = subprocess.run(
+        [sys.executable, "-c", MEASURE],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True
+    ).stdout
+    return tuple(float(value) for value in output.split()[-3:])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--warm", action="store_true", help="open AWS connections at startup")
+    args = parser.parse_args()
+
+    runs = [measure(args.warm) for _ in range(args.runs)]
+    for label, values in zip(("import", "startup", "ready"), zip(*runs)):
+        print(
+            f"{label:<8} median {statistics.median(values) * 1000:8.1f} ms"
+            f"  max {max(values) * 1000:8.1f} ms"
+        )
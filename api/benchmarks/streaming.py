@@ -0,0 +1,89 @@
+"""
+Reading a Bedrock stream into HTTP chunks.
+
+    python -m benchmarks.streaming [--tokens 2000] [--runs 20]
+
+Compares the previous pipeline, `json.loads` per event and one chunk per
+text delta, with `utils.process_stream` on streams of each model family
+whose events are all buffered already, as under load.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.fakes import recorded_events
+from config import CLAUDE, DAISII, TITAN
+from utils import process_stream
+
+
+class ListStream:
+    """
+    A stream whose events are all already buffered.
+    """
+
+    def __init__(self, events):
+        self.events = events
+        self.position = 0
+
+
+    def __aiter__(self):
+        return self
+
+
+    async def __anext__(self):
+        if self.position == len(self.events):
+            raise StopAsyncIteration
+        self.position += 1
+        return self.events[self.position - 1]
+
+
+    def ready(self):
+        return self.position < len(self.events)
+
+
+    def close(self):
+        pass
+
+
+async def baseline(events, model_type):
+    chunks, full_response = 0, ""
+    for event in events:
+        chunk = json.loads(event["chunk"]["bytes"])
+        if model_type == CLAUDE:
+            if chunk["type"] != "content_block_delta":
+                continue
+            text = chunk["delta"]["text"]
+        else:
+            text = chunk["generation" if model_type == DAISII else "outputText"]
+        chunks += 1
+        full_response += text
+    return chunks
+
+
+async def pipeline(events, model_type):
+    parts = []
+    async for text in process_stream(ListStream(events), model_type, max_chars=64):
+        parts.append(text)
+    "".join(parts)
+    return len(parts)
+
+
+async def main(tokens: int = 2000, runs: int = 20):
+    for model_type in (CLAUDE, DAISII, TITAN):
+        events = [{"chunk": {"bytes": event}} for event in recorded_events(model_type, tokens)]
+        for label, run in (("baseline", baseline), ("pipeline", pipeline)):
+            start = time.perf_counter()
+            for _ in range(runs):
+                chunks = await run(events, model_type)
+            elapsed = (time.perf_counter() - start) / runs
+            print(f"{model_type:<7} {label:<9} {elapsed * 1000:7.2f} ms/stream  {chunks:5d} HTTP chunks")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tokens", type=int, default=2000)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.tokens, args.runs))
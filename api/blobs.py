@@ -0,0 +1,348 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+import io
+import os
+import tempfile
+
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Tuple
+
+from botocore.exceptions import ClientError
+
+from cache import LocalCache
+from models.chat import ChatMessage, ContentType, ImageRef, MediaType
+
+
+class LocalObjectStore:
+    """
+    Objects in a local directory, one file per key under a directory per
+    bucket.
+
+    It implements the part of the S3 client API that `BlobStore` uses,
+    with the same arguments and errors, so an S3 client (or any S3
+    compatible store) can replace it.
+    """
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+
+
+    def _path(self, bucket: str, key: str) -> str:
+        path = os.path.abspath(os.path.join(self.root, bucket, key))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Invalid key {key}")
+        return path
+
+
+    @staticmethod
+    def _not_found(code: str, operation: str) -> ClientError:
+        return ClientError({"Error": {"Code": code, "Message": "Not Found"}}, operation)
+
+
+    def head_object(self, Bucket: str, Key: str, **kwargs) -> Dict:
+        try:
+            size = os.path.getsize(self._path(Bucket, Key))
+        except FileNotFoundError:
+            raise self._not_found("404", "HeadObject")
+        return {"ContentLength": size}
+
+
+    def get_object(self, Bucket: str, Key: str, **kwargs) -> Dict:
+        try:
+            with open(self._path(Bucket, Key), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            raise self._not_found("NoSuchKey", "GetObject")
+        return {"Body": io.BytesIO(data), "ContentLength": len(data)}
+
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes, **kwargs) -> Dict:
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written aside and renamed, so readers never see half an object
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(Body)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        return {}
+
+
+def sniff_media_type(data: bytes) -> str | None:
+    """
+    The media type of an image in one of the formats `MediaType` allows.
+    """
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return MediaType.PNG.value
+    if data.startswith(b"\xff\xd8\xff"):
+        return MediaType.JPEG.value
+    if data.startswith(b"GIF8"):
+        return MediaType.GIF.value
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return MediaType.WEBP.value
+    return None
+
+
+def image_refs(messages: Iterable[ChatMessage]) -> List[str]:
+    """
+    The blob references of the images in `messages`.
+    """
+    refs = []
+
+    def walk(content):
+        if isinstance(content, str):
+            return
+        for block in content:
+            if block.type == ContentType.IMAGE and isinstance(block.source, ImageRef):
+                refs.append(block.source.ref)
+            elif block.type == ContentType.TOOLRESULT:
+                walk(block.content)
+
+    for message in messages:
+        walk(message.content)
+    return refs
+
+
+class BlobStore:
+    """
+    Image payloads stored once by content hash, so messages only carry a
+    reference.
+
+    The same image sent again, in a later turn or by another user, maps to
+    the same object and is not written twice. Each user that stores an image
+    also gets an ownership marker under `owner_prefix`, and a user can only
+    reference images they stored: a content hash alone does not grant
+    access to another user's image. Base64 payloads are kept in an
+    in-memory LRU of `max_cached_bytes`, filled when an image is stored and
+    when `load` fetches the images of a request body about to be built.
+    """
+
+    def __init__(
+        self,
+        backend,
+        bucket: str,
+        prefix: str = "images/",
+        owner_prefix: str = "owners/",
+        max_cached_bytes: int = 64 * 1024 * 1024,
+        max_known: int = 100000
+    ):
+        self.backend = backend
+        self.bucket = bucket
+        self.prefix = prefix
+        self.owner_prefix = owner_prefix
+        self.max_cached_bytes = max_cached_bytes
+        self._cached = OrderedDict()
+        self.cached_bytes = 0
+        # References known to be stored, and (user, reference) pairs known
+        # to be owned, they skip the existence checks
+        self.known = LocalCache(max_known, ttl=24 * 3600)
+        self.owned = LocalCache(max_known, ttl=24 * 3600)
+        self.stored = 0
+        self.deduplicated = 0
+        self.fetched = 0
+
+
+    @staticmethod
+    def ref(data: bytes) -> str:
+        return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+    @staticmethod
+    def _digest(ref: str) -> str:
+        algorithm, _, digest = ref.partition(":")
+        if algorithm != "sha256" or len(digest) != 64 or not all(c in "0123456789abcdef" for c in digest):
+            raise ValueError(f"Invalid image reference {ref}")
+        return digest
+
+
+    def _key(self, ref: str) -> str:
+        return self.prefix + self._digest(ref)
+
+
+    def _owner_key(self, user_id: str, ref: str) -> str:
+        return f"{self.owner_prefix}{user_id}/{self._digest(ref)}"
+
+
+    def _cache(self, ref: str, data: str):
+        if len(data) > self.max_cached_bytes:
+            return
+        if ref in self._cached:
+            self._cached.move_to_end(ref)
+            return
+        self._cached[ref] = data
+        self.cached_bytes += len(data)
+        while self.cached_bytes > self.max_cached_bytes:
+            _, evicted = self._cached.popitem(last=False)
+            self.cached_bytes -= len(evicted)
+
+
+    def get(self, ref: str) -> str | None:
+        """
+        The base64 payload of `ref` if it is in memory.
+        """
+        data = self._cached.get(ref)
+        if data is not None:
+            self._cached.move_to_end(ref)
+        return data
+
+
+    def _exists(self, key: str) -> bool:
+        try:
+            self.backend.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        return True
+
+
+    def _put(self, ref: str, data: bytes, media_type: str) -> bool:
+        if self._exists(self._key(ref)):
+            return False
+        self.backend.put_object(
+            Bucket=self.bucket,
+            Key=self._key(ref),
+            Body=data,
+            ContentType=media_type
+        )
+        return True
+
+
+    def _read(self, ref: str) -> Tuple[bytes, str | None]:
+        response = self.backend.get_object(Bucket=self.bucket, Key=self._key(ref))
+        return response["Body"].read(), response.get("ContentType")
+
+
+    def _fetch(self, ref: str) -> str:
+        return base64.b64encode(self._read(ref)[0]).decode()
+
+
+    def _own(self, user_id: str, ref: str):
+        self.backend.put_object(Bucket=self.bucket, Key=self._owner_key(user_id, ref), Body=b"")
+
+
+    async def put(self, user_id: str, data: str, media_type: str) -> str:
+        """
+        Store a base64 image of `user_id` and return its reference.
+        """
+        try:
+            raw = base64.b64decode(data, validate=True)
+        except binascii.Error:
+            raise ValueError("Image data is not valid base64")
+        ref = self.ref(raw)
+        if self.known.get(ref):
+            self.deduplicated += 1
+        else:
+            if await asyncio.to_thread(self._put, ref, raw, media_type):
+                self.stored += 1
+            else:
+                self.deduplicated += 1
+            self.known.set(ref, True)
+        if not self.owned.get((user_id, ref)):
+            # Written after the image, a marker always points to a stored one
+            await asyncio.to_thread(self._own, user_id, ref)
+            self.owned.set((user_id, ref), True)
+        # The request that sent it is about to build a body with it
+        self._cache(ref, data)
+        return ref
+
+
+    async def check(self, user_id: str, ref: str):
+        """
+        Raise ValueError unless `ref` is an image `user_id` stored.
+        """
+        key = self._owner_key(user_id, ref)
+        if self.owned.get((user_id, ref)):
+            return
+        if not await asyncio.to_thread(self._exists, key):
+            raise ValueError(f"Unknown image reference {ref}")
+        self.owned.set((user_id, ref), True)
+
+
+    async def open(self, user_id: str, ref: str) -> Tuple[bytes, str]:
+        """
+        The bytes and media type of the image `ref`, which history returns
+        in place of the payload.
+
+        Raise ValueError unless `user_id` stored it.
+        """
+        await self.check(user_id, ref)
+        data = self.get(ref)
+        if data is not None:
+            raw, media_type = base64.b64decode(data), None
+        else:
+            try:
+                raw, media_type = await asyncio.to_thread(self._read, ref)
+            except ClientError as e:
+                if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                    raise ValueError(f"Unknown image reference {ref}")
+                raise
+            self.fetched += 1
+        return raw, media_type or sniff_media_type(raw) or "application/octet-stream"
+
+
+    async def load(self, refs: Iterable[str]) -> Dict[str, str]:
+        """
+        Return the payloads of `refs`, fetching the ones not in memory.
+
+        The caller builds its request body from the returned payloads, so
+        other requests filling the LRU meanwhile cannot evict them.
+        """
+        payloads = {}
+        missing = []
+        for ref in dict.fromkeys(refs):
+            data = self.get(ref)
+            if data is None:
+                missing.append(ref)
+            else:
+                payloads[ref] = data
+        if not missing:
+            return payloads
+        fetched = await asyncio.gather(*(
+            asyncio.to_thread(self._fetch, ref) for ref in missing
+        ))
+        self.fetched += len(missing)
+        for ref, data in zip(missing, fetched):
+            self._cache(ref, data)
+            payloads[ref] = data
+        return payloads
+
+
+    async def externalize(self, user_id: str, messages: List[ChatMessage]):
+        """
+        Replace the inline images of `messages` by references, in place.
+
+        References sent by the client must point to images `user_id` stored.
+        """
+        async def walk(content):
+            if isinstance(content, str):
+                return
+            for block in content:
+                if block.type == ContentType.IMAGE:
+                    if isinstance(block.source, ImageRef):
+                        await self.check(user_id, block.source.ref)
+                    else:
+                        block.source = ImageRef(
+                            media_type=block.source.media_type,
+                            ref=await self.put(user_id, block.source.data, block.source.media_type.value)
+                        )
+                elif block.type == ContentType.TOOLRESULT:
+                    await walk(block.content)
+
+        for message in messages:
+            await walk(message.content)
+
+
+    def stats(self) -> Dict:
+        return {
+            "cached": len(self._cached),
+            "cached_bytes": self.cached_bytes,
+            "stored": self.stored,
+            "deduplicated": self.deduplicated,
+            "fetched": self.fetched,
+        }
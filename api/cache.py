@@ -0,0 +1,581 @@
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import random
+import time
+
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List
+
+from redis.exceptions import ConnectionError, RedisError, TimeoutError
+
+from metrics import REDIS
+
+
+def jittered(ttl: float, jitter: float = 0.1) -> int:
+    """
+    Spread a TTL by up to `jitter` of its length, so entries written
+    together do not all expire together.
+    """
+    return max(1, int(ttl * (1 - random.uniform(0, jitter))))
+
+
+class LocalCache:
+    """
+    Bounded in-process LRU cache with a per-entry time to live.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+    def delete(self, key: Hashable):
+        self._entries.pop(key, None)
+
+
+    def clear(self):
+        self._entries.clear()
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ConversationMemo:
+    """
+    Values derived from each message of a conversation, per conversation.
+
+    Conversations usually only grow, so a request derives values for the
+    messages added since the previous one and reuses the rest. Values are
+    kept next to the message they were derived from: from the first
+    message that differs from the incoming one (an edited or retried
+    turn, or another client's copy of the history) they are dropped and
+    derived again.
+
+    Only the newest known message is compared while it is unchanged, the
+    ones before it are then taken to be unchanged too. A request does not
+    pay for a comparison of the whole history that way.
+    """
+
+    def __init__(self, max_conversations: int = 10000, ttl: float = 3600):
+        self.entries = LocalCache(max_conversations, ttl)
+
+
+    def values(self, key: Hashable, messages: List) -> List:
+        """
+        The values of `messages`, None where not derived yet. Fill them in
+        the returned list, it is the one kept for the next request.
+        """
+        known, values = self.entries.get(key) or ([], [])
+        last = len(known) - 1
+        if 0 <= last < len(messages) and self._same(known[last], messages[last]):
+            same = len(known)
+        else:
+            same = 0
+            for cached, message in zip(known, messages):
+                if not self._same(cached, message):
+                    break
+                same += 1
+        del known[same:]
+        known.extend(messages[same:])
+        del values[same:]
+        values.extend([None] * (len(messages) - same))
+        self.entries.set(key, (known, values))
+        return values
+
+
+    @staticmethod
+    def _same(cached, message) -> bool:
+        # Messages read from the server side cache are the same objects
+        return cached is message or cached == message
+
+
+class ResponseCache:
+    """
+    Generated texts of deterministic (temperature 0) model requests.
+
+    Entries are keyed by a hash of the request body, which BedrockService
+    always builds with the same field order. They are evicted least
+    recently used once their total size passes `max_bytes`, or when their
+    `ttl` runs out.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl: float = 300.0,
+        disabled_models: Iterable[str] = ()
+    ):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disabled_models = set(disabled_models)
+        self._entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+
+    def enabled(self, model: str, temperature: float) -> bool:
+        return model not in self.disabled_models and temperature == 0
+
+
+    @staticmethod
+    def key(model_id: str, body: bytes, volatile: Iterable[str] = ()) -> str:
+        """
+        Hash the request body, ignoring `volatile` substrings such as the current time.
+        """
+        for value in volatile:
+            body = body.replace(value.encode(), b"")
+        return hashlib.sha256(model_id.encode() + b"\n" + body).hexdigest()
+
+
+    def get(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] <= time.monotonic():
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+
+    def put(self, key: str, text: str):
+        size = len(text.encode())
+        if size > self.max_bytes:
+            return
+        self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, text, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+
+    def stats(self) -> Dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class UserCache:
+    """
+    Worker-local cache of `UserInDB` objects in front of Redis.
+
+    Unknown users are cached as `False` for a shorter time so repeated
+    lookups of a missing account do not reach RDS on every request.
+    Invalidations are broadcast over Redis pub/sub so every worker drops
+    its copy when a user is registered or changed.
+    """
+
+    def __init__(
+        self,
+        redis_client,
+        max_size: int = 10000,
+        ttl: float = 60.0,
+        negative_ttl: float = 10.0,
+        channel: str = "user:invalidate"
+    ):
+        self.redis = redis_client
+        self.local = LocalCache(max_size, ttl)
+        self.negative_ttl = negative_ttl
+        self.channel = channel
+
+
+    def get(self, email: str):
+        """
+        Return the cached user, `False` for a known-missing user, or None.
+        """
+        return self.local.get(email)
+
+
+    def set(self, email: str, user):
+        if user:
+            self.local.set(email, user)
+        else:
+            self.local.set(email, False, self.negative_ttl)
+
+
+    async def invalidate(self, email: str):
+        """
+        Drop the user from every cache layer on every worker.
+        """
+        self.local.delete(email)
+        try:
+            await self.redis.delete(f"user:{email}")
+            await self.redis.publish(self.channel, email)
+        except RedisError as e:
+            # Other workers drop their copy when its short local TTL runs out
+            logging.error(f"Error while invalidating user {email}: {str(e)}")
+
+
+    async def prime(self, users, ttl: int = 3600):
+        """
+        Put freshly created users in the shared Redis cache and drop any
+        "no such user" other workers still remember for them.
+        """
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user in users:
+                pipe.setex(f"user:{user.email}", jittered(ttl), user.model_dump_json())
+                pipe.publish(self.channel, user.email)
+            await pipe.execute()
+
+
+    async def listen(self, backoff: float = 1.0, max_backoff: float = 30.0):
+        """
+        Apply invalidations published by other workers until cancelled.
+
+        While Redis is unreachable the local copies keep serving requests.
+        They are dropped once the subscription is back, as invalidations
+        published meanwhile were lost. Subscribing goes through the
+        circuit breaker of a `GuardedRedis`, and is retried with
+        exponential backoff.
+        """
+        breaker = getattr(self.redis, "breaker", None)
+        delay = backoff
+        while True:
+            try:
+                async with self.redis.pubsub() as pubsub:
+                    if breaker is not None:
+                        await breaker.call(pubsub.subscribe, self.channel)
+                    else:
+                        await pubsub.subscribe(self.channel)
+                    self.local.clear()
+                    delay = backoff
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            self.local.delete(message["data"].decode())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Error in user cache invalidation listener: {str(e)}")
+                await asyncio.sleep(delay * random.uniform(0.5, 1))
+                delay = min(delay * 2, max_backoff)
+
+
+class SingleFlight:
+    """
+    Lets concurrent loads of the same cache entry share one call.
+
+    Within a worker, later callers await the load already in flight. With
+    `redis_client` set, a short Redis lock extends this across workers:
+    whoever does not get the lock polls the cache until the holder has
+    filled it, and only loads itself once `lock_wait` runs out.
+
+    Load times are tracked to refresh hot entries early (XFetch): a read
+    refreshes with a probability that rises as the entry nears expiry,
+    scaled by how long a load takes, so the one refresh usually happens
+    before the entry is gone.
+    """
+
+    def __init__(
+        self,
+        redis_client=None,
+        lock_ttl: float = 5.0,
+        lock_wait: float = 2.0,
+        poll_interval: float = 0.05,
+        beta: float = 1.0
+    ):
+        self.redis = redis_client
+        self.lock_ttl = lock_ttl
+        self.lock_wait = lock_wait
+        self.poll_interval = poll_interval
+        self.beta = beta
+        self.load_time = 0.05
+        self.loads = 0
+        self.coalesced = 0
+        self._inflight = {}
+
+
+    async def do(
+        self,
+        key: str,
+        load: Callable[[], Awaitable[Any]],
+        cached: Callable[[], Awaitable[Any]] | None = None
+    ) -> Any:
+        """
+        Return `load()`, sharing the call with concurrent loads of `key`.
+
+        `cached` reads the entry back from the shared cache, it is what
+        workers waiting on another worker's lock poll.
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key, load, cached))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # A caller that goes away does not cancel the load for the others
+        return await asyncio.shield(task)
+
+
+    def refresh(self, key: str, load: Callable[[], Awaitable[Any]]):
+        """
+        Reload `key` in the background unless a load is already running.
+        """
+        if key not in self._inflight:
+            task = asyncio.ensure_future(self._load(key, load, None))
+            self._inflight[key] = task
+            task.add_done_callback(self._refreshed(key))
+
+
+    def _refreshed(self, key):
+        def done(task):
+            self._inflight.pop(key, None)
+            if not task.cancelled() and task.exception() is not None:
+                logging.error(f"Error while refreshing {key}: {str(task.exception())}")
+        return done
+
+
+    def should_refresh(self, ttl_remaining: float) -> bool:
+        """
+        XFetch: whether a read with `ttl_remaining` seconds left should refresh.
+        """
+        if ttl_remaining <= 0:
+            return False
+        return -self.load_time * self.beta * math.log(1.0 - random.random()) >= ttl_remaining
+
+
+    async def _load(self, key, load, cached):
+        lock_key, token = f"lock:{key}", None
+        if self.redis is not None and cached is not None:
+            token = os.urandom(8).hex()
+            try:
+                locked = await self.redis.set(
+                    lock_key, token, nx=True, px=int(self.lock_ttl * 1000)
+                )
+            except CircuitOpenError:
+                locked, token = True, None
+            except Exception as e:
+                logging.error(f"Error while taking cache lock {lock_key}: {str(e)}")
+                locked, token = True, None
+            if not locked:
+                token = None
+                deadline = time.monotonic() + self.lock_wait
+                while time.monotonic() < deadline:
+                    await asyncio.sleep(self.poll_interval)
+                    try:
+                        value = await cached()
+                    except RedisError:
+                        break
+                    if value is not None:
+                        return value
+
+        started = time.monotonic()
+        try:
+            return await load()
+        finally:
+            self.loads += 1
+            self.load_time = 0.8 * self.load_time + 0.2 * (time.monotonic() - started)
+            if token is not None:
+                try:
+                    if await self.redis.get(lock_key) == token.encode():
+                        await self.redis.delete(lock_key)
+                except Exception as e:
+                    logging.error(f"Error while releasing cache lock {lock_key}: {str(e)}")
+
+
+    def stats(self) -> Dict:
+        return {
+            "loads": self.loads,
+            "coalesced": self.coalesced,
+            "load_time": self.load_time,
+        }
+
+
+class CircuitOpenError(ConnectionError):
+    """
+    Redis is not called while the circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops calling Redis after `failure_threshold` consecutive connection
+    failures or timeouts.
+
+    While the circuit is open, calls fail at once with `CircuitOpenError`
+    and callers fall back to their local cache or the database. A
+    background probe pings Redis every `probe_interval` seconds and closes
+    the circuit as soon as it answers, then runs the `on_close` callbacks.
+    """
+
+    def __init__(
+        self,
+        ping: Callable[[], Awaitable[Any]],
+        failure_threshold: int = 3,
+        timeout: float = 1.0,
+        probe_interval: float = 1.0
+    ):
+        self.ping = ping
+        self.failure_threshold = failure_threshold
+        self.timeout = timeout
+        self.probe_interval = probe_interval
+        self.state = "closed"
+        self.failures = 0
+        self.trips = 0
+        self.rejected = 0
+        self.opened_at = None
+        self.callbacks = []
+        self._probe = None
+
+
+    def on_close(self, callback: Callable[[], Awaitable[Any]]):
+        self.callbacks.append(callback)
+
+
+    async def call(self, func, *args, **kwargs):
+        if self.state == "open":
+            self.rejected += 1
+            raise CircuitOpenError("Redis circuit is open")
+        try:
+            result = await asyncio.wait_for(func(*args, **kwargs), self.timeout)
+        except asyncio.TimeoutError:
+            self._failure()
+            raise TimeoutError(f"Redis did not answer within {self.timeout}s")
+        except (ConnectionError, TimeoutError, OSError):
+            self._failure()
+            raise
+        self.failures = 0
+        return result
+
+
+    def _failure(self):
+        self.failures += 1
+        if self.state == "closed" and self.failures >= self.failure_threshold:
+            logging.error(f"Redis failed {self.failures} times in a row, opening the circuit")
+            self.state = "open"
+            self.trips += 1
+            self.opened_at = time.monotonic()
+            self._probe = asyncio.ensure_future(self._recover())
+
+
+    async def _recover(self):
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            try:
+                await asyncio.wait_for(self.ping(), self.timeout)
+                break
+            except Exception:
+                continue
+        logging.warning(f"Redis is back after {time.monotonic() - self.opened_at:.1f}s, closing the circuit")
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        for callback in self.callbacks:
+            try:
+                await callback()
+            except Exception as e:
+                logging.error(f"Error while recovering from a Redis outage: {str(e)}")
+
+
+    def stats(self) -> Dict:
+        return {
+            "state": self.state,
+            "open": self.state != "closed",
+            "failures": self.failures,
+            "trips": self.trips,
+            "rejected": self.rejected,
+            "open_seconds": time.monotonic() - self.opened_at if self.opened_at else 0.0,
+        }
+
+
+class GuardedPipeline:
+    """
+    Pipeline whose `execute` goes through the circuit breaker.
+    """
+
+    def __init__(self, pipeline, breaker: CircuitBreaker):
+        self._pipeline = pipeline
+        self._breaker = breaker
+
+
+    def __getattr__(self, name):
+        return getattr(self._pipeline, name)
+
+
+    async def __aenter__(self):
+        await self._pipeline.__aenter__()
+        return self
+
+
+    async def __aexit__(self, *exc_info):
+        return await self._pipeline.__aexit__(*exc_info)
+
+
+    async def execute(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await self._breaker.call(self._pipeline.execute, *args, **kwargs)
+        finally:
+            REDIS.labels("pipeline").observe(time.perf_counter() - start)
+
+
+class GuardedRedis:
+    """
+    Redis client whose commands go through a `CircuitBreaker`, so callers
+    get an error at once instead of waiting on a Redis that is down.
+
+    Pub/sub and connection management are passed through untouched.
+    """
+
+    PASSTHROUGH = {"pubsub", "aclose", "close", "connection_pool"}
+
+    def __init__(self, redis_client, breaker: CircuitBreaker):
+        self._redis = redis_client
+        self.breaker = breaker
+
+
+    def __getattr__(self, name):
+        attribute = getattr(self._redis, name)
+        if name in self.PASSTHROUGH or not callable(attribute):
+            return attribute
+
+        timer = REDIS.labels(name)
+
+        async def command(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await self.breaker.call(attribute, *args, **kwargs)
+            finally:
+                timer.observe(time.perf_counter() - start)
+        return command
+
+
+    def pipeline(self, *args, **kwargs) -> GuardedPipeline:
+        return GuardedPipeline(self._redis.pipeline(*args, **kwargs), self.breaker)
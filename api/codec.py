@@ -0,0 +1,147 @@
+import json
+import logging
+import zlib
+
+from typing import Iterable, List
+
+try:
+    import orjson
+
+    loads = orjson.loads
+    dumps = orjson.dumps
+except ImportError:
+    loads = json.loads
+
+    def dumps(value) -> bytes:
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+
+# No JSON document starts with this byte, entries without it predate the codec
+MAGIC = 0xDA
+VERSION = 1
+
+ENCODINGS = {"json": 0, "msgpack": 1}
+COMPRESSIONS = {"none": 0, "zlib": 1, "zstd": 2, "lz4": 3}
+
+
+class CacheCodec:
+    """
+    Encodes the message documents of cached conversations for Redis.
+
+    An entry is a 4 byte header (magic, format version, body encoding,
+    compression) followed by the body. Bodies of at least
+    `min_compress_size` bytes are compressed when that makes them smaller.
+    Entries are always decoded back to JSON, which is what the rest of the
+    app splices into responses and validates, and any entry this version
+    knows is readable whatever the codec is configured to write. Entries
+    without a header are JSON written before the codec and pass through.
+
+    msgpack, zstandard and lz4 are optional, a missing compressor falls
+    back to zlib.
+    """
+
+    def __init__(
+        self,
+        encoding: str = "json",
+        compression: str = "zstd",
+        min_compress_size: int = 1024,
+        level: int = 3
+    ):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown cache encoding {encoding}")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown cache compression {compression}")
+        if encoding == "msgpack" and msgpack is None:
+            logging.warning("msgpack is not installed, cached messages are stored as JSON")
+            encoding = "json"
+        if (
+            (compression == "zstd" and zstandard is None)
+            or (compression == "lz4" and lz4_frame is None)
+        ):
+            logging.warning(f"{compression} is not installed, cached messages use zlib")
+            compression = "zlib"
+        self.encoding = encoding
+        self.compression = compression
+        self.min_compress_size = min_compress_size
+        self.level = level
+        self._compressor = None
+        if compression == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=level)
+        self._decompressor = zstandard.ZstdDecompressor() if zstandard else None
+
+
+    def _compress(self, body: bytes) -> bytes:
+        if self.compression == "zstd":
+            return self._compressor.compress(body)
+        if self.compression == "lz4":
+            return lz4_frame.compress(body)
+        return zlib.compress(body, self.level)
+
+
+    def _decompress(self, compression: int, body: bytes) -> bytes:
+        if compression == COMPRESSIONS["zstd"]:
+            if self._decompressor is None:
+                raise ValueError("Cached message is zstd compressed but zstandard is not installed")
+            return self._decompressor.decompress(body)
+        if compression == COMPRESSIONS["lz4"]:
+            if lz4_frame is None:
+                raise ValueError("Cached message is lz4 compressed but lz4 is not installed")
+            return lz4_frame.decompress(body)
+        if compression == COMPRESSIONS["zlib"]:
+            return zlib.decompress(body)
+        return body
+
+
+    def encode(self, document: bytes | str) -> bytes:
+        """
+        Entry for a message JSON document.
+        """
+        if isinstance(document, str):
+            document = document.encode()
+        body = msgpack.packb(loads(document)) if self.encoding == "msgpack" else document
+        compression = "none"
+        if self.compression != "none" and len(body) >= self.min_compress_size:
+            compressed = self._compress(body)
+            if len(compressed) < len(body):
+                body, compression = compressed, self.compression
+        return bytes((MAGIC, VERSION, ENCODINGS[self.encoding], COMPRESSIONS[compression])) + body
+
+
+    def encode_many(self, documents: Iterable[bytes | str]) -> List[bytes]:
+        return [self.encode(document) for document in documents]
+
+
+    def decode(self, entry: bytes | str) -> bytes | str:
+        """
+        The message JSON document of an entry.
+        """
+        if isinstance(entry, str) or not entry or entry[0] != MAGIC:
+            return entry
+        version, encoding, compression = entry[1], entry[2], entry[3]
+        if version != VERSION:
+            raise ValueError(f"Unsupported cached message version {version}")
+        body = self._decompress(compression, entry[4:])
+        if encoding == ENCODINGS["msgpack"]:
+            if msgpack is None:
+                raise ValueError("Cached message is msgpack encoded but msgpack is not installed")
+            return dumps(msgpack.unpackb(body))
+        return body
+
+
+    def decode_many(self, entries: Iterable[bytes | str]) -> List[bytes | str]:
+        return [self.decode(entry) for entry in entries]
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import logging
+
+from typing import Dict, List, Tuple
+
+from redis.exceptions import RedisError
+
+from cache import ConversationMemo
+from config import CLAUDE, DAISII, TITAN
+from models.chat import ChatMessage, ContentType
+
+
+# Rough characters per token of each model's tokenizer on mixed English and
+# Vietnamese text. Estimates only need to be stable and a little pessimistic.
+CHARS_PER_TOKEN = {
+    CLAUDE: 3.5,
+    DAISII: 4.0,
+    TITAN: 4.2,
+}
+# Claude bills an image by its pixel size, which we do not decode. This is
+# the cost of an image at the largest size Bedrock accepts without resizing.
+IMAGE_TOKENS = 1600
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def with_summary(instruction: str, summary: str | None) -> str:
+    if not summary:
+        return instruction
+    return f"""{instruction}
+<summary>
+Earlier in this conversation (oldest first):
+{summary}
+</summary>
+"""
+
+
+class ContextWindow:
+    """
+    Picks the part of a conversation that is sent to the model.
+
+    The most recent messages are kept within a per-model token budget.
+    When `summarize` is set, the messages that fall out of the window are
+    folded into a short rolling summary stored next to the conversation
+    in Redis and prepended to the system prompt.
+
+    Token counts are memoized per conversation, so each request only
+    counts the messages added or changed since the previous one.
+    """
+
+    def __init__(
+        self,
+        redis_client,
+        budgets: Dict[str, int],
+        summarize: bool = False,
+        summary_max_chars: int = 2000,
+        cache_ttl: int = 3600,
+        max_conversations: int = 10000
+    ):
+        self.redis = redis_client
+        self.budgets = budgets
+        self.summarize = summarize
+        self.summary_max_chars = summary_max_chars
+        self.cache_ttl = cache_ttl
+        self.token_counts = ConversationMemo(max_conversations, cache_ttl)
+
+
+    def _text_length(self, content) -> Tuple[int, int]:
+        """
+        Return (characters of text, number of images) in a message content.
+        """
+        if isinstance(content, str):
+            return len(content), 0
+        chars, images = 0, 0
+        for block in content:
+            if block.type == ContentType.TEXT:
+                chars += len(block.text)
+            elif block.type == ContentType.IMAGE:
+                images += 1
+            elif block.type == ContentType.TOOLUSE:
+                chars += len(block.tool_name) + len(json.dumps(block.input))
+            elif block.type == ContentType.TOOLRESULT:
+                block_chars, block_images = self._text_length(block.content)
+                chars += block_chars
+                images += block_images
+        return chars, images
+
+
+    def estimate_tokens(self, model: str, message: ChatMessage) -> int:
+        chars, images = self._text_length(message.content)
+        return (
+            int(chars / CHARS_PER_TOKEN[model]) + 1
+            + images * IMAGE_TOKENS
+            + MESSAGE_OVERHEAD_TOKENS
+        )
+
+
+    def _counts(self, model, user_id, conversation_id, messages) -> List[int]:
+        counts = self.token_counts.values((model, user_id, conversation_id), messages)
+        for i, count in enumerate(counts):
+            if count is None:
+                counts[i] = self.estimate_tokens(model, messages[i])
+        return counts
+
+
+    def _summary_line(self, message: ChatMessage) -> str:
+        if isinstance(message.content, str):
+            text = message.content
+        else:
+            text = " ".join(
+                block.text for block in message.content
+                if block.type == ContentType.TEXT
+            )
+        text = " ".join(text.split())
+        if len(text) > 200:
+            text = text[:200].rsplit(" ", 1)[0] + "..."
+        return f"{message.role}: {text}"
+
+
+    def _fingerprint(self, message: ChatMessage) -> str:
+        return hashlib.sha256(message.model_dump_json().encode()).hexdigest()
+
+
+    async def _update_summary(self, model, user_id, conversation_id, messages, cutoff) -> str:
+        """
+        Fold messages[:cutoff] into the stored summary, touching only the new ones.
+
+        The summary is rebuilt when the window moved back, or when the last
+        message it covers is not the one it was built from, as happens when
+        a client sends a different history.
+        """
+        key = f"chat:{user_id}:{conversation_id}:summary:{model}"
+        cached = await self.redis.get(key)
+        summary = json.loads(cached) if cached else None
+        if summary is not None and (
+            summary["upto"] > cutoff
+            or summary["last"] != self._fingerprint(messages[summary["upto"] - 1])
+        ):
+            summary = None
+        if summary is None:
+            summary = {"upto": 0, "text": "", "last": None}
+        if summary["upto"] < cutoff:
+            lines = [summary["text"]] if summary["text"] else []
+            lines.extend(self._summary_line(m) for m in messages[summary["upto"]:cutoff])
+            text = "\n".join(lines)
+            if len(text) > self.summary_max_chars:
+                # Keep the most recent part of the summary, on a line boundary
+                text = text[-self.summary_max_chars:].split("\n", 1)[-1]
+            summary = {"upto": cutoff, "text": text, "last": self._fingerprint(messages[cutoff - 1])}
+            await self.redis.setex(key, self.cache_ttl, json.dumps(summary))
+        return summary["text"]
+
+
+    async def fit(
+        self,
+        model: str,
+        user_id: str,
+        conversation_id: str,
+        messages: List[ChatMessage]
+    ) -> Tuple[List[ChatMessage], str | None]:
+        """
+        Return the messages to send and the summary of the ones left out.
+        """
+        if not messages:
+            return messages, None
+        counts = self._counts(model, user_id, conversation_id, messages)
+        budget = self.budgets[model]
+
+        cutoff = len(messages)
+        used = 0
+        while cutoff > 0 and used + counts[cutoff - 1] <= budget:
+            cutoff -= 1
+            used += counts[cutoff]
+        # Always send the latest message, even when it alone is over budget
+        cutoff = min(cutoff, len(messages) - 1)
+        # The window has to open on a user turn
+        while cutoff < len(messages) - 1 and messages[cutoff].role != "user":
+            cutoff += 1
+
+        summary = None
+        if self.summarize and cutoff > 0:
+            try:
+                summary = await self._update_summary(
+                    model, user_id, conversation_id, messages, cutoff
+                )
+            except RedisError as e:
+                logging.error(f"Error while updating conversation summary: {str(e)}")
+        return messages[cutoff:], summary
@@ -0,0 +1,310 @@
+import bisect
+import collections
+import math
+import sys
+import threading
+import time
+
+from typing import Callable, Dict, Iterable, Tuple
+
+
+# Seconds, from a cached lookup to a slow Bedrock stream
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+RATE_BUCKETS = (1, 5, 10, 25, 50, 100, 200, 400, 800, 1600)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _HistogramChild:
+    """
+    Counts of one label combination. `observe` only bumps existing slots.
+    """
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram:
+    """
+    Prometheus histogram. Resolve `labels(...)` once per call site and keep
+    the child, observing is then a bisect and three additions.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.children: Dict[Tuple[str, ...], _HistogramChild] = {}
+        if not self.label_names:
+            self.children[()] = _HistogramChild(self.buckets)
+
+
+    def labels(self, *values) -> _HistogramChild:
+        child = self.children.get(values)
+        if child is None:
+            child = self.children.setdefault(values, _HistogramChild(self.buckets))
+        return child
+
+
+    def observe(self, value: float):
+        self.children[()].observe(value)
+
+
+    def samples(self) -> Iterable[str]:
+        for values, child in list(self.children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                labels = _format_labels(self.label_names, values, f'le="{_format_value(bound)}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.label_names, values)
+            yield f"{self.name}_sum{labels} {_format_value(child.sum)}"
+            yield f"{self.name}_count{labels} {child.count}"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.values: Dict[Tuple[str, ...], float] = collections.defaultdict(float)
+
+
+    def inc(self, *values, amount: float = 1):
+        self.values[values] += amount
+
+
+    def samples(self) -> Iterable[str]:
+        for values, value in list(self.values.items()):
+            yield f"{self.name}{_format_labels(self.label_names, values)} {_format_value(value)}"
+
+
+class StatsGauges:
+    """
+    Gauges read from a component's `stats()` when /metrics is scraped.
+
+    `stats` returns {metric: value}, or {label value: {metric: value}}
+    when `label` is set.
+    """
+
+    type = "gauge"
+
+    def __init__(self, prefix: str, help: str, stats: Callable[[], Dict], label: str | None = None):
+        self.name = prefix
+        self.help = help
+        self.stats = stats
+        self.label = label
+
+
+    def _rows(self) -> Iterable[Tuple[str, Dict]]:
+        stats = self.stats()
+        if self.label is None:
+            yield "", stats
+            return
+        for value, metrics in stats.items():
+            yield f'{{{self.label}="{value}"}}', metrics
+
+
+    def render(self) -> Iterable[str]:
+        series = collections.defaultdict(list)
+        for labels, metrics in self._rows():
+            for metric, value in metrics.items():
+                if isinstance(value, bool):
+                    value = int(value)
+                if isinstance(value, (int, float)):
+                    series[metric].append(f"{self.name}_{metric}{labels} {_format_value(value)}")
+        for metric, lines in series.items():
+            yield f"# HELP {self.name}_{metric} {self.help}"
+            yield f"# TYPE {self.name}_{metric} gauge"
+            yield from lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        return self.register(Histogram(*args, **kwargs))
+
+
+    def counter(self, *args, **kwargs) -> Counter:
+        return self.register(Counter(*args, **kwargs))
+
+
+    def stats(self, *args, **kwargs) -> StatsGauges:
+        return self.register(StatsGauges(*args, **kwargs))
+
+
+    def render(self) -> str:
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics:
+            try:
+                if isinstance(metric, StatsGauges):
+                    lines.extend(metric.render())
+                    continue
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.type}")
+                lines.extend(metric.samples())
+            except Exception as e:
+                lines.append(f"# {metric.name} unavailable: {e}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+JWT_DECODE = REGISTRY.histogram(
+    "daisii_jwt_decode_seconds", "Access token verification, cached or not"
+)
+USER_LOOKUP = REGISTRY.histogram(
+    "daisii_user_lookup_seconds", "User lookup by where it was found", ["source"]
+)
+BCRYPT = REGISTRY.histogram(
+    "daisii_bcrypt_seconds", "bcrypt calls including the wait for a worker", ["operation"]
+)
+BEDROCK_TTFT = REGISTRY.histogram(
+    "daisii_bedrock_time_to_first_token_seconds",
+    "From the Bedrock invoke to the first generated text",
+    ["model"]
+)
+BEDROCK_TOKENS_PER_SECOND = REGISTRY.histogram(
+    "daisii_bedrock_tokens_per_second",
+    "Output tokens per second after the first token",
+    ["model"],
+    buckets=RATE_BUCKETS
+)
+STREAM_CHUNKS = REGISTRY.counter(
+    "daisii_stream_chunks_total", "HTTP chunks sent by process_stream", ["model"]
+)
+STREAM_EVENTS = REGISTRY.counter(
+    "daisii_stream_events_total", "Bedrock stream events read by process_stream", ["model"]
+)
+REDIS = REGISTRY.histogram(
+    "daisii_redis_seconds", "Redis command and pipeline latency", ["command"]
+)
+AWS_CALLS = REGISTRY.histogram(
+    "daisii_aws_call_seconds", "AWS API call latency including retries", ["service", "operation"]
+)
+SAVE_LAG = REGISTRY.histogram(
+    "daisii_chat_save_lag_seconds", "From queuing a chat history write to DynamoDB accepting it"
+)
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every thread `interval` seconds apart and counts
+    them in the folded format flame graph tools read.
+
+    Nothing runs until `start`, and it can be started and stopped while
+    the app is serving.
+    """
+
+    def __init__(self, max_stacks: int = 10000):
+        self.max_stacks = max_stacks
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.interval = 0.005
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+
+    def start(self, interval: float = 0.005):
+        if self.running:
+            return
+        self.interval = interval
+        self.stacks.clear()
+        self.samples = 0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if ident not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                if key in self.stacks or len(self.stacks) < self.max_stacks:
+                    self.stacks[key] += 1
+            self.samples += 1
+
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+PROFILER = SamplingProfiler()
+
+
+if __name__ == "__main__":
+    child = BEDROCK_TTFT.labels("Claude")
+    runs = 1_000_000
+    start = time.perf_counter()
+    for i in range(runs):
+        child.observe(i % 1000 / 1000)
+    elapsed = time.perf_counter() - start
+    print(f"observe: {elapsed / runs * 1e9:.0f} ns")
+    start = time.perf_counter()
+    text = REGISTRY.render()
+    print(f"render: {(time.perf_counter() - start) * 1000:.2f} ms, {len(text)} bytes")
@@ -0,0 +1,146 @@
+"""
+One-shot schema and data migrations.
+
+    python migrate.py dynamodb-table
+    python migrate.py dynamodb-split-tables [--source TABLE] [--delete-source]
+    python migrate.py rds-schema
+"""
+import argparse
+import json
+import logging
+import os
+
+from decimal import Decimal
+from dotenv import load_dotenv
+
+from aws_services.dynamodb import DynamoDBService
+from aws_services.rds import AuroraPostgres
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def copy_conversation_table(service: DynamoDBService, table, conversation_id: str | None = None) -> int:
+    """
+    Stream one legacy table into the single table.
+
+    Handles both legacy layouts: one item holding the whole `messages`
+    list, and one item per message keyed by `seq`. Items are filed under
+    their own `conversation_id`: the old service could write a
+    conversation into another conversation's table, or into the base
+    table. `conversation_id`, taken from the table name, is only used
+    for items without one.
+    """
+    copied = 0
+    owners = set()
+    scan = {}
+    with service.table.batch_writer() as batch:
+        while True:
+            response = table.scan(**scan)
+            for item in response.get('Items', []):
+                userid = item['userid']
+                item_conversation_id = item.get('conversation_id', conversation_id)
+                if item_conversation_id is None:
+                    logging.error(f"Skipping an item of {table.name} without conversation_id")
+                    continue
+                owners.add((userid, item_conversation_id))
+                if 'messages' in item:
+                    messages = enumerate(item['messages'])
+                else:
+                    messages = [(int(item['seq']), item['message'])]
+                for seq, message in messages:
+                    if not isinstance(message, str):
+                        message = json.dumps(message, default=_json_default)
+                    batch.put_item(
+                        Item={
+                            'user_id': userid,
+                            'sk': service.message_key(item_conversation_id, seq),
+                            'conversation_id': item_conversation_id,
+                            'seq': seq,
+                            'message': message
+                        }
+                    )
+                    copied += 1
+            if 'LastEvaluatedKey' not in response:
+                break
+            scan['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    for userid, item_conversation_id in owners:
+        service.create_conversation(userid, item_conversation_id)
+    return copied
+
+
+def split_tables(service: DynamoDBService, source: str | None = None, delete_source: bool = False):
+    """
+    Move every `<source>_<conversation_id>` table, and the `<source>` base
+    table the old service also wrote to, into the single table.
+
+    `source` defaults to the single table's name. When the base table
+    still has the legacy key schema the single table must be a new one.
+    """
+    client = service.dynamodb.meta.client
+    source = source or service.table_name
+    prefix = f"{source}_"
+    names = [
+        name
+        for page in client.get_paginator('list_tables').paginate()
+        for name in page['TableNames']
+    ]
+    legacy_tables = [
+        (name, name[len(prefix):]) for name in names
+        if name.startswith(prefix) and name != service.table_name
+    ]
+    if source in names and not service.has_current_schema(source):
+        if source == service.table_name:
+            raise RuntimeError(
+                f"Table {source} has the legacy key schema, set DYNAMODB_TABLE_NAME "
+                f"to a new table and run again with --source {source}"
+            )
+        legacy_tables.append((source, None))
+
+    service.create_table()
+    for name, conversation_id in legacy_tables:
+        copied = copy_conversation_table(
+            service, service.dynamodb.Table(name), conversation_id
+        )
+        logging.info(f"Migrated {copied} messages from {name}")
+        if delete_source:
+            client.delete_table(TableName=name)
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("dynamodb-table", help="create the chat history table")
+    split = commands.add_parser(
+        "dynamodb-split-tables",
+        help="copy the legacy base and per-conversation tables into the chat history table"
+    )
+    split.add_argument(
+        "--source",
+        help="name the legacy tables were derived from, by default DYNAMODB_TABLE_NAME"
+    )
+    split.add_argument(
+        "--delete-source",
+        action="store_true",
+        help="drop each legacy table once it has been copied"
+    )
+    commands.add_parser("rds-schema", help="create the user table in Aurora PostgreSQL")
+    args = parser.parse_args()
+
+    dynamodb_service = DynamoDBService(
+        os.environ.get("DYNAMODB_REGION"),
+        os.environ.get("DYNAMODB_TABLE_NAME")
+    )
+    if args.command == "dynamodb-table":
+        dynamodb_service.create_table()
+    elif args.command == "dynamodb-split-tables":
+        split_tables(dynamodb_service, args.source, args.delete_source)
+    elif args.command == "rds-schema":
+        AuroraPostgres(os.environ.get('AURORA_DATABASE_REGION')).create_schema()
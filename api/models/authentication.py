@@ -1,26 +1,81 @@
+import asyncio
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
 from passlib.context import CryptContext
-from aws_services.rds import AuroraPostgres
-    
-    
+from metrics import BCRYPT
+
+
 class Authentication:
-    
-    def __init__(self):
+
+    def __init__(self, max_workers: int | None = None, max_pending: int | None = None):
         self.pwd_context = CryptContext(
-            schemes=["bcrypt"], 
+            schemes=["bcrypt"],
             deprecated="auto"
         )
-        
-    
-    def verify_password(self, 
-            plain_password, 
+        # bcrypt releases the GIL, so a thread pool spreads hashing across
+        # cores while the event loop keeps serving streams. One core is left
+        # for the loop itself.
+        if max_workers is None:
+            max_workers = max(1, (os.cpu_count() or 2) - 1)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="bcrypt"
+        )
+        self.max_workers = max_workers
+        self.max_pending = max_pending or max_workers * 8
+        self.pending = 0
+        self.rejected = 0
+        self.timers = {
+            "verify": BCRYPT.labels("verify"),
+            "hash": BCRYPT.labels("hash"),
+        }
+
+
+    async def _run(self, operation, func, *args):
+        """
+        Run a bcrypt call on the pool, rejecting it when too many are queued.
+        """
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Too many authentication requests. Please try again",
+                headers={"Retry-After": "1"}
+            )
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            self.pending -= 1
+            self.timers[operation].observe(time.perf_counter() - start)
+
+
+    async def verify_password(self,
+            plain_password,
             hashed_password
         ):
-        return self.pwd_context.verify(
-            plain_password, 
+        return await self._run(
+            "verify",
+            self.pwd_context.verify,
+            plain_password,
             hashed_password
         )
-    
-    
-    def get_password_hash(self, password):
-        return self.pwd_context.hash(password)
-    
\ No newline at end of file
+
+
+    async def get_password_hash(self, password):
+        return await self._run("hash", self.pwd_context.hash, password)
+
+
+    def stats(self):
+        return {
+            "workers": self.max_workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "rejected": self.rejected,
+        }
+
@@ -1,7 +1,16 @@
+import asyncio
+import json
+import logging
+import os
+
 from enum import Enum
-from typing import List, Dict
-from fastapi import BackgroundTasks
-from pydantic import BaseModel
+from typing import Annotated, AsyncIterator, List, Dict, Literal, Tuple, Union
+from pydantic import BaseModel, Field, TypeAdapter
+
+from redis.exceptions import RedisError, WatchError
+
+from cache import LocalCache, SingleFlight, jittered
+from codec import CacheCodec
 
 
 class MediaType(str, Enum):
@@ -19,38 +28,78 @@ class ContentType(str, Enum):
     
 
 class Image(BaseModel):
-    type = "base64"
+    type: Literal["base64"] = "base64"
     media_type: MediaType
     data: str
+
+
+class ImageRef(BaseModel):
+    """
+    An image in the blob store, see blobs.BlobStore.
+    """
+    type: Literal["blob"] = "blob"
+    media_type: MediaType
+    ref: str
     
     
 class TextContent(BaseModel):
-    type: ContentType.TEXT
+    type: Literal["text"]
     text: str
     
 
 class ImageContent(BaseModel):
-    type: ContentType.IMAGE
-    source: Image
+    type: Literal["image"]
+    source: Image | ImageRef
     
     
 class ToolUseContent(BaseModel):
-    type: ContentType.TOOLUSE
+    type: Literal["tool_use"]
     tool_use_id: str
     tool_name: str
     input: Dict
     
 
+# Tagged on `type`, so each block is validated against exactly one model
+ToolResultBlock = Annotated[
+    Union[TextContent, ImageContent],
+    Field(discriminator="type")
+]
+
+
 class ToolResultContent(BaseModel):
-    type: ContentType.TOOLRESULT
+    type: Literal["tool_result"]
     tool_use_id: str
     is_error: bool
-    content: List[TextContent | ImageContent] | str
+    content: List[ToolResultBlock] | str
+
+
+ContentBlock = Annotated[
+    Union[TextContent, ImageContent, ToolUseContent, ToolResultContent],
+    Field(discriminator="type")
+]
 
 
 class ChatMessage(BaseModel):
     role: str
-    content: List[TextContent | ImageContent | ToolUseContent | ToolResultContent] | str
+    content: List[ContentBlock] | str
+
+
+CHAT_MESSAGES = TypeAdapter(List[ChatMessage])
+
+
+def parse_messages(messages: List[bytes | str]) -> List[ChatMessage]:
+    """
+    Validate stored message documents with a single call into pydantic-core.
+    """
+    if not messages:
+        return []
+    return CHAT_MESSAGES.validate_json(json_array(messages))
+
+
+def json_array(items: List[bytes | str]) -> bytes:
+    return b"[" + b",".join(
+        item.encode() if isinstance(item, str) else item for item in items
+    ) + b"]"
 
 
 class ChatHistory(BaseModel):
@@ -58,55 +107,436 @@ class ChatHistory(BaseModel):
     user_id: str
     messages: List[ChatMessage]
 
+
+class ChatTurn(BaseModel):
+    """
+    A new user message, sent against the last message the client has seen.
+
+    `last_seq` is the sequence number of that message, or None when the
+    conversation is new.
+    """
+    message: ChatMessage
+    last_seq: int | None = Field(default=None, ge=0)
+
+
+class ConflictError(Exception):
+    """
+    The conversation changed since the client last saw it, or another
+    turn is still being answered.
+    """
+
+    def __init__(self, message: str, last_seq: int | None):
+        super().__init__(message)
+        self.last_seq = last_seq
+
+
+class ChatHistoryPage(BaseModel):
+    """
+    A contiguous slice of a conversation in chronological order.
+
+    `messages[i]` has sequence number `first_seq + i`. `before` is the
+    cursor for the next older page, or None once the start is reached.
+    """
+    conversation_id: str
+    user_id: str
+    messages: List[ChatMessage]
+    first_seq: int
+    before: int | None
+
     
 class ChatService:
-    def __init__(self, redis_client, dynamodb_service):
+    """
+    Conversation history stored append-only, one entry per message.
+
+    Redis keeps each conversation as a list of messages, encoded and
+    compressed by `codec`, and DynamoDB keeps one item per (conversation,
+    sequence number), so a turn only writes the messages it added instead
+    of the whole conversation. DynamoDB writes go through the write-behind
+    queue.
+
+    While Redis is unavailable, conversations are served from a bounded
+    local copy loaded from DynamoDB. The Redis lists that missed messages
+    meanwhile are dropped once it is back, see `recovered`.
+    """
+
+    def __init__(
+        self,
+        redis_client,
+        dynamodb_service,
+        write_queue,
+        loads: SingleFlight | None = None,
+        max_fallback_conversations: int = 1000,
+        codec: CacheCodec | None = None,
+        max_parsed_conversations: int = 1000,
+        turn_ttl: int = 300
+    ):
         self.redis = redis_client
         self.dynamodb = dynamodb_service
+        self.write_queue = write_queue
+        self.loads = loads or SingleFlight()
+        self.codec = codec or CacheCodec()
         self.cache_ttl = 3600  # 1 hour cache
+        self.fallback = LocalCache(max_fallback_conversations, self.cache_ttl)
+        self.dirty = set()
+        # Validated messages per conversation, extended as the list grows
+        self.parsed = LocalCache(max_parsed_conversations, self.cache_ttl)
+        self.turn_ttl = turn_ttl
 
 
-    async def get_chat_history(self, user_id: str, conversation_id: str) -> ChatHistory:
-        # Try getting from Redis first
-        cache_key = f"chat:{user_id}:{conversation_id}"
-        cached_history = self.redis.get(cache_key)
-        
-        if cached_history:
-            return ChatHistory.model_validate(cached_history)
-
-        # If not in cache, get from DynamoDB
-        history = await self.dynamodb.get_chat_history(user_id, conversation_id)
-        
-        # Cache the result
-        self.redis.setex(
+    def _cache_key(self, user_id: str, conversation_id: str) -> str:
+        return f"chat:{user_id}:{conversation_id}:messages"
+
+
+    async def _stored_messages(self, user_id: str, conversation_id: str) -> List[str]:
+        """
+        The messages in DynamoDB and the ones still queued for it.
+        """
+        # Taken first: an item flushed during the query is then in its result
+        unwritten = self.write_queue.unwritten_items(
+            user_id, self.dynamodb.message_prefix(conversation_id)
+        )
+        items = await asyncio.to_thread(
+            self.dynamodb.get_chat_history, user_id, conversation_id
+        )
+        messages = {item["sk"]: item["message"] for item in items + unwritten}
+        return [messages[sk] for sk in sorted(messages)]
+
+
+    async def _rebuild(self, user_id: str, conversation_id: str) -> List[str]:
+        """
+        Fill the cached list from the stored messages, unless a turn
+        filled it meanwhile.
+        """
+        cache_key = self._cache_key(user_id, conversation_id)
+        messages = await self._stored_messages(user_id, conversation_id)
+
+        if messages:
+            try:
+                async with self.redis.pipeline(transaction=True) as pipe:
+                    await pipe.watch(cache_key)
+                    if not await pipe.exists(cache_key):
+                        pipe.multi()
+                        pipe.rpush(cache_key, *self.codec.encode_many(messages))
+                        pipe.expire(cache_key, jittered(self.cache_ttl))
+                        await pipe.execute()
+            except WatchError:
+                pass
+            except RedisError as e:
+                logging.error(f"Error while caching chat history: {str(e)}")
+        return messages
+
+
+    async def _load_fallback(self, user_id: str, conversation_id: str) -> List[str]:
+        """
+        `_load_messages` while Redis is unavailable.
+        """
+        cache_key = self._cache_key(user_id, conversation_id)
+        messages = self.fallback.get(cache_key)
+        if messages is None:
+            loaded = await self.loads.do(
+                f"{cache_key}:fallback",
+                lambda: self._stored_messages(user_id, conversation_id)
+            )
+            # Concurrent loads share one list, turns append to it
+            messages = self.fallback.get(cache_key)
+            if messages is None:
+                messages = list(loaded)
+                self.fallback.set(cache_key, messages)
+        return messages
+
+
+    async def recovered(self):
+        """
+        Called once Redis is back. Lists that missed messages while it was
+        down are deleted and rebuilt from DynamoDB on the next read.
+        """
+        dirty, self.dirty = self.dirty, set()
+        self.fallback.clear()
+        if dirty:
+            await self.redis.delete(*dirty)
+
+
+    async def _load_messages(self, user_id: str, conversation_id: str) -> List[str]:
+        """
+        Return the stored messages as JSON documents, filling the cache on a miss.
+        """
+        cache_key = self._cache_key(user_id, conversation_id)
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.lrange(cache_key, 0, -1)
+                pipe.ttl(cache_key)
+                cached_messages, ttl = await pipe.execute()
+        except RedisError:
+            return await self._load_fallback(user_id, conversation_id)
+        if cached_messages:
+            # Redis holds the newest messages (DynamoDB is written behind),
+            # so a hot list is kept alive instead of being reloaded
+            if self.loads.should_refresh(ttl):
+                await self.redis.expire(cache_key, jittered(self.cache_ttl))
+            return self.codec.decode_many(cached_messages)
+
+        # Concurrent misses share one DynamoDB read
+        async def cached():
+            cached_messages = await self.redis.lrange(cache_key, 0, -1)
+            return self.codec.decode_many(cached_messages) if cached_messages else None
+
+        return await self.loads.do(
             cache_key,
-            self.cache_ttl,
-            history.json()
+            lambda: self._rebuild(user_id, conversation_id),
+            cached
         )
-        
-        return history
 
 
-    async def save_chat_history(
+    async def get_messages(self, user_id: str, conversation_id: str) -> List[ChatMessage]:
+        """
+        The whole conversation as models.
+
+        Conversations are append-only, so after the first call only the
+        messages added since are read from Redis and validated.
+        """
+        cache_key = self._cache_key(user_id, conversation_id)
+        messages = self.parsed.get(cache_key) or []
+        try:
+            stored = await self.redis.llen(cache_key)
+        except RedisError:
+            return parse_messages(await self._load_fallback(user_id, conversation_id))
+        if not stored or stored < len(messages):
+            messages = parse_messages(await self._load_messages(user_id, conversation_id))
+        elif stored > len(messages):
+            tail = await self.redis.lrange(cache_key, len(messages), -1)
+            messages = messages + parse_messages(self.codec.decode_many(tail))
+        self.parsed.set(cache_key, messages)
+        return list(messages)
+
+
+    async def begin_turn(
         self,
         user_id: str,
         conversation_id: str,
-        messages: List[ChatMessage],
-        background_tasks: BackgroundTasks
-    ):
-        # Update cache immediately
-        cache_key = f"chat:{user_id}:{conversation_id}"
-        history = ChatHistory(
+        last_seq: int | None
+    ) -> Tuple[List[ChatMessage], str | None]:
+        """
+        Lock the conversation for a new turn and return its messages.
+
+        Raise ConflictError when another turn holds the lock, or when the
+        client has not seen the newest message. The lock expires after
+        `turn_ttl` seconds in case its holder dies, otherwise it is
+        released by `end_turn` with the returned token.
+        """
+        lock_key = f"{self._cache_key(user_id, conversation_id)}:turn"
+        token = os.urandom(8).hex()
+        try:
+            if not await self.redis.set(lock_key, token, nx=True, ex=self.turn_ttl):
+                raise ConflictError("A reply is still being generated", None)
+        except RedisError as e:
+            # Without Redis there is nothing shared to lock, check the sequence only
+            logging.error(f"Error while locking conversation {conversation_id}: {str(e)}")
+            token = None
+        try:
+            messages = await self.get_messages(user_id, conversation_id)
+            expected = 0 if last_seq is None else last_seq + 1
+            if len(messages) != expected:
+                raise ConflictError(
+                    "The conversation has changed", len(messages) - 1 if messages else None
+                )
+        except BaseException:
+            await self.end_turn(user_id, conversation_id, token)
+            raise
+        return messages, token
+
+
+    async def end_turn(self, user_id: str, conversation_id: str, token: str | None):
+        if token is None:
+            return
+        lock_key = f"{self._cache_key(user_id, conversation_id)}:turn"
+        try:
+            if await self.redis.get(lock_key) == token.encode():
+                await self.redis.delete(lock_key)
+        except RedisError as e:
+            logging.error(f"Error while unlocking conversation {conversation_id}: {str(e)}")
+
+
+    async def get_chat_history(self, user_id: str, conversation_id: str) -> ChatHistory:
+        messages = await self._load_messages(user_id, conversation_id)
+        return ChatHistory(
             conversation_id=conversation_id,
             user_id=user_id,
-            messages=messages
+            messages=parse_messages(messages)
+        )
+
+
+    async def iter_messages(
+        self,
+        user_id: str,
+        conversation_id: str,
+        before: int | None = None,
+        limit: int = 50,
+        chunk_size: int = 100
+    ) -> AsyncIterator[Tuple[int, bytes | str]]:
+        """
+        Yield `(seq, message JSON)` pairs newest first, `limit` at most.
+
+        Reads go from the cached Redis list in chunks, or straight from
+        DynamoDB when the conversation is not cached. A page read never
+        loads the rest of the conversation.
+        """
+        cache_key = self._cache_key(user_id, conversation_id)
+        try:
+            stored = await self.redis.llen(cache_key)
+        except RedisError:
+            messages = await self._load_fallback(user_id, conversation_id)
+            end = len(messages) if before is None else min(before, len(messages))
+            for seq in range(end - 1, max(0, end - limit) - 1, -1):
+                yield seq, messages[seq]
+            return
+        if stored:
+            end = stored if before is None else min(before, stored)
+            start = max(0, end - limit)
+            while end > start:
+                chunk_start = max(start, end - chunk_size)
+                chunk = await self.redis.lrange(cache_key, chunk_start, end - 1)
+                for offset in range(len(chunk) - 1, -1, -1):
+                    yield chunk_start + offset, self.codec.decode(chunk[offset])
+                end = chunk_start
+            return
+
+        start_key = None
+        while limit > 0:
+            items, start_key = await asyncio.to_thread(
+                self.dynamodb.get_chat_history_page,
+                user_id,
+                conversation_id,
+                before,
+                min(limit, chunk_size),
+                start_key
+            )
+            for item in items:
+                yield int(item["seq"]), item["message"]
+            limit -= len(items)
+            if start_key is None:
+                return
+
+
+    async def _page(self, user_id, conversation_id, before, limit) -> Tuple[int, List]:
+        page = [m async for m in self.iter_messages(user_id, conversation_id, before, limit)]
+        page.reverse()
+        first_seq = page[0][0] if page else (before or 0)
+        return first_seq, [m for _, m in page]
+
+
+    async def get_chat_history_page(
+        self,
+        user_id: str,
+        conversation_id: str,
+        before: int | None = None,
+        limit: int = 50
+    ) -> ChatHistoryPage:
+        first_seq, messages = await self._page(user_id, conversation_id, before, limit)
+        return ChatHistoryPage(
+            conversation_id=conversation_id,
+            user_id=user_id,
+            messages=parse_messages(messages),
+            first_seq=first_seq,
+            before=first_seq if first_seq > 0 else None
+        )
+
+
+    async def get_chat_history_page_json(
+        self,
+        user_id: str,
+        conversation_id: str,
+        before: int | None = None,
+        limit: int = 50
+    ) -> bytes:
+        """
+        `get_chat_history_page` as JSON, built from the stored documents.
+
+        Everything in the store was validated on the way in, so the
+        messages are spliced in as they are instead of being parsed into
+        models and serialized again.
+        """
+        first_seq, messages = await self._page(user_id, conversation_id, before, limit)
+        page = json.dumps({
+            "conversation_id": conversation_id,
+            "user_id": user_id,
+            "first_seq": first_seq,
+            "before": first_seq if first_seq > 0 else None
+        }).encode()
+        return page[:-1] + b',"messages":' + json_array(messages) + b"}"
+
+
+    async def _append(self, user_id: str, conversation_id: str, entries: List[bytes]) -> int:
+        """
+        Push encoded messages onto the cached list and return the sequence
+        number of the first one.
+
+        The numbers come from the list length RPUSHX returns, so concurrent
+        turns, in any worker, never get the same ones. An expired list is
+        refilled in full along with the messages instead of holding only
+        a tail.
+        """
+        cache_key = self._cache_key(user_id, conversation_id)
+        while True:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.rpushx(cache_key, *entries)
+                pipe.expire(cache_key, jittered(self.cache_ttl))
+                length, _ = await pipe.execute()
+            if length:
+                return length - len(entries)
+
+            stored = await self._stored_messages(user_id, conversation_id)
+            try:
+                async with self.redis.pipeline(transaction=True) as pipe:
+                    await pipe.watch(cache_key)
+                    if await pipe.exists(cache_key):
+                        continue
+                    pipe.multi()
+                    pipe.rpush(cache_key, *self.codec.encode_many(stored), *entries)
+                    pipe.expire(cache_key, jittered(self.cache_ttl))
+                    await pipe.execute()
+                return len(stored)
+            except WatchError:
+                continue
+
+
+    async def save_chat_history(
+        self,
+        user_id: str,
+        conversation_id: str,
+        messages: List[ChatMessage]
+    ):
+        """
+        Append `messages`, the ones a turn added, after the stored ones.
+
+        Only the messages of the turn are passed: the history a client
+        sends may be a page, or differ from what is stored, so its length
+        says nothing about which of its messages are new.
+        """
+        cache_key = self._cache_key(user_id, conversation_id)
+        new_messages = [
+            ChatMessage.model_validate(m).model_dump_json()
+            for m in messages
+        ]
+        if not new_messages:
+            return
+
+        try:
+            stored = await self._append(
+                user_id, conversation_id, self.codec.encode_many(new_messages)
+            )
+        except RedisError:
+            # Without Redis, turns are only ordered within this worker
+            fallback = await self._load_fallback(user_id, conversation_id)
+            stored = len(fallback)
+            fallback.extend(new_messages)
+            self.dirty.add(cache_key)
+
+        # Queue the DynamoDB write, it is flushed in batches
+        await self.write_queue.put(
+            self.dynamodb.message_items(
+                conversation_id,
+                user_id,
+                stored,
+                new_messages
+            )
         )
-        self.redis.setex(cache_key, self.cache_ttl, history.model_dump_json())
-        
-        # Save to DynamoDB in background
-        background_tasks.add_task(
-            self.dynamodb.save_chat_history,
-            conversation_id,
-            user_id,
-            messages
-        )
\ No newline at end of file
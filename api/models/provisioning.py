@@ -0,0 +1,224 @@
+import asyncio
+import csv
+import io
+import logging
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+from botocore.exceptions import ClientError
+from pydantic import ValidationError
+
+from aws_services.rds import AuroraPostgres
+from models.user import NewUser, UserInDB
+
+
+def _error(line: int, email, message: str) -> Dict:
+    return {"line": line, "email": email, "error": message}
+
+
+def _csv_rows(reader: csv.DictReader):
+    try:
+        for row in reader:
+            yield reader.line_num, row
+    except csv.Error as e:
+        raise ValueError(f"Invalid CSV after line {reader.line_num}: {str(e)}")
+
+
+def parse_users(data: bytes, format: str) -> Tuple[List[Tuple[int, NewUser]], List[Dict]]:
+    """
+    Read users from CSV (with an email,username,password header) or NDJSON.
+
+    Return the valid users with their line numbers, and an error for each
+    invalid or repeated row. Raise ValueError when the input as a whole
+    cannot be read: CSV that is not UTF-8 or not well formed.
+    """
+    if format == "csv":
+        try:
+            text = data.decode("utf-8-sig")
+        except UnicodeDecodeError as e:
+            raise ValueError(f"CSV is not UTF-8: byte {e.start} is invalid")
+        reader = csv.DictReader(io.StringIO(text))
+        # The header is line 1
+        records = _csv_rows(reader)
+    elif format == "ndjson":
+        records = (
+            (number, line)
+            for number, line in enumerate(data.splitlines(), start=1)
+            if line.strip()
+        )
+    else:
+        raise ValueError(f"Unsupported format {format}")
+
+    users, errors, seen = [], [], set()
+    for line, record in records:
+        try:
+            if isinstance(record, dict):
+                user = NewUser.model_validate(record)
+            else:
+                user = NewUser.model_validate_json(record)
+        except ValidationError as e:
+            error = e.errors()[0]
+            field = ".".join(str(part) for part in error["loc"])
+            email = record.get("email") if isinstance(record, dict) else None
+            errors.append(_error(line, email, f"{field}: {error['msg']}" if field else error["msg"]))
+            continue
+        email = user.email.lower()
+        if email in seen:
+            errors.append(_error(line, user.email, "Duplicate email in input"))
+            continue
+        seen.add(email)
+        users.append((line, user))
+    return users, errors
+
+
+class UserProvisioner:
+    """
+    Registers many users at once.
+
+    Passwords are hashed on a dedicated pool (bcrypt releases the GIL, so
+    it spreads across cores) while earlier batches are being inserted, one
+    Data API request per batch. The pool is separate from the login pool so
+    a large import does not queue ahead of people signing in.
+    """
+
+    def __init__(
+        self,
+        user_database: AuroraPostgres,
+        pwd_context,
+        user_cache=None,
+        max_workers: int | None = None,
+        batch_size: int = 100
+    ):
+        self.user_database = user_database
+        self.pwd_context = pwd_context
+        self.user_cache = user_cache
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers or max(1, (os.cpu_count() or 2) // 2),
+            thread_name_prefix="bcrypt-bulk"
+        )
+
+
+    async def _insert(self, batch: List[Tuple[int, NewUser, str]]) -> Tuple[List[UserInDB], List[Dict]]:
+        created, errors = [], []
+        try:
+            ids = await self.user_database.create_users(
+                (user.email, user.username, hashed) for _, user, hashed in batch
+            )
+        except ClientError:
+            # The whole batch was rolled back, insert row by row to find the culprit
+            ids = []
+            for line, user, hashed in batch:
+                try:
+                    ids.append(await self.user_database.create_new_user(
+                        user.email, user.username, hashed
+                    ))
+                except ClientError as e:
+                    ids.append(e)
+
+        for (line, user, hashed), user_id in zip(batch, ids):
+            if user_id is None:
+                errors.append(_error(line, user.email, "Email already registered"))
+            elif isinstance(user_id, Exception):
+                errors.append(_error(line, user.email, str(user_id)))
+            else:
+                created.append(UserInDB(
+                    id=user_id,
+                    email=user.email,
+                    username=user.username,
+                    password=hashed,
+                    disabled=False
+                ))
+        return created, errors
+
+
+    async def provision(self, data: bytes, format: str) -> Dict:
+        """
+        Register every valid user in `data` and report the rows that failed.
+        """
+        start = time.perf_counter()
+        users, errors = parse_users(data, format)
+
+        # Queue every hash up front, the pool works through them in order
+        # while the batches before are inserted
+        loop = asyncio.get_running_loop()
+        hashes = [
+            loop.run_in_executor(self.executor, self.pwd_context.hash, user.password)
+            for _, user in users
+        ]
+
+        created = []
+        for offset in range(0, len(users), self.batch_size):
+            batch = [
+                (line, user, await hashed)
+                for (line, user), hashed in zip(
+                    users[offset:offset + self.batch_size],
+                    hashes[offset:offset + self.batch_size]
+                )
+            ]
+            batch_created, batch_errors = await self._insert(batch)
+            created.extend(batch_created)
+            errors.extend(batch_errors)
+
+        if self.user_cache is not None and created:
+            try:
+                await self.user_cache.prime(created)
+            except Exception as e:
+                # Users are registered, they will be cached on first login
+                logging.error(f"Error while caching provisioned users: {str(e)}")
+
+        elapsed = time.perf_counter() - start
+        errors.sort(key=lambda error: error["line"])
+        return {
+            "created": len(created),
+            "failed": len(errors),
+            "errors": errors,
+            "seconds": round(elapsed, 3),
+            "users_per_second": round(len(created) / elapsed, 1) if elapsed else 0.0,
+        }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    from dotenv import load_dotenv
+    from passlib.context import CryptContext
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Register users from a CSV or NDJSON file")
+    parser.add_argument("file", help="email,username,password CSV, or one JSON object per line")
+    parser.add_argument("--format", choices=("csv", "ndjson"), help="default: from the file extension")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="hashing threads")
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    format = args.format or ("csv" if args.file.endswith(".csv") else "ndjson")
+    with open(args.file, "rb") as f:
+        data = f.read()
+
+    async def main():
+        user_cache = None
+        if os.environ.get("REDIS_HOST"):
+            from redis.asyncio import Redis
+            from cache import UserCache
+            user_cache = UserCache(Redis(
+                host=os.environ.get("REDIS_HOST"),
+                port=int(os.environ.get("REDIS_PORT", 6379))
+            ))
+        provisioner = UserProvisioner(
+            AuroraPostgres(os.environ.get('AURORA_DATABASE_REGION')),
+            CryptContext(schemes=["bcrypt"], deprecated="auto"),
+            user_cache,
+            args.workers,
+            args.batch_size
+        )
+        report = await provisioner.provision(data, format)
+        print(json.dumps(report, indent=2))
+        if user_cache is not None:
+            await user_cache.redis.aclose()
+
+    asyncio.run(main())
@@ -1,4 +1,6 @@
+import hashlib
 import jwt
+import time
 
 from datetime import datetime, timedelta, timezone
 from pydantic import BaseModel
@@ -6,6 +8,8 @@ from jwt.exceptions import InvalidTokenError
 
 from typing import Dict
 
+from cache import LocalCache
+
 
 class TokenData(BaseModel):
     email: str | None = None
@@ -17,9 +21,13 @@ class Token(BaseModel):
     
 
 class Session:
-    def __init__(self, secret_key, algorithm):
+    def __init__(self, secret_key, algorithm, max_cached_tokens: int = 10000):
         self.secret_key = secret_key
         self.algorithm = algorithm
+        # Tokens that already passed verification, keyed by their digest and
+        # evicted at their own expiry. Only valid tokens get in, and the LRU
+        # bound caps memory when many distinct tokens are presented.
+        self.verified_tokens = LocalCache(max_size=max_cached_tokens)
 
 
     def  __encode(self, payload):
@@ -39,6 +47,27 @@ class Session:
             )
         except InvalidTokenError:
             return None
+
+
+    def get_token_data(self, token) -> TokenData | None:
+        """
+        Return the token's claims, verifying the signature only on first use.
+        """
+        key = hashlib.sha256(token.encode()).digest()
+        token_data = self.verified_tokens.get(key)
+        if token_data is not None:
+            return token_data
+
+        payload = self.decode(token)
+        if payload is None or payload.get("sub") is None:
+            return None
+        token_data = TokenData(email=payload["sub"])
+
+        # Tokens without an expiry are never cached
+        expire = payload.get("exp")
+        if expire is not None:
+            self.verified_tokens.set(key, token_data, expire - time.time())
+        return token_data
         
     
     def create_access_token(self, 
@@ -52,4 +81,17 @@ class Session:
             expire = datetime.now(timezone.utc) + timedelta(minutes=15)
         to_encode.update({"exp": expire})
         encoded_jwt = self.__encode(to_encode)
-        return encoded_jwt
\ No newline at end of file
+        return encoded_jwt
+
+
+if __name__ == "__main__":
+    import timeit
+
+    session = Session("benchmark-secret", "HS256")
+    token = session.create_access_token({"sub": "user@example.com"})
+    runs = 20000
+
+    uncached = timeit.timeit(lambda: session.decode(token), number=runs)
+    cached = timeit.timeit(lambda: session.get_token_data(token), number=runs)
+    print(f"jwt.decode:       {uncached / runs * 1e6:.2f} us/request")
+    print(f"cached token:     {cached / runs * 1e6:.2f} us/request")
@@ -1,4 +1,4 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field
 from fastapi import HTTPException
 
 
@@ -13,6 +13,12 @@ class UserInDB(User):
     password: str
     
 
+class NewUser(BaseModel):
+    email: EmailStr
+    username: str = Field(min_length=1)
+    password: str = Field(min_length=1)
+
+
 class RegisterUser(BaseModel):
     email: EmailStr
     username: str
@@ -0,0 +1,330 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+from collections import deque
+from typing import Dict, List
+
+from botocore.exceptions import ClientError
+
+from metrics import SAVE_LAG
+
+
+# Errors that go away by themselves, anything else rejects the item for good
+RETRYABLE_ERRORS = {
+    "InternalServerError",
+    "ProvisionedThroughputExceededException",
+    "RequestLimitExceeded",
+    "ServiceUnavailable",
+    "ThrottlingException",
+}
+
+
+def is_retryable(error: Exception) -> bool:
+    # Errors without a response, timeouts and dropped connections, are retried
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code") in RETRYABLE_ERRORS
+    return True
+
+
+class WriteBehindQueue:
+    """
+    Durable, batched persistence of DynamoDB items.
+
+    `put` appends the items to a local log before returning, and a
+    background flusher drains them into `batch_write_item` calls of up to
+    25 items, coalescing writes from every user. Unprocessed items are
+    retried with backoff. On `start` any items left in the log by a
+    previous process are replayed.
+
+    A batch DynamoDB rejects, for example because an item is over the
+    size limit, is written again one item at a time. Items rejected on
+    their own are moved to `dead_letter.jsonl` in the log directory, so
+    they do not hold back the writes queued behind them.
+
+    The log is split into segments. A segment file is deleted once every
+    item it holds has been written, so the log stays roughly the size of
+    the unflushed backlog. Each worker process needs its own `log_dir`.
+    """
+
+    BATCH_SIZE = 25
+
+    def __init__(
+        self,
+        dynamodb_service,
+        log_dir: str,
+        flush_interval: float = 0.2,
+        segment_bytes: int = 1024 * 1024,
+        fsync: bool = False
+    ):
+        self.dynamodb = dynamodb_service
+        self.log_dir = log_dir
+        self.flush_interval = flush_interval
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+
+        # Entries are (segment id, enqueue time, item)
+        self.pending = deque()
+        # Newest item per (user_id, sk) not written yet, pending or in flight
+        self.unwritten: Dict[tuple, Dict] = {}
+        self.outstanding: Dict[int, int] = {}
+        self.segment_id = 0
+        self.segment = None
+        # Group commit: records written to the segment, and made durable
+        self.written = 0
+        self.synced = 0
+        self.syncing = None
+        self.wakeup = asyncio.Event()
+        self.flusher = None
+
+        self.flushed_items = 0
+        self.flushed_batches = 0
+        self.retried_items = 0
+        self.failed_batches = 0
+        self.dead_letters = 0
+
+
+    def _segment_path(self, segment_id: int) -> str:
+        return os.path.join(self.log_dir, f"{segment_id:012d}.log")
+
+
+    def _open_segment(self, segment_id: int):
+        if self.segment is not None:
+            self.segment.close()
+        self.segment_id = segment_id
+        self.segment = open(self._segment_path(segment_id), "ab")
+        self.outstanding.setdefault(segment_id, 0)
+
+
+    def _replay(self):
+        segment_ids = sorted(
+            int(name[:-4]) for name in os.listdir(self.log_dir) if name.endswith(".log")
+        )
+        for segment_id in segment_ids:
+            count = 0
+            with open(self._segment_path(segment_id), "rb") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Torn write from a crash, nothing after it was acknowledged
+                        break
+                    for item in record["items"]:
+                        self.pending.append((segment_id, record["time"], item))
+                        self.unwritten[(item["user_id"], item["sk"])] = item
+                    count += len(record["items"])
+            self.outstanding[segment_id] = count
+            if count == 0:
+                os.remove(self._segment_path(segment_id))
+                del self.outstanding[segment_id]
+        if self.pending:
+            logging.warning(f"Replaying {len(self.pending)} unflushed chat history writes")
+        return (segment_ids[-1] + 1) if segment_ids else 0
+
+
+    async def start(self):
+        os.makedirs(self.log_dir, exist_ok=True)
+        self._open_segment(self._replay())
+        self.flusher = asyncio.create_task(self._flush_loop())
+
+
+    async def stop(self, timeout: float = 10.0):
+        """
+        Stop the flusher and flush what is pending for up to `timeout` seconds.
+
+        Anything not written by then stays in the log for the next start.
+        """
+        if self.flusher is not None:
+            self.flusher.cancel()
+            try:
+                await self.flusher
+            except asyncio.CancelledError:
+                pass
+            self.flusher = None
+        try:
+            await asyncio.wait_for(self.flush(), timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"{len(self.pending)} chat history writes left in {self.log_dir}")
+        if self.syncing is not None:
+            await asyncio.gather(self.syncing, return_exceptions=True)
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+
+
+    async def put(self, items: List[Dict]):
+        """
+        Durably enqueue items. They reach DynamoDB within about `flush_interval`.
+
+        The log is flushed, and fsynced with `fsync`, in a thread. Puts
+        that arrive meanwhile wait for the next flush and share it.
+        """
+        now = time.time()
+        self.segment.write(json.dumps({"time": now, "items": items}).encode() + b"\n")
+        self.written += 1
+        record = self.written
+
+        self.outstanding[self.segment_id] += len(items)
+        self.pending.extend((self.segment_id, now, item) for item in items)
+        for item in items:
+            self.unwritten[(item["user_id"], item["sk"])] = item
+        if len(self.pending) >= self.BATCH_SIZE:
+            self.wakeup.set()
+
+        while self.synced < record:
+            if self.syncing is None:
+                self.syncing = asyncio.create_task(self._sync())
+            await asyncio.shield(self.syncing)
+
+
+    def _sync_segment(self):
+        self.segment.flush()
+        if self.fsync:
+            os.fsync(self.segment.fileno())
+
+
+    async def _sync(self):
+        written = self.written
+        try:
+            await asyncio.to_thread(self._sync_segment)
+        finally:
+            self.syncing = None
+        self.synced = written
+        # Rotated here, the segment is never closed while a thread flushes it
+        if self.segment.tell() >= self.segment_bytes:
+            self._open_segment(self.segment_id + 1)
+
+
+    def unwritten_items(self, user_id: str, prefix: str) -> List[Dict]:
+        """
+        Items of `user_id` with a sort key starting with `prefix` that are
+        not in DynamoDB yet.
+        """
+        return [
+            item for (owner, sk), item in self.unwritten.items()
+            if owner == user_id and sk.startswith(prefix)
+        ]
+
+
+    def _written(self, key: tuple, item: Dict):
+        # A newer write of the same key stays unwritten
+        if self.unwritten.get(key) is item:
+            del self.unwritten[key]
+
+
+    def _done(self, segment_id: int):
+        self.outstanding[segment_id] -= 1
+        if self.outstanding[segment_id] > 0:
+            return
+        if segment_id == self.segment_id:
+            self.segment.truncate(0)
+            self.segment.seek(0)
+        else:
+            del self.outstanding[segment_id]
+            os.remove(self._segment_path(segment_id))
+
+
+    async def flush(self):
+        attempt = 0
+        while self.pending:
+            # Coalesce repeated writes of the same key, the newest one wins
+            batch = {}
+            while self.pending and len(batch) < self.BATCH_SIZE:
+                entry = self.pending.popleft()
+                key = (entry[2]["user_id"], entry[2]["sk"])
+                if key in batch:
+                    self._done(batch[key][0])
+                batch[key] = entry
+
+            try:
+                try:
+                    unprocessed = await asyncio.to_thread(
+                        self.dynamodb.batch_write,
+                        [entry[2] for entry in batch.values()]
+                    )
+                except Exception as e:
+                    self.failed_batches += 1
+                    if is_retryable(e):
+                        logging.error(f"Error while flushing chat history: {str(e)}")
+                        unprocessed = [entry[2] for entry in batch.values()]
+                    else:
+                        logging.error(f"Chat history batch rejected, writing items one by one: {str(e)}")
+                        unprocessed = await self._write_each(batch)
+            except asyncio.CancelledError:
+                self.pending.extendleft(reversed(batch.values()))
+                raise
+
+            retry_keys = {(item["user_id"], item["sk"]) for item in unprocessed}
+            now = time.time()
+            for key, entry in reversed(batch.items()):
+                if key in retry_keys:
+                    self.pending.appendleft(entry)
+                else:
+                    self._done(entry[0])
+                    self._written(key, entry[2])
+                    self.flushed_items += 1
+                    SAVE_LAG.observe(now - entry[1])
+            self.flushed_batches += 1
+
+            if retry_keys:
+                self.retried_items += len(retry_keys)
+                attempt += 1
+                await asyncio.sleep(min(0.05 * 2 ** attempt, 5))
+            else:
+                attempt = 0
+
+
+    async def _write_each(self, batch: Dict) -> List[Dict]:
+        """
+        Write the entries of a rejected batch one at a time and return the
+        items to retry. Rejected entries are dead-lettered and removed
+        from `batch`.
+        """
+        unprocessed = []
+        for key, entry in list(batch.items()):
+            try:
+                unprocessed.extend(await asyncio.to_thread(self.dynamodb.batch_write, [entry[2]]))
+            except Exception as e:
+                if is_retryable(e):
+                    unprocessed.append(entry[2])
+                else:
+                    del batch[key]
+                    self._dead_letter(entry, e)
+        return unprocessed
+
+
+    def _dead_letter(self, entry, error: Exception):
+        item = entry[2]
+        logging.error(
+            f"Chat history item {item['user_id']} {item['sk']} rejected, "
+            f"moved to the dead letter log: {str(error)}"
+        )
+        with open(os.path.join(self.log_dir, "dead_letter.jsonl"), "ab") as f:
+            f.write(json.dumps({"time": entry[1], "error": str(error), "item": item}).encode() + b"\n")
+        self._done(entry[0])
+        self._written((item["user_id"], item["sk"]), item)
+        self.dead_letters += 1
+
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+
+    def stats(self) -> Dict:
+        return {
+            "depth": len(self.pending),
+            "lag_seconds": time.time() - self.pending[0][1] if self.pending else 0.0,
+            "flushed_items": self.flushed_items,
+            "flushed_batches": self.flushed_batches,
+            "retried_items": self.retried_items,
+            "failed_batches": self.failed_batches,
+            "dead_letters": self.dead_letters,
+        }
@@ -0,0 +1,105 @@
+from typing import Callable, Dict, List
+
+from cache import ConversationMemo
+from codec import dumps
+from models.chat import ChatMessage, ContentType, ImageRef
+
+
+def claude_content(content, images: Callable[[str], str | None] | None = None) -> str | List[Dict]:
+    """
+    Map `ChatMessage` content to the Anthropic Messages API shape.
+
+    The dicts only reference the model's strings, so large payloads such
+    as base64 images are not copied before the single encode. `images`
+    returns the base64 payload of an image reference.
+    """
+    if isinstance(content, str):
+        return content
+    blocks = []
+    for block in content:
+        if block.type == ContentType.TEXT:
+            blocks.append({"type": "text", "text": block.text})
+        elif block.type == ContentType.IMAGE:
+            if isinstance(block.source, ImageRef):
+                data = images(block.source.ref) if images else None
+                if data is None:
+                    raise ValueError(f"Image {block.source.ref} is not loaded")
+            else:
+                data = block.source.data
+            blocks.append({
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": block.source.media_type,
+                    "data": data
+                }
+            })
+        elif block.type == ContentType.TOOLUSE:
+            blocks.append({
+                "type": "tool_use",
+                "id": block.tool_use_id,
+                "name": block.tool_name,
+                "input": block.input
+            })
+        elif block.type == ContentType.TOOLRESULT:
+            blocks.append({
+                "type": "tool_result",
+                "tool_use_id": block.tool_use_id,
+                "is_error": block.is_error,
+                "content": claude_content(block.content, images)
+            })
+    return blocks
+
+
+def encode_claude_message(message: ChatMessage, images: Callable[[str], str | None] | None = None) -> bytes:
+    return dumps({"role": message.role, "content": claude_content(message.content, images)})
+
+
+class MessageEncoder:
+    """
+    Keeps each conversation's messages encoded in the Claude wire format.
+
+    A request encodes only the messages added or changed since the
+    previous one and reuses the bytes of the rest, see ConversationMemo.
+    Messages before the context window are not encoded until a request
+    sends them, so their images are never loaded otherwise.
+    """
+
+    def __init__(
+        self,
+        max_conversations: int = 10000,
+        ttl: float = 3600,
+        images: Callable[[str], str | None] | None = None
+    ):
+        self.encoded = ConversationMemo(max_conversations, ttl)
+        self.images = images
+
+
+    def _encoded(self, key, messages: List[ChatMessage]) -> List[bytes | None]:
+        return self.encoded.values(key, messages)
+
+
+    def pending(self, key, messages: List[ChatMessage], start: int = 0) -> List[ChatMessage]:
+        """
+        The messages of messages[start:] that `claude` would have to encode.
+        """
+        encoded = self._encoded(key, messages)
+        return [messages[i] for i in range(start, len(messages)) if encoded[i] is None]
+
+
+    def claude(
+        self,
+        key,
+        messages: List[ChatMessage],
+        start: int = 0,
+        images: Callable[[str], str | None] | None = None
+    ) -> List[bytes]:
+        """
+        Encoded messages[start:], `key` names the conversation. `images`
+        replaces the image lookup of the encoder for this call.
+        """
+        encoded = self._encoded(key, messages)
+        for i in range(start, len(messages)):
+            if encoded[i] is None:
+                encoded[i] = encode_claude_message(messages[i], images or self.images)
+        return encoded[start:]
@@ -0,0 +1,316 @@
+"""
+Production server: a master process and a pool of uvicorn workers.
+
+    python server.py [--workers 4] [--host 0.0.0.0] [--port 8001]
+                     [--graceful-timeout 30]
+
+The master imports the libraries the app needs, binds the socket and
+forks the workers, which share nothing but the socket: each one imports
+the app after the fork, so its AWS clients, Redis pool, thread pools and
+local caches are its own. The master never imports the app.
+
+Connection pool sizes and concurrency limits (REDIS_MAX_CONNECTIONS,
+AURORA_DATABASE_MAX_CONNECTIONS, BEDROCK_LIMIT_*...) are read as totals
+for the whole server and divided between the workers, so adding workers
+does not exceed what Redis, Aurora or Bedrock allow. Every worker needs
+at least one of each, --workers is lowered to the smallest total with a
+warning. Each worker keeps its write-behind log in
+WRITE_BEHIND_LOG_DIR/worker-<n>, picked up again by the worker restarted
+in its place. Logs no worker would pick up, of workers beyond --workers
+or written to WRITE_BEHIND_LOG_DIR itself by api.py run on its own, are
+moved to worker 0's directory at startup.
+
+SIGTERM or SIGINT stops accepting connections. Workers give open HTTP
+chat streams up to --graceful-timeout seconds to finish, and close
+WebSocket connections, whose open turns are saved as partial replies.
+They then wait for replies still being saved (BACKGROUND_DRAIN_TIMEOUT)
+and drain the write-behind queue before exiting. Workers still running
+after all of that are killed.
+"""
+import argparse
+import importlib
+import logging
+import math
+import os
+import re
+import shutil
+import signal
+import socket
+import sys
+import time
+import traceback
+
+from dotenv import load_dotenv
+
+
+# Imported once by the master, the workers inherit them on fork
+PRELOAD = [
+    "boto3",
+    "botocore.session",
+    "fastapi",
+    "fastapi.openapi.models",
+    "jwt",
+    "orjson",
+    "passlib.context",
+    "pydantic",
+    "redis.asyncio",
+    "uvicorn",
+]
+
+# Totals for the server and their defaults, each worker gets its share
+SHARED_LIMITS = {
+    "REDIS_MAX_CONNECTIONS": 50,
+    "AURORA_DATABASE_MAX_CONNECTIONS": 10,
+    "DYNAMODB_MAX_CONNECTIONS": 32,
+    "BEDROCK_MAX_STREAMS": 256,
+    "BEDROCK_LIMIT_CLAUDE": 32,
+    "BEDROCK_LIMIT_DAISII": 16,
+    "BEDROCK_LIMIT_TITAN": 16,
+    "BCRYPT_WORKERS": os.cpu_count() or 1,
+}
+
+# Seconds the app's shutdown gives the write-behind queue to drain, see
+# WriteBehindQueue.stop, and a margin for the rest of the shutdown
+WRITE_BEHIND_STOP_TIMEOUT = 10
+SHUTDOWN_MARGIN = 10
+
+
+def preload():
+    for module in PRELOAD:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            logging.warning(f"Could not preload {module}: {str(e)}")
+
+
+def log_directory() -> str:
+    return os.environ.get("WRITE_BEHIND_LOG_DIR", "write_behind")
+
+
+def _total(name: str) -> int:
+    return int(os.environ.get(name) or SHARED_LIMITS[name])
+
+
+def worker_count(workers: int) -> int:
+    """
+    `workers`, lowered until each worker gets at least one of every limit.
+    """
+    for name in SHARED_LIMITS:
+        total = _total(name)
+        if workers > total:
+            logging.warning(f"{name} is {total}, starting {total} workers instead of {workers}")
+            workers = total
+    return workers
+
+
+def worker_environment(index: int, workers: int) -> dict:
+    """
+    Environment variables of worker `index` out of `workers`, at most
+    `worker_count` workers.
+
+    The first workers get one more of a limit that does not divide
+    evenly, so the shares add up to the total.
+    """
+    environment = {}
+    for name in SHARED_LIMITS:
+        total = _total(name)
+        environment[name] = str(total // workers + (index < total % workers))
+    environment["WRITE_BEHIND_LOG_DIR"] = os.path.join(log_directory(), f"worker-{index}")
+    return environment
+
+
+def _segments(directory: str) -> list:
+    return sorted(
+        (int(name[:-4]), name) for name in os.listdir(directory)
+        if name.endswith(".log") and name[:-4].isdigit()
+    )
+
+
+def adopt_orphaned_logs(base: str, workers: int) -> int:
+    """
+    Move the write-behind logs no worker would replay to worker 0's
+    directory, where it replays them on start. Return the number of
+    segments moved.
+
+    Those are the logs of workers numbered `workers` or more, left by a
+    server that ran with more workers, and the segments in `base` itself,
+    written by api.py run without this launcher. Moved segments are
+    numbered after worker 0's own, dead letters are appended to its file.
+    Must run before the workers start.
+    """
+    if not os.path.isdir(base):
+        return 0
+    orphans = [base] + [
+        os.path.join(base, name) for name in sorted(os.listdir(base))
+        if (match := re.fullmatch(r"worker-(\d+)", name))
+        and int(match.group(1)) >= workers
+        and os.path.isdir(os.path.join(base, name))
+    ]
+    target = os.path.join(base, "worker-0")
+    next_id = None
+    moved = 0
+    for directory in orphans:
+        segments = _segments(directory)
+        dead_letters = os.path.join(directory, "dead_letter.jsonl")
+        if segments or os.path.exists(dead_letters):
+            os.makedirs(target, exist_ok=True)
+        if segments and next_id is None:
+            next_id = max((segment_id for segment_id, _ in _segments(target)), default=-1) + 1
+        for _, name in segments:
+            os.replace(os.path.join(directory, name), os.path.join(target, f"{next_id:012d}.log"))
+            next_id += 1
+            moved += 1
+        if os.path.exists(dead_letters):
+            with open(dead_letters, "rb") as source, open(os.path.join(target, "dead_letter.jsonl"), "ab") as f:
+                shutil.copyfileobj(source, f)
+            os.remove(dead_letters)
+        if directory != base:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                logging.warning(f"Could not remove {directory}, it still has files")
+    if moved:
+        logging.warning(f"Moved {moved} orphaned write-behind segments to {target}")
+    return moved
+
+
+def shutdown_timeout(graceful_timeout: float) -> int:
+    """
+    Seconds a worker may take to stop before it is killed: open streams,
+    then replies still being saved, then the write-behind drain.
+    """
+    drain_timeout = float(os.environ.get("BACKGROUND_DRAIN_TIMEOUT", 30))
+    return math.ceil(graceful_timeout + drain_timeout + WRITE_BEHIND_STOP_TIMEOUT + SHUTDOWN_MARGIN)
+
+
+def bind(host: str, port: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(index: int, sock: socket.socket, args):
+    import uvicorn
+
+    os.environ.update(worker_environment(index, args.workers))
+    config = uvicorn.Config(
+        args.app,
+        factory=args.factory,
+        log_level=args.log_level,
+        timeout_graceful_shutdown=args.graceful_timeout,
+    )
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+class Master:
+    """
+    Keeps `args.workers` workers running until told to stop.
+    """
+
+    def __init__(self, sock: socket.socket, args):
+        self.sock = sock
+        self.args = args
+        self.workers = {}
+        self.started = {}
+        self.stopping = False
+
+
+    def spawn(self, index: int):
+        pid = os.fork()
+        if pid == 0:
+            for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGALRM):
+                signal.signal(signum, signal.SIG_DFL)
+            code = 0
+            try:
+                run_worker(index, self.sock, self.args)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        self.workers[pid] = index
+        self.started[index] = time.monotonic()
+        logging.info(f"Started worker {index} [{pid}]")
+
+
+    def stop(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        logging.info(f"Stopping {len(self.workers)} workers")
+        # SIGTERM, a second SIGINT would make uvicorn skip the graceful shutdown
+        self.signal_workers(signal.SIGTERM)
+        signal.alarm(shutdown_timeout(self.args.graceful_timeout))
+
+
+    def kill(self, signum, frame):
+        logging.warning(f"Killing {len(self.workers)} workers still running")
+        self.signal_workers(signal.SIGKILL)
+
+
+    def signal_workers(self, signum: int):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+
+    def run(self) -> int:
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGALRM, self.kill)
+        for index in range(self.args.workers):
+            self.spawn(index)
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index = self.workers.pop(pid, None)
+            if index is None:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            if self.stopping:
+                logging.info(f"Worker {index} [{pid}] exited with {code}")
+                continue
+            logging.error(f"Worker {index} [{pid}] exited with {code}, restarting")
+            # A worker failing at startup is not restarted in a tight loop
+            if time.monotonic() - self.started[index] < 1:
+                time.sleep(1)
+            if not self.stopping:
+                self.spawn(index)
+        self.sock.close()
+        return 0
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(process)d %(levelname)s %(message)s")
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--app", default="api:app", help="module:attribute of the ASGI app")
+    parser.add_argument("--factory", action="store_true", help="the attribute is a function returning the app")
+    parser.add_argument(
+        "--graceful-timeout",
+        type=float,
+        default=30,
+        help="seconds open connections get to finish on shutdown"
+    )
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    args.workers = worker_count(args.workers)
+    preload()
+    adopt_orphaned_logs(log_directory(), args.workers)
+    sock = bind(args.host, args.port)
+    logging.info(f"Serving on {args.host}:{args.port} with {args.workers} workers")
+    sys.exit(Master(sock, args).run())
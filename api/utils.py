@@ -1,25 +1,206 @@
+from codec import loads
 from config import CLAUDE, DAISII, TITAN
-import json
-
-
-async def process_stream(stream, model_type):
-    if model_type == CLAUDE:
-            for event in stream:
-                chunk = json.loads(event["chunk"]["bytes"])
-                if chunk['type'] == 'content_block_delta':
-                    if chunk['delta']['type'] == 'text_delta':
-                        text_chunk = chunk['delta']['text']
-                        yield text_chunk
-    # Parse Llama stream response    
-    elif model_type == DAISII:
-        for event in stream:
-            chunk = json.loads(event["chunk"]["bytes"])
-            text = chunk["generation"]
-            yield text
-    
-    # Parse Titan stream response
-    elif model_type == TITAN:
-        for event in stream:
-            chunk = json.loads(event["chunk"]["bytes"])
-            text = chunk["outputText"]
-            yield text
\ No newline at end of file
+from metrics import STREAM_CHUNKS, STREAM_EVENTS
+import asyncio
+import time
+
+
+_END_OF_STREAM = object()
+
+
+class AsyncEventStream:
+    """
+    Async iterator over a blocking botocore EventStream.
+
+    A single reader runs on the given executor and hands events to the
+    event loop through a bounded queue, so a slow Bedrock stream only
+    occupies one worker thread and never the loop itself. When the queue
+    is full the reader waits, which keeps memory per stream bounded.
+    """
+
+    def __init__(self, stream, executor=None, max_buffered: int = 64):
+        self.stream = stream
+        self.executor = executor
+        self.queue = asyncio.Queue(maxsize=max_buffered)
+        self.closed = False
+        self.cache_key = None
+        # Set from the invocation metrics Bedrock appends to the last event
+        self.output_tokens = None
+        self._reader = None
+
+
+    def _read(self, loop):
+        try:
+            for event in self.stream:
+                if self.closed:
+                    return
+                asyncio.run_coroutine_threadsafe(
+                    self.queue.put(event), loop
+                ).result()
+            item = _END_OF_STREAM
+        except Exception as e:
+            item = e
+        if self.closed:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self.queue.put(item), loop).result()
+        except RuntimeError:
+            # The loop went away while we were reading, nobody is listening
+            pass
+
+
+    def __aiter__(self):
+        return self
+
+
+    async def __anext__(self):
+        if self.closed:
+            raise StopAsyncIteration
+        if self._reader is None:
+            loop = asyncio.get_running_loop()
+            self._reader = loop.run_in_executor(self.executor, self._read, loop)
+        item = await self.queue.get()
+        if item is _END_OF_STREAM:
+            self.closed = True
+            raise StopAsyncIteration
+        if isinstance(item, Exception):
+            self.closed = True
+            raise item
+        return item
+
+
+    def ready(self) -> bool:
+        """
+        Whether an event can be taken without waiting.
+        """
+        return not self.queue.empty()
+
+
+    def close(self):
+        """
+        Stop reading and release the reader thread and the HTTP connection.
+        """
+        self.closed = True
+        # Wake a reader blocked on a full queue so it can see the flag
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        close = getattr(self.stream, "close", None)
+        if close is not None:
+            close()
+
+
+class ReplayStream:
+    """
+    Plays back a cached response as text chunks of `chunk_size` characters.
+    """
+
+    cache_key = None
+    output_tokens = None
+
+    def __init__(self, text: str, chunk_size: int = 16):
+        self.text = text
+        self.chunk_size = chunk_size
+
+
+    async def __aiter__(self):
+        for start in range(0, len(self.text), self.chunk_size):
+            yield self.text[start:start + self.chunk_size]
+            # Let other streams run between chunks like a live response would
+            await asyncio.sleep(0)
+
+
+    def close(self):
+        pass
+
+
+def _claude_text(chunk):
+    if chunk.get('type') == 'content_block_delta' and chunk['delta'].get('type') == 'text_delta':
+        return chunk['delta']['text']
+    return None
+
+
+def _llama_text(chunk):
+    return chunk.get("generation")
+
+
+def _titan_text(chunk):
+    return chunk.get("outputText")
+
+
+TEXT_PARSERS = {
+    CLAUDE: _claude_text,
+    DAISII: _llama_text,
+    TITAN: _titan_text,
+}
+
+# Claude streams many events without output, only the ones that may carry
+# text or the invocation metrics are parsed
+EVENT_MARKERS = {
+    CLAUDE: (b'"text_delta"', b'"amazon-bedrock-invocationMetrics"'),
+}
+
+
+async def process_stream(stream, model_type, max_chars: int = 0, max_delay: float = 0.03):
+    """
+    Yield the generated text of a Bedrock stream.
+
+    With `max_chars` set, deltas are coalesced: text is held back only
+    while more events are already waiting in the stream, and flushed once
+    `max_chars` characters are buffered or the oldest held text is
+    `max_delay` seconds old. An idle stream therefore adds no latency,
+    while a backlog goes out in few, larger HTTP chunks.
+    """
+    if not hasattr(stream, "__aiter__"):
+        stream = AsyncEventStream(stream)
+
+    events, chunks = 0, 0
+    try:
+        if isinstance(stream, ReplayStream):
+            async for text in stream:
+                chunks += 1
+                yield text
+            return
+
+        parse = TEXT_PARSERS[model_type]
+        markers = EVENT_MARKERS.get(model_type)
+        ready = getattr(stream, "ready", None)
+        buffer, size, started = [], 0, 0.0
+        async for event in stream:
+            events += 1
+            raw = event["chunk"]["bytes"]
+            if markers and not any(marker in raw for marker in markers):
+                continue
+            # Parsed once, the generated text may itself mention the metrics
+            chunk = loads(raw)
+            metrics = chunk.get("amazon-bedrock-invocationMetrics")
+            if metrics and metrics.get("outputTokenCount") is not None:
+                stream.output_tokens = metrics["outputTokenCount"]
+            text = parse(chunk)
+            if not text:
+                continue
+            if not max_chars:
+                chunks += 1
+                yield text
+                continue
+
+            if not buffer:
+                started = time.monotonic()
+            buffer.append(text)
+            size += len(text)
+            if (
+                size >= max_chars
+                or ready is None
+                or not ready()
+                or time.monotonic() - started >= max_delay
+            ):
+                chunks += 1
+                yield "".join(buffer)
+                buffer, size = [], 0
+        if buffer:
+            chunks += 1
+            yield "".join(buffer)
+    finally:
+        stream.close()
+        # Counted once per stream, not per event
+        STREAM_EVENTS.inc(model_type, amount=events)
+        STREAM_CHUNKS.inc(model_type, amount=chunks)
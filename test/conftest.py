@@ -0,0 +1,82 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# The app runs from api/, its modules import each other by top-level name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api"))
+
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "test")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "test")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+
+@pytest.fixture
+def dynamodb_service():
+    from moto import mock_aws
+
+    from aws_services.dynamodb import DynamoDBService
+
+    with mock_aws():
+        service = DynamoDBService("us-east-1", "test-chat")
+        service.create_table()
+        yield service
+
+
+@pytest.fixture(scope="session")
+def app_module(tmp_path_factory):
+    os.environ.setdefault("WRITE_BEHIND_LOG_DIR", str(tmp_path_factory.mktemp("write_behind")))
+    os.environ.setdefault("BLOB_STORE_DIR", str(tmp_path_factory.mktemp("blobs")))
+    # The app starts outside any AWS mock, see `client`
+    for variable in ("BEDROCK", "DYNAMODB", "AURORA_DATABASE"):
+        os.environ.setdefault(f"{variable}_WARM_CONNECTIONS", "0")
+    from moto import mock_aws
+
+    from benchmarks import fakes
+
+    module = fakes.install(tokens_per_second=0, first_token=0, tokens=5, users=2)
+    # install() leaves AWS mocked for good, each test gets its own mock instead
+    mock_aws().stop()
+    return module
+
+
+@pytest.fixture
+def api(app_module):
+    """
+    The app module with every backend replaced by a local stand-in, see
+    benchmarks/fakes.py. It is imported once, DynamoDB starts empty for
+    each test while Redis and the users are shared, so tests use their own
+    conversations.
+    """
+    from moto import mock_aws
+
+    with mock_aws():
+        app_module.dynamodb_service.create_table()
+        yield app_module
+
+
+@pytest.fixture(scope="session")
+def started_client(app_module):
+    from fastapi.testclient import TestClient
+
+    with TestClient(app_module.app) as client:
+        yield client
+
+
+@pytest.fixture
+def client(api, started_client):
+    """
+    A TestClient of the app. It is started once, the app's Redis pool and
+    queues belong to the event loop that runs it.
+    """
+    yield started_client
+
+    async def settle():
+        # Replies saved after their request, and the writes behind them,
+        # go to this test's DynamoDB
+        if api.background_tasks:
+            await asyncio.wait(set(api.background_tasks))
+        await api.write_queue.flush()
+
+    started_client.portal.call(settle)
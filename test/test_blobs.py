@@ -0,0 +1,127 @@
+import asyncio
+import base64
+import os
+
+import pytest
+
+from blobs import BlobStore, LocalObjectStore, image_refs
+from codec import loads
+from models.chat import ChatMessage
+from serialization import MessageEncoder
+
+
+def image(size: int = 1024) -> str:
+    return base64.b64encode(os.urandom(size)).decode()
+
+
+def message(source: dict) -> ChatMessage:
+    return ChatMessage.model_validate({
+        "role": "user",
+        "content": [{"type": "image", "source": {"media_type": "image/png", **source}}],
+    })
+
+
+def test_references_are_scoped_to_the_user_who_stored_them(tmp_path):
+    backend = LocalObjectStore(str(tmp_path))
+
+    async def main():
+        store = BlobStore(backend, "blobs")
+        inline = message({"type": "base64", "data": image()})
+        await store.externalize("u1", [inline])
+        ref = inline.content[0].source.ref
+
+        await store.externalize("u1", [message({"type": "blob", "ref": ref})])
+        with pytest.raises(ValueError):
+            await store.externalize("u2", [message({"type": "blob", "ref": ref})])
+        # A worker that never saw the image reads the ownership from the backend
+        other_worker = BlobStore(backend, "blobs")
+        await other_worker.check("u1", ref)
+        with pytest.raises(ValueError):
+            await other_worker.check("u2", ref)
+        return store.stats()
+
+    stats = asyncio.run(main())
+
+    assert stats["stored"] == 1
+
+
+def test_same_image_of_two_users_is_stored_once(tmp_path):
+    data = image()
+
+    async def main():
+        store = BlobStore(LocalObjectStore(str(tmp_path)), "blobs")
+        refs = [await store.put(user_id, data, "image/png") for user_id in ("u1", "u2")]
+        for user_id in ("u1", "u2"):
+            await store.check(user_id, refs[0])
+        return refs, store.stats()
+
+    refs, stats = asyncio.run(main())
+
+    assert refs[0] == refs[1]
+    assert (stats["stored"], stats["deduplicated"]) == (1, 1)
+
+
+def test_loaded_images_survive_eviction_until_encoded(tmp_path):
+    first, second = image(3000), image(3000)
+
+    async def main():
+        # Room for a single image, storing another evicts the previous one
+        store = BlobStore(LocalObjectStore(str(tmp_path)), "blobs", max_cached_bytes=5000)
+        encoder = MessageEncoder(images=store.get)
+        messages = [message({"type": "base64", "data": first})]
+        await store.externalize("u1", messages)
+
+        images = await store.load(image_refs(encoder.pending("c1", messages)))
+        await store.put("u2", second, "image/png")
+        assert store.get(messages[0].content[0].source.ref) is None
+        return encoder.claude("c1", messages, images=images.get)
+
+    encoded = asyncio.run(main())
+
+    assert loads(encoded[0])["content"][0]["source"]["data"] == first
+
+
+def test_open_fetches_an_image_for_its_owner(tmp_path):
+    backend = LocalObjectStore(str(tmp_path))
+    gif = b"GIF89a" + os.urandom(512)
+
+    async def main():
+        ref = await BlobStore(backend, "blobs").put("u1", base64.b64encode(gif).decode(), "image/gif")
+        # A worker without the image in memory
+        other_worker = BlobStore(backend, "blobs")
+        opened = await other_worker.open("u1", ref)
+        with pytest.raises(ValueError):
+            await other_worker.open("u2", ref)
+        return opened, other_worker.stats()
+
+    (data, media_type), stats = asyncio.run(main())
+
+    assert (data, media_type) == (gif, "image/gif")
+    assert stats["fetched"] == 1
+
+
+def login(client, email):
+    token = client.post("/token", data={"username": email, "password": "benchmark"}).json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+
+def test_history_images_are_served_to_their_owner_only(client):
+    png = b"\x89PNG\r\n\x1a\n" + os.urandom(2048)
+    owner = login(client, "bench0@example.com")
+    turn = {"message": {"role": "user", "content": [
+        {"type": "text", "text": "What is this?"},
+        {"type": "image", "source": {"media_type": "image/png", "data": base64.b64encode(png).decode()}},
+    ]}}
+    assert client.post("/chat/images-c1/turn?model=Claude", json=turn, headers=owner).status_code == 200
+    history = client.get("/chat/images-c1", headers=owner).json()
+    ref = history["messages"][0]["content"][1]["source"]["ref"]
+
+    response = client.get(f"/images/{ref}", headers=owner)
+    other = client.get(f"/images/{ref}", headers=login(client, "bench1@example.com"))
+    unknown = client.get(f"/images/sha256:{'0' * 64}", headers=owner)
+    invalid = client.get("/images/not-a-ref", headers=owner)
+
+    assert response.status_code == 200
+    assert response.content == png
+    assert response.headers["content-type"] == "image/png"
+    assert [r.status_code for r in (other, unknown, invalid)] == [404, 404, 404]
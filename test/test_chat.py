@@ -0,0 +1,167 @@
+import asyncio
+
+import fakeredis
+
+from redis.exceptions import ConnectionError
+
+from models.chat import ChatMessage, ChatService
+from models.write_behind import WriteBehindQueue
+
+
+def message(role, content):
+    return ChatMessage(role=role, content=content)
+
+
+async def run_chat_service(dynamodb_service, log_dir, exercise):
+    write_queue = WriteBehindQueue(dynamodb_service, str(log_dir))
+    await write_queue.start()
+    try:
+        return await exercise(ChatService(fakeredis.FakeAsyncRedis(), dynamodb_service, write_queue))
+    finally:
+        await write_queue.stop()
+
+
+def test_turn_is_appended_whatever_history_the_client_sent(dynamodb_service, tmp_path):
+    async def exercise(chat_service):
+        await chat_service.save_chat_history("u1", "c1", [
+            message("user", "one"), message("assistant", "two"),
+            message("user", "three"), message("assistant", "four"),
+        ])
+        # The client only had the last page, plus its new message and the reply
+        page = [message("assistant", "four"), message("user", "five")]
+        await chat_service.save_chat_history("u1", "c1", (page + [message("assistant", "six")])[-2:])
+        return await chat_service.get_chat_history("u1", "c1")
+
+    history = asyncio.run(run_chat_service(dynamodb_service, tmp_path, exercise))
+
+    assert [m.content for m in history.messages] == ["one", "two", "three", "four", "five", "six"]
+    items = dynamodb_service.get_chat_history("u1", "c1")
+    assert [(int(item["seq"]), item["message"]) for item in items][-2:] == [
+        (4, message("user", "five").model_dump_json()),
+        (5, message("assistant", "six").model_dump_json()),
+    ]
+
+
+class DownRedis:
+    """
+    Redis that refuses every command.
+    """
+
+    def __getattr__(self, name):
+        async def command(*args, **kwargs):
+            raise ConnectionError("Connection refused")
+        return command
+
+
+    def pipeline(self, *args, **kwargs):
+        return fakeredis.FakeAsyncRedis(connected=False).pipeline(*args, **kwargs)
+
+
+def test_concurrent_turns_get_their_own_sequence_numbers(dynamodb_service, tmp_path):
+    server = fakeredis.FakeServer()
+    dynamodb_service.batch_write(dynamodb_service.message_items(
+        "c1", "u1", 0, [message("user", "stored").model_dump_json()]
+    ))
+
+    async def main():
+        # Two workers, the cached list has expired
+        queues = [WriteBehindQueue(dynamodb_service, str(tmp_path / f"worker-{i}")) for i in range(2)]
+        for queue in queues:
+            await queue.start()
+        services = [ChatService(fakeredis.FakeAsyncRedis(server=server), dynamodb_service, queue) for queue in queues]
+        try:
+            await asyncio.gather(*(
+                services[i % 2].save_chat_history("u1", "c1", [
+                    message("user", f"question {i}"), message("assistant", f"answer {i}")
+                ])
+                for i in range(10)
+            ))
+        finally:
+            for queue in queues:
+                await queue.stop()
+        return await services[0].get_chat_history("u1", "c1")
+
+    history = asyncio.run(main())
+
+    contents = [m.content for m in history.messages]
+    assert contents[0] == "stored" and len(contents) == 21
+    # Each turn's messages stay together
+    for i in range(10):
+        assert contents.index(f"answer {i}") == contents.index(f"question {i}") + 1
+    items = dynamodb_service.get_chat_history("u1", "c1")
+    assert [int(item["seq"]) for item in items] == list(range(21))
+    assert [item["message"] for item in items] == [m.model_dump_json() for m in history.messages]
+
+
+def test_turns_without_redis_count_unwritten_messages(dynamodb_service, tmp_path):
+    async def main():
+        queue = WriteBehindQueue(dynamodb_service, str(tmp_path), flush_interval=60)
+        await queue.start()
+        chat_service = ChatService(fakeredis.FakeAsyncRedis(), dynamodb_service, queue)
+        try:
+            await chat_service.save_chat_history("u1", "c1", [message("user", "one"), message("assistant", "two")])
+            assert dynamodb_service.get_chat_history("u1", "c1") == []
+
+            chat_service.redis = DownRedis()
+            await asyncio.gather(*(
+                chat_service.save_chat_history("u1", "c1", [message("user", f"turn {i}")])
+                for i in range(3)
+            ))
+            fallback = await chat_service._load_fallback("u1", "c1")
+        finally:
+            await queue.stop()
+        return fallback
+
+    fallback = asyncio.run(main())
+
+    assert len(fallback) == 5
+    items = dynamodb_service.get_chat_history("u1", "c1")
+    assert [int(item["seq"]) for item in items] == list(range(5))
+    assert [item["message"] for item in items] == fallback
+
+
+def test_page_cursors_walk_the_conversation_from_redis_and_dynamodb(dynamodb_service, tmp_path):
+    async def walk(chat_service, limit, before=None):
+        pages = []
+        while True:
+            page = await chat_service.get_chat_history_page("u1", "c1", before, limit)
+            pages.append(([m.content for m in page.messages], page.first_seq, page.before))
+            if page.before is None:
+                return pages
+            before = page.before
+
+    async def seqs(chat_service, before, limit, chunk_size):
+        return [
+            seq async for seq, _ in chat_service.iter_messages("u1", "c1", before, limit, chunk_size)
+        ]
+
+    async def exercise(chat_service):
+        await chat_service.save_chat_history("u1", "c1", [message("user", str(i)) for i in range(7)])
+        cached = (
+            await walk(chat_service, 3),
+            await walk(chat_service, 7),
+            await walk(chat_service, 3, before=100),
+            await seqs(chat_service, 6, 4, 2),
+        )
+        await chat_service.write_queue.flush()
+        await chat_service.redis.delete(chat_service._cache_key("u1", "c1"))
+        stored = (
+            await walk(chat_service, 3),
+            await walk(chat_service, 7),
+            await walk(chat_service, 3, before=100),
+            await seqs(chat_service, 6, 4, 2),
+        )
+        empty = await chat_service.get_chat_history_page("u1", "c2")
+        return cached, stored, empty
+
+    cached, stored, empty = asyncio.run(run_chat_service(dynamodb_service, tmp_path, exercise))
+
+    by_three = [(["4", "5", "6"], 4, 4), (["1", "2", "3"], 1, 1), (["0"], 0, None)]
+    for pages in (cached, stored):
+        assert pages[0] == by_three
+        assert pages[1] == [([str(i) for i in range(7)], 0, None)]
+        # A cursor past the end starts from the newest message
+        assert pages[2] == by_three
+        # Chunks smaller than the page still stop at the cursor and the limit
+        assert pages[3] == [5, 4, 3, 2]
+    assert (empty.messages, empty.first_seq, empty.before) == ([], 0, None)
@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+
+from starlette.websockets import WebSocketDisconnect
+
+
+def login(client, email="bench0@example.com"):
+    return client.post("/token", data={"username": email, "password": "benchmark"}).json()["access_token"]
+
+
+def authenticate(websocket, token):
+    websocket.send_json({"type": "auth", "token": token})
+    assert websocket.receive_json() == {"type": "ready"}
+
+
+def chat(websocket, request_id, conversation_id, content):
+    websocket.send_json({
+        "type": "chat",
+        "id": request_id,
+        "conversation_id": conversation_id,
+        "model": "Titan",
+        "message": {"role": "user", "content": content},
+    })
+
+
+def history(client, token, conversation_id):
+    response = client.get(f"/chat/{conversation_id}", headers={"Authorization": f"Bearer {token}"})
+    return [message["content"] for message in response.json()["messages"]]
+
+
+@pytest.fixture
+def slow_model(api, monkeypatch):
+    """
+    Paces the fake Bedrock stream, 5 tokens take about a second, so turns
+    are still streaming while the test acts on them.
+    """
+    monkeypatch.setattr(api.bedrock_service.bedrock_runtime, "tokens_per_second", 5)
+
+
+def test_turns_stream_interleaved_on_one_connection(client, slow_model):
+    token = login(client)
+    received = []
+    with client.websocket_connect("/ws/chat") as websocket:
+        authenticate(websocket, token)
+        # Prompts of their own, a cached reply would not stream
+        chat(websocket, "a", "socket-c1", "interleaved one")
+        chat(websocket, "b", "socket-c2", "interleaved two")
+        chat(websocket, "a", "socket-c3", "same id")
+        while sum(message["type"] == "done" for message in received) < 2:
+            received.append(websocket.receive_json())
+
+    errors = [message for message in received if message["type"] == "error"]
+    assert errors == [{"type": "error", "id": "a", "status": 400, "detail": "Duplicate id"}]
+    replies = {}
+    for request_id, content, conversation_id in (("a", "interleaved one", "socket-c1"), ("b", "interleaved two", "socket-c2")):
+        messages = [message for message in received if message["id"] == request_id and message["type"] != "error"]
+        assert messages[0] == {"type": "start", "id": request_id, "seq": 0}
+        assert messages[-1] == {"type": "done", "id": request_id, "seq": 1, "cancelled": False}
+        replies[request_id] = "".join(message["text"] for message in messages[1:-1])
+        assert history(client, token, conversation_id) == [content, replies[request_id]]
+    # Neither turn waited for the other to finish
+    deltas = [message["id"] for message in received if message["type"] == "delta"]
+    assert deltas.index("b") < len(deltas) - 1 - deltas[::-1].index("a")
+
+
+def test_connection_is_closed_once_the_user_is_disabled(api, client):
+    email = "bench1@example.com"
+    token = login(client, email)
+    with client.websocket_connect("/ws/chat") as websocket:
+        websocket.send_json({"type": "auth", "token": "not a token"})
+        with pytest.raises(WebSocketDisconnect) as refused:
+            websocket.receive_json()
+    assert refused.value.code == 4401
+
+    with client.websocket_connect("/ws/chat") as websocket:
+        authenticate(websocket, token)
+        # The token stays valid, the next turn checks the user again
+        api.user_database.db.db.execute("UPDATE users SET disabled = 1 WHERE email = ?", (email,))
+        client.portal.call(api.user_cache.invalidate, email)
+        try:
+            chat(websocket, "a", "socket-c4", "one")
+            with pytest.raises(WebSocketDisconnect) as closed:
+                websocket.receive_json()
+        finally:
+            api.user_database.db.db.execute("UPDATE users SET disabled = 0 WHERE email = ?", (email,))
+            client.portal.call(api.user_cache.invalidate, email)
+
+    assert (closed.value.code, closed.value.reason) == (4400, "Inactive user")
+    assert history(client, token, "socket-c4") == []
+
+
+def test_partial_reply_is_saved_when_the_connection_drops(api, client, slow_model):
+    token = login(client)
+    with client.websocket_connect("/ws/chat") as websocket:
+        authenticate(websocket, token)
+        chat(websocket, "a", "socket-c5", "dropped")
+        assert websocket.receive_json()["type"] == "start"
+        delta = websocket.receive_json()
+        assert delta["type"] == "delta"
+
+    async def saved():
+        while api.background_tasks:
+            await asyncio.wait(set(api.background_tasks))
+
+    client.portal.call(saved)
+    messages = history(client, token, "socket-c5")
+    full = client.post(
+        "/chat/socket-c6/turn?model=Titan",
+        json={"message": {"role": "user", "content": "dropped"}},
+        headers={"Authorization": f"Bearer {token}"}
+    ).text
+    assert messages[0] == "dropped"
+    assert messages[1].startswith(delta["text"])
+    assert full.startswith(messages[1]) and len(messages[1]) < len(full)
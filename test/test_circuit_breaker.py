@@ -0,0 +1,193 @@
+import asyncio
+import json
+import time
+
+import fakeredis
+
+from cache import CircuitBreaker, CircuitOpenError, GuardedRedis
+from models.chat import ChatMessage, ChatService
+from models.write_behind import WriteBehindQueue
+
+
+class HangingRedis:
+    """
+    fakeredis whose commands and pipelines never answer while `hanging`,
+    like a Redis that accepts connections but is stuck.
+    """
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self.hanging = False
+
+
+    async def _wait(self):
+        while self.hanging:
+            await asyncio.sleep(0.01)
+
+
+    def __getattr__(self, name):
+        attribute = getattr(self.redis, name)
+        if not callable(attribute):
+            return attribute
+
+        async def command(*args, **kwargs):
+            await self._wait()
+            return await attribute(*args, **kwargs)
+        return command
+
+
+    def pipeline(self, *args, **kwargs):
+        pipe = self.redis.pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        async def hanging_execute(*args, **kwargs):
+            await self._wait()
+            return await execute(*args, **kwargs)
+        pipe.execute = hanging_execute
+        return pipe
+
+
+def chat_service(dynamodb_service, tmp_path, redis_client, **breaker_options):
+    breaker = CircuitBreaker(redis_client.ping, **breaker_options)
+    service = ChatService(
+        GuardedRedis(redis_client, breaker),
+        dynamodb_service,
+        WriteBehindQueue(dynamodb_service, str(tmp_path))
+    )
+    breaker.on_close(service.recovered)
+    return service, breaker
+
+
+def store(dynamodb_service, user_id, conversation_id, *contents):
+    dynamodb_service.batch_write(dynamodb_service.message_items(
+        conversation_id, user_id, 0,
+        [json.dumps({"role": "user", "content": content}) for content in contents]
+    ))
+
+
+async def wait_for(predicate, timeout: float = 2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.01)
+
+
+def test_breaker_opens_probes_and_closes():
+    up = False
+    probes = 0
+    closed = []
+
+    async def ping():
+        nonlocal probes
+        probes += 1
+        if not up:
+            raise ConnectionError("Connection refused")
+        return True
+
+    async def down():
+        raise ConnectionError("Connection refused")
+
+    async def on_close():
+        closed.append(True)
+
+    async def main():
+        nonlocal up
+        breaker = CircuitBreaker(ping, failure_threshold=2, timeout=0.1, probe_interval=0.02)
+        breaker.on_close(on_close)
+        for _ in range(2):
+            try:
+                await breaker.call(down)
+            except ConnectionError:
+                pass
+        opened = breaker.stats()
+
+        # Open: calls are rejected without reaching Redis
+        try:
+            await breaker.call(down)
+        except CircuitOpenError:
+            pass
+        # Half open: the probes keep failing while Redis is down
+        await wait_for(lambda: probes >= 3)
+        still_open = breaker.stats()
+
+        up = True
+        await wait_for(lambda: breaker.state == "closed")
+        return opened, still_open, breaker.stats(), await breaker.call(ping)
+
+    opened, still_open, closed_stats, answer = asyncio.run(main())
+
+    assert opened["open"] and opened["trips"] == 1
+    assert still_open["open"] and still_open["rejected"] == 1
+    assert not closed_stats["open"] and closed_stats["failures"] == 0
+    assert closed == [True]
+    assert answer is True
+
+
+def test_redis_down_falls_back_and_recovers(dynamodb_service, tmp_path):
+    server = fakeredis.FakeServer()
+    redis_client = fakeredis.FakeAsyncRedis(server=server)
+    store(dynamodb_service, "u1", "c1", "hi")
+
+    async def main():
+        service, breaker = chat_service(
+            dynamodb_service, tmp_path, redis_client,
+            failure_threshold=2, timeout=0.2, probe_interval=0.05
+        )
+        await service.write_queue.start()
+        try:
+            assert [m.content for m in (await service.get_chat_history("u1", "c1")).messages] == ["hi"]
+
+            server.connected = False
+            for _ in range(3):
+                history = await service.get_chat_history("u1", "c1")
+                assert [m.content for m in history.messages] == ["hi"]
+            await service.save_chat_history("u1", "c1", [ChatMessage(role="user", content="while down")])
+            opened = breaker.stats()
+            await asyncio.sleep(0.2)
+            assert breaker.state == "open"
+
+            server.connected = True
+            await wait_for(lambda: breaker.state == "closed")
+            await service.write_queue.flush()
+            history = await service.get_chat_history("u1", "c1")
+            return opened, history
+        finally:
+            await service.write_queue.stop()
+
+    opened, history = asyncio.run(main())
+
+    assert opened["open"] and opened["rejected"] >= 1
+    # The list that missed a message was dropped and rebuilt from DynamoDB
+    assert [m.content for m in history.messages] == ["hi", "while down"]
+
+
+def test_redis_timing_out_is_cut_short(dynamodb_service, tmp_path):
+    redis_client = HangingRedis(fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer()))
+    store(dynamodb_service, "u1", "c1", "hi")
+
+    async def main():
+        service, breaker = chat_service(
+            dynamodb_service, tmp_path, redis_client,
+            failure_threshold=2, timeout=0.1, probe_interval=0.05
+        )
+        redis_client.hanging = True
+        durations = []
+        for _ in range(4):
+            started = time.perf_counter()
+            history = await service.get_chat_history("u1", "c1")
+            durations.append(time.perf_counter() - started)
+            assert [m.content for m in history.messages] == ["hi"]
+        # Probes time out as well, the circuit stays open
+        await asyncio.sleep(0.3)
+        still_open = breaker.state
+
+        redis_client.hanging = False
+        await wait_for(lambda: breaker.state == "closed")
+        return durations, still_open
+
+    durations, still_open = asyncio.run(main())
+
+    # Each call waits at most the breaker timeout, then none at all
+    assert all(duration < 0.5 for duration in durations[:2])
+    assert all(duration < 0.05 for duration in durations[2:])
+    assert still_open == "open"
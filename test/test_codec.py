@@ -0,0 +1,69 @@
+import pytest
+
+import codec
+
+from codec import MAGIC, VERSION, CacheCodec
+
+
+DOCUMENT = b'{"role":"user","content":"' + b"How does this work? " * 100 + b'"}'
+
+
+@pytest.mark.parametrize("encoding", ["json", "msgpack"])
+@pytest.mark.parametrize("compression", ["none", "zlib", "zstd", "lz4"])
+def test_every_format_is_read_by_any_codec(encoding, compression):
+    entry = CacheCodec(encoding, compression).encode(DOCUMENT)
+
+    assert entry[:2] == bytes((MAGIC, VERSION))
+    assert codec.loads(CacheCodec("json", "none").decode(entry)) == codec.loads(DOCUMENT)
+    if compression != "none":
+        assert len(entry) < len(DOCUMENT)
+
+
+def test_entries_without_a_header_pass_through():
+    reader = CacheCodec()
+
+    assert reader.decode(DOCUMENT) == DOCUMENT
+    assert reader.decode(DOCUMENT.decode()) == DOCUMENT.decode()
+    assert reader.decode(b"") == b""
+    # Only the magic byte marks an entry, a wrong one is taken as a document
+    assert reader.decode(bytes((MAGIC + 1, VERSION, 0, 0)) + DOCUMENT)[:1] == bytes((MAGIC + 1,))
+
+
+def test_unknown_version_is_refused():
+    entry = CacheCodec().encode(DOCUMENT)
+
+    with pytest.raises(ValueError, match="version 2"):
+        CacheCodec().decode(entry[:1] + bytes((VERSION + 1,)) + entry[2:])
+
+
+def test_small_or_incompressible_bodies_are_stored_uncompressed():
+    writer = CacheCodec("json", "zlib", min_compress_size=0)
+    small = CacheCodec("json", "zlib").encode(b'{"role":"user","content":"hi"}')
+    # zlib adds more than it saves on a two byte body
+    tiny = writer.encode(b"{}")
+
+    assert small[3] == codec.COMPRESSIONS["none"]
+    assert tiny == bytes((MAGIC, VERSION, 0, codec.COMPRESSIONS["none"])) + b"{}"
+    assert writer.decode(tiny) == b"{}"
+
+
+def test_missing_compressor_falls_back_to_zlib(monkeypatch):
+    zstd_entry = CacheCodec("json", "zstd").encode(DOCUMENT)
+    monkeypatch.setattr(codec, "zstandard", None)
+    monkeypatch.setattr(codec, "msgpack", None)
+
+    writer = CacheCodec("msgpack", "zstd")
+    entry = writer.encode(DOCUMENT)
+
+    assert (writer.encoding, writer.compression) == ("json", "zlib")
+    assert entry[2:4] == bytes((codec.ENCODINGS["json"], codec.COMPRESSIONS["zlib"]))
+    assert writer.decode(entry) == DOCUMENT
+    with pytest.raises(ValueError, match="zstandard is not installed"):
+        writer.decode(zstd_entry)
+
+
+def test_unknown_settings_are_refused():
+    with pytest.raises(ValueError):
+        CacheCodec("xml")
+    with pytest.raises(ValueError):
+        CacheCodec("json", "brotli")
@@ -0,0 +1,101 @@
+import asyncio
+
+import fakeredis
+
+from cache import ConversationMemo
+from config import CLAUDE, TITAN
+from context_window import ContextWindow
+from models.chat import ChatMessage
+from prompt import PromptRenderer
+
+
+def conversation(*contents):
+    return [
+        ChatMessage(role="user" if i % 2 == 0 else "assistant", content=content)
+        for i, content in enumerate(contents)
+    ]
+
+
+def test_edited_turn_is_rendered_again():
+    renderer = PromptRenderer()
+    first = renderer.titan("c1", "Be nice.", conversation("What is 2+2?"))
+    edited = renderer.titan("c1", "Be nice.", conversation("Tell me a joke"))
+
+    assert "What is 2+2?" in first
+    assert edited == "Be nice.\nUser: Tell me a joke\nBot:"
+
+
+def test_turns_before_an_edit_are_reused():
+    renderer = PromptRenderer()
+    messages = conversation("one", "two", "three")
+    renderer.titan("c1", "", messages)
+    turns = renderer.turns.values(("titan", "c1"), conversation("one", "two", "changed"))
+
+    assert turns[:2] == ["User: one\n", "Bot: two\n"]
+    assert turns[2] is None
+
+
+comparisons = []
+
+
+class Counted(ChatMessage):
+    def __eq__(self, other):
+        comparisons.append(self)
+        return super().__eq__(other)
+
+
+def test_growing_conversation_is_not_compared_in_full():
+    memo = ConversationMemo()
+
+    def request(*contents):
+        # Each request parses a fresh copy of the history
+        return [Counted(role="user", content=content) for content in contents]
+
+    values = memo.values("c1", request(*map(str, range(100))))
+    values[:] = range(100)
+    comparisons.clear()
+    values = memo.values("c1", request(*map(str, range(101))))
+
+    assert len(comparisons) == 1
+    assert values.count(None) == 1
+
+
+def test_edited_turn_is_counted_again():
+    window = ContextWindow(None, budgets={TITAN: 20})
+
+    async def fit(*contents):
+        context, _ = await window.fit(TITAN, "u1", "c1", conversation(*contents))
+        return [m.content for m in context]
+
+    assert asyncio.run(fit("hi", "hello", "short")) == ["hi", "hello", "short"]
+    # The same position now holds a message over the budget on its own
+    assert asyncio.run(fit("hi", "hello", "long " * 40)) == ["long " * 40]
+
+
+def test_summary_follows_the_model_and_the_history():
+    window = ContextWindow(fakeredis.FakeAsyncRedis(), budgets={TITAN: 40, CLAUDE: 20}, summarize=True)
+    words = [f"m{i} " + "word " * 10 for i in range(6)]
+
+    async def summarized(model, *contents):
+        context, summary = await window.fit(model, "u1", "c1", conversation(*contents))
+        return [line.split()[1] for line in summary.splitlines()], len(context)
+
+    async def main():
+        return [
+            await summarized(TITAN, *words),
+            # A smaller window folds in more messages, kept apart from TITAN's
+            await summarized(CLAUDE, *words),
+            await summarized(TITAN, *words),
+            # The window moved back once the long reply was edited
+            await summarized(TITAN, *words[:5], "long " * 100),
+            await summarized(TITAN, *words),
+            # A history that differs from the summarized one
+            await summarized(TITAN, *words[:3], "edited", *words[4:]),
+        ]
+
+    (titan, _), (claude, _), (again, _), (long, sent), (short, _), (edited, _) = asyncio.run(main())
+
+    assert titan == again == short == ["m0", "m1", "m2", "m3"]
+    assert claude == long == ["m0", "m1", "m2", "m3", "m4"]
+    assert sent == 1
+    assert edited == ["m0", "m1", "m2", "edited"]
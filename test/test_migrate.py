@@ -0,0 +1,94 @@
+import json
+
+import pytest
+
+from moto import mock_aws
+
+from aws_services.dynamodb import DynamoDBService
+from migrate import split_tables
+
+
+def legacy_table(dynamodb, name):
+    """
+    A table as the old service created them, keyed by conversation_id.
+    """
+    return dynamodb.create_table(
+        TableName=name,
+        KeySchema=[{'AttributeName': 'conversation_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'conversation_id', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+
+def messages(service, userid, conversation_id):
+    return [
+        (int(item['seq']), json.loads(item['message'])['content'])
+        for item in service.get_chat_history(userid, conversation_id)
+    ]
+
+
+@pytest.fixture
+def aws():
+    with mock_aws():
+        yield
+
+
+def test_items_are_filed_under_their_own_conversation(aws):
+    service = DynamoDBService("us-east-1", "chat")
+    legacy_table(service.dynamodb, "chat_c1").put_item(Item={
+        'conversation_id': 'c1',
+        'userid': 'u1',
+        'messages': [{'role': 'user', 'content': 'one'}, {'role': 'assistant', 'content': 'two'}],
+    })
+    # Written to c1's table by the shared table race
+    legacy_table(service.dynamodb, "chat_c3").put_item(Item={
+        'conversation_id': 'c2',
+        'userid': 'u2',
+        'messages': [{'role': 'user', 'content': 'misfiled'}],
+    })
+
+    split_tables(service, delete_source=True)
+
+    assert messages(service, 'u1', 'c1') == [(0, 'one'), (1, 'two')]
+    assert messages(service, 'u2', 'c2') == [(0, 'misfiled')]
+    assert messages(service, 'u2', 'c3') == []
+    assert service.table.get_item(Key={'user_id': 'u2', 'sk': 'c2#meta'}).get('Item')
+    tables = service.dynamodb.meta.client.list_tables()['TableNames']
+    assert tables == ["chat"]
+
+
+def test_legacy_base_table_is_migrated_into_a_new_table(aws):
+    service = DynamoDBService("us-east-1", "chat-v2")
+    legacy_table(service.dynamodb, "chat").put_item(Item={
+        'conversation_id': 'c1',
+        'userid': 'u1',
+        'messages': [{'role': 'user', 'content': 'in the base table'}],
+    })
+    legacy_table(service.dynamodb, "chat_c2").put_item(Item={
+        'conversation_id': 'c2',
+        'userid': 'u1',
+        'messages': [{'role': 'user', 'content': 'in its own table'}],
+    })
+
+    split_tables(service, source="chat")
+
+    assert messages(service, 'u1', 'c1') == [(0, 'in the base table')]
+    assert messages(service, 'u1', 'c2') == [(0, 'in its own table')]
+
+
+def test_legacy_base_table_is_not_used_as_the_single_table(aws):
+    service = DynamoDBService("us-east-1", "chat")
+    legacy_table(service.dynamodb, "chat")
+
+    with pytest.raises(RuntimeError, match="legacy key schema"):
+        service.create_table()
+    with pytest.raises(RuntimeError, match="legacy key schema"):
+        split_tables(service)
+
+
+def test_existing_single_table_is_reused(aws):
+    service = DynamoDBService("us-east-1", "chat")
+    service.create_table()
+    service.create_table()
+
+    assert service.has_current_schema("chat")
@@ -0,0 +1,89 @@
+import pytest
+
+from models.provisioning import parse_users
+
+
+def test_invalid_and_repeated_rows_are_reported_by_line():
+    data = (
+        b"email,username,password\n"
+        b"ann@example.com,ann,secret\n"
+        b"not an email,bob,secret\n"
+        b"ANN@example.com,ann2,secret\n"
+        b"cat@example.com,,secret\n"
+    )
+
+    users, errors = parse_users(data, "csv")
+
+    assert [(line, user.email) for line, user in users] == [(2, "ann@example.com")]
+    assert [(error["line"], error["email"]) for error in errors] == [
+        (3, "not an email"), (4, "ANN@example.com"), (5, "cat@example.com")
+    ]
+    assert errors[1]["error"] == "Duplicate email in input"
+
+
+def test_unreadable_ndjson_lines_fail_on_their_own():
+    data = (
+        b'{"email": "ann@example.com", "username": "ann", "password": "secret"}\n'
+        b"\n"
+        b"not json\n"
+        b'{"email": "b\xffb@example.com", "username": "bob", "password": "secret"}\n'
+    )
+
+    users, errors = parse_users(data, "ndjson")
+
+    assert [line for line, _ in users] == [1]
+    assert [error["line"] for error in errors] == [3, 4]
+    assert all(error["error"].startswith("Invalid JSON") for error in errors)
+
+
+@pytest.mark.parametrize("data, message", [
+    (b"email,username,password\n\xff@example.com,ann,secret\n", "CSV is not UTF-8"),
+    (b"email,username,password\nann@example.com,ann," + b"x" * 200 * 1024 + b"\n", "Invalid CSV after line 1"),
+], ids=["not utf-8", "field over the limit"])
+def test_unreadable_csv_is_rejected_whole(data, message):
+    with pytest.raises(ValueError, match=message):
+        parse_users(data, "csv")
+
+
+def admin_headers(api, monkeypatch, client):
+    monkeypatch.setattr(api, "admin_emails", {"bench0@example.com"})
+    token = client.post(
+        "/token", data={"username": "bench0@example.com", "password": "benchmark"}
+    ).json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+
+def test_partial_failures_are_reported_with_the_created_users(api, client, monkeypatch):
+    data = (
+        b"email,username,password\n"
+        b"provisioned0@example.com,p0,secret\n"
+        b"bench1@example.com,taken,secret\n"
+        b"provisioned0@example.com,again,secret\n"
+        b"not an email,p1,secret\n"
+        b"provisioned1@example.com,p1,secret\n"
+    )
+    headers = admin_headers(api, monkeypatch, client)
+    response = client.post("/admin/users", content=data, headers={**headers, "Content-Type": "text/csv"})
+    login = client.post("/token", data={"username": "provisioned1@example.com", "password": "secret"})
+
+    assert response.status_code == 200
+    report = response.json()
+    assert (report["created"], report["failed"]) == (2, 3)
+    assert [(error["line"], error["error"]) for error in report["errors"]][:2] == [
+        (3, "Email already registered"), (4, "Duplicate email in input")
+    ]
+    assert report["errors"][2]["line"] == 5
+    assert login.status_code == 200
+
+
+@pytest.mark.parametrize("data, content_type, status_code", [
+    (b"email,username,password\n\xff,ann,secret\n", "text/csv", 400),
+    (b"email,username,password\nann@example.com,ann," + b"x" * 200 * 1024 + b"\n", "text/csv", 400),
+    (b"not json\n", "application/x-ndjson", 200),
+    (b"email,username,password\n", "application/json", 415),
+], ids=["csv not utf-8", "csv field over the limit", "ndjson not json", "unknown type"])
+def test_unreadable_bodies_are_client_errors(api, client, monkeypatch, data, content_type, status_code):
+    headers = admin_headers(api, monkeypatch, client)
+    response = client.post("/admin/users", content=data, headers={**headers, "Content-Type": content_type})
+
+    assert response.status_code == status_code
@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+from aws_services.clients import ClientFactory
+from aws_services.rds import AuroraPostgres
+from benchmarks.fakes import FakeRdsData
+
+
+class SlowRdsData(FakeRdsData):
+    """
+    A Data API answering each statement after `delay` seconds.
+    """
+
+    def __init__(self, delay: float):
+        super().__init__()
+        self.delay = delay
+
+
+    def execute_statement(self, **kwargs):
+        time.sleep(self.delay)
+        return super().execute_statement(**kwargs)
+
+
+def user_database(db: FakeRdsData, max_connections: int = 10) -> AuroraPostgres:
+    database = AuroraPostgres("us-east-1", "arn:cluster", "arn:secret", "chat", max_connections=max_connections)
+    database.db = db
+    return database
+
+
+def test_users_round_trip_by_column_name():
+    async def main():
+        database = user_database(FakeRdsData())
+        user_id = await database.create_new_user("ann@example.com", "ann", "hash")
+        return user_id, await database.get_user("ann@example.com"), await database.get_user("bob@example.com")
+
+    user_id, user, missing = asyncio.run(main())
+
+    assert user.id == user_id
+    assert (user.email, user.username, user.password, user.disabled) == ("ann@example.com", "ann", "hash", False)
+    assert missing is None
+
+
+def test_batch_insert_skips_registered_emails():
+    async def main():
+        database = user_database(FakeRdsData())
+        await database.create_new_user("ann@example.com", "ann", "hash")
+        ids = await database.create_users([
+            ("bob@example.com", "bob", "hash"),
+            ("ann@example.com", "ann", "other"),
+            ("cid@example.com", "cid", "hash"),
+        ])
+        users = [await database.get_user(f"{name}@example.com") for name in ("ann", "bob", "cid")]
+        return ids, users
+
+    ids, (ann, bob, cid) = asyncio.run(main())
+
+    assert ids == [bob.id, None, cid.id]
+    assert ann.password == "hash"
+
+
+def test_statements_run_concurrently_off_the_event_loop():
+    async def main():
+        database = user_database(SlowRdsData(0.2), max_connections=8)
+        await database.create_new_user("ann@example.com", "ann", "hash")
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        start = time.perf_counter()
+        users = await asyncio.gather(*(database.get_user("ann@example.com") for _ in range(8)))
+        elapsed = time.perf_counter() - start
+        task.cancel()
+        return users, elapsed, ticks
+
+    users, elapsed, ticks = asyncio.run(main())
+
+    assert all(user.username == "ann" for user in users)
+    # One pool thread per connection, the eight queries overlap
+    assert elapsed < 0.2 * 8 / 2
+    assert ticks >= 5
+
+
+def test_clients_get_the_configured_pool():
+    clients = ClientFactory(max_attempts=5)
+    client = clients.client("rds-data", "us-east-1", max_pool_connections=7)
+
+    assert clients.client("rds-data", "us-east-1") is client
+    config = client.meta.config
+    assert config.max_pool_connections == 7
+    assert config.tcp_keepalive
+    assert config.retries["mode"] == "adaptive"
+    assert clients.stats()["rds-data"]["max_connections"] == 7
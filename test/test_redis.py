@@ -0,0 +1,128 @@
+import asyncio
+import threading
+import time
+
+import fakeredis
+
+from redis.asyncio import ConnectionPool, Redis
+
+from models.chat import ChatMessage, ChatService
+from models.write_behind import WriteBehindQueue
+
+
+class SlowRedis:
+    """
+    fakeredis behind a proxy that holds every request for `delay` seconds,
+    like a Redis that is slow to answer.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.fake = fakeredis.TcpFakeServer(("127.0.0.1", 0), server_type="redis")
+        self.thread = threading.Thread(target=self.fake.serve_forever, daemon=True)
+        self.thread.start()
+        self.server = None
+
+
+    async def start(self) -> int:
+        self.server = await asyncio.start_server(self._proxy, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+
+    async def _proxy(self, reader, writer):
+        upstream_reader, upstream_writer = await asyncio.open_connection(*self.fake.server_address)
+
+        async def pipe(source, destination, delay):
+            try:
+                while data := await source.read(65536):
+                    await asyncio.sleep(delay)
+                    destination.write(data)
+                    await destination.drain()
+            finally:
+                destination.close()
+
+        try:
+            await asyncio.gather(
+                pipe(reader, upstream_writer, self.delay),
+                pipe(upstream_reader, writer, 0)
+            )
+        except (asyncio.CancelledError, ConnectionError):
+            pass
+
+
+    async def stop(self):
+        self.server.close()
+        self.fake.shutdown()
+        self.fake.server_close()
+
+
+async def run_chat_service(dynamodb_service, log_dir, delay, exercise):
+    slow = SlowRedis(delay)
+    port = await slow.start()
+    redis = Redis(connection_pool=ConnectionPool(host="127.0.0.1", port=port, max_connections=16))
+    write_queue = WriteBehindQueue(dynamodb_service, str(log_dir))
+    await write_queue.start()
+    try:
+        return await exercise(ChatService(redis, dynamodb_service, write_queue))
+    finally:
+        await write_queue.stop()
+        await redis.aclose()
+        await slow.stop()
+
+
+def test_event_loop_stays_responsive_while_redis_is_slow(dynamodb_service, tmp_path):
+    delay, interval = 0.3, 0.005
+    gaps = []
+
+    async def exercise(chat_service):
+        async def ticker():
+            last = time.perf_counter()
+            while True:
+                await asyncio.sleep(interval)
+                now = time.perf_counter()
+                gaps.append(now - last)
+                last = now
+
+        task = asyncio.create_task(ticker())
+        started = time.perf_counter()
+        messages = [ChatMessage(role="user", content="hi")]
+        await chat_service.save_chat_history("u1", "c1", messages)
+        history = await chat_service.get_chat_history("u1", "c1")
+        elapsed = time.perf_counter() - started
+        task.cancel()
+        return history, elapsed
+
+    history, elapsed = asyncio.run(run_chat_service(dynamodb_service, tmp_path, delay, exercise))
+
+    assert [m.content for m in history.messages] == ["hi"]
+    # Several slow round trips went by, none of them held the loop, not
+    # even for a fraction of a round trip
+    assert elapsed >= 2 * delay
+    assert max(gaps) < delay / 3
+    # The timer kept ticking through them
+    assert len(gaps) >= 0.5 * elapsed / interval
+
+
+def test_concurrent_reads_overlap(dynamodb_service, tmp_path):
+    async def exercise(chat_service):
+        await chat_service.save_chat_history("u1", "c1", [ChatMessage(role="user", content="hi")])
+        # Open the connections first, their handshakes are slow too
+        await asyncio.gather(*(chat_service.get_chat_history("u1", "c1") for _ in range(10)))
+
+        started = time.perf_counter()
+        for _ in range(10):
+            await chat_service.get_chat_history("u1", "c1")
+        sequential = time.perf_counter() - started
+
+        started = time.perf_counter()
+        histories = await asyncio.gather(*(
+            chat_service.get_chat_history("u1", "c1") for _ in range(10)
+        ))
+        return histories, sequential, time.perf_counter() - started
+
+    histories, sequential, concurrent = asyncio.run(
+        run_chat_service(dynamodb_service, tmp_path, 0.1, exercise)
+    )
+
+    assert all(len(history.messages) == 1 for history in histories)
+    assert concurrent < sequential / 3
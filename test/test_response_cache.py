@@ -0,0 +1,101 @@
+import asyncio
+
+from aws_services.bedrock import BedrockService
+from benchmarks.fakes import FakeBedrockRuntime
+from cache import ResponseCache
+from codec import dumps
+from config import CLAUDE, TITAN
+from utils import ReplayStream
+
+
+def bedrock_service(**cache_options):
+    service = BedrockService("us-east-1", response_cache=ResponseCache(**cache_options))
+    service.bedrock_runtime = FakeBedrockRuntime(tokens_per_second=0, first_token=0, tokens=5)
+    return service
+
+
+def message(content):
+    return dumps({"role": "user", "content": content})
+
+
+def test_sampled_requests_are_never_replayed():
+    service = bedrock_service()
+
+    async def main():
+        streams = []
+        for _ in range(2):
+            stream = await service.invoke_model_titan("User: hi\nBot:", 100, 0.7, 0.9)
+            service.cache_response(stream, "hello")
+            stream.close()
+            streams.append(stream)
+        return streams
+
+    streams = asyncio.run(main())
+
+    assert service.bedrock_runtime.invocations == 2
+    assert all(stream.cache_key is None for stream in streams)
+    assert service.response_cache.stats()["entries"] == 0
+
+
+def test_deterministic_request_is_replayed():
+    service = bedrock_service()
+
+    async def main():
+        stream = await service.invoke_model_titan("User: hi\nBot:", 100, 0, 0.9)
+        service.cache_response(stream, "hello")
+        stream.close()
+        replay = await service.invoke_model_titan("User: hi\nBot:", 100, 0, 0.9)
+        return replay, [chunk async for chunk in replay]
+
+    replay, chunks = asyncio.run(main())
+
+    assert service.bedrock_runtime.invocations == 1
+    assert isinstance(replay, ReplayStream)
+    assert "".join(chunks) == "hello"
+
+
+def test_requests_that_differ_do_not_share_a_response():
+    service = bedrock_service()
+
+    async def main():
+        requests = [
+            lambda: service.invoke_model_claude("Be nice.", [message("hi")], 100, 0, 0.9, 250),
+            lambda: service.invoke_model_claude("Be nice.", [message("hello")], 100, 0, 0.9, 250),
+            lambda: service.invoke_model_claude("Be brief.", [message("hi")], 100, 0, 0.9, 250),
+            lambda: service.invoke_model_claude("Be nice.", [message("hi")], 200, 0, 0.9, 250),
+            lambda: service.invoke_model_claude("Be nice.", [message("h"), message("i")], 100, 0, 0.9, 250),
+            lambda: service.invoke_model_titan("Be nice.", 100, 0, 0.9),
+            lambda: service.invoke_model_llama("Be nice.", 100, 0, 0.9),
+        ]
+        replies = []
+        for i, request in enumerate(requests):
+            stream = await request()
+            service.cache_response(stream, f"reply {i}")
+            stream.close()
+        for request in requests:
+            stream = await request()
+            replies.append("".join([chunk async for chunk in stream]))
+        return replies
+
+    replies = asyncio.run(main())
+
+    assert replies == [f"reply {i}" for i in range(7)]
+    assert service.bedrock_runtime.invocations == 7
+
+
+def test_key_ignores_only_the_volatile_parts():
+    body = b'{"system": "Today is 2024-05-01. Be nice."}'
+
+    assert ResponseCache.key("m1", body, ["2024-05-01"]) == ResponseCache.key(
+        "m1", body.replace(b"2024-05-01", b"2024-05-02"), ["2024-05-02"]
+    )
+    assert ResponseCache.key("m1", body) != ResponseCache.key("m2", body)
+    assert ResponseCache.key("m1", body) != ResponseCache.key("m1", body.replace(b"nice", b"kind"))
+
+
+def test_disabled_model_is_not_cached():
+    cache = ResponseCache(disabled_models=[CLAUDE])
+
+    assert not cache.enabled(CLAUDE, 0)
+    assert not cache.enabled(TITAN, 0.1)
+    assert cache.enabled(TITAN, 0)
@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from botocore.exceptions import ClientError
+from fastapi import HTTPException
+
+from aws_services.scheduler import ModelLimiter, is_throttling
+
+
+class ThrottlingBedrock:
+    """
+    Throttles streams started while `capacity` others are running.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.active = 0
+        self.most_active = 0
+
+
+    async def stream(self):
+        self.active += 1
+        self.most_active = max(self.most_active, self.active)
+        try:
+            if self.active > self.capacity:
+                await asyncio.sleep(0.001)
+                raise ClientError(
+                    {"Error": {"Code": "ThrottlingException", "Message": "Too many requests"}},
+                    "InvokeModelWithResponseStream"
+                )
+            await asyncio.sleep(0.005)
+        finally:
+            self.active -= 1
+
+
+async def call(limiter: ModelLimiter, bedrock: ThrottlingBedrock, user_id: str):
+    slot = await limiter.acquire(user_id)
+    try:
+        await bedrock.stream()
+    except ClientError as e:
+        slot.release("throttled" if is_throttling(e) else "neutral")
+        return
+    slot.release("success")
+
+
+async def run_calls(limiter: ModelLimiter, bedrock: ThrottlingBedrock, requests: int):
+    await asyncio.gather(*(call(limiter, bedrock, f"user{i % 4}") for i in range(requests)))
+
+
+def test_limit_decreases_on_throttling_and_recovers():
+    async def main():
+        limiter = ModelLimiter(max_limit=32, max_queue=1000, queue_timeout=60)
+        bedrock = ThrottlingBedrock(capacity=4)
+        await run_calls(limiter, bedrock, 400)
+        throttled = limiter.stats()
+        # Bedrock has room again, successes grow the limit back
+        bedrock.capacity = 32
+        await run_calls(limiter, bedrock, 800)
+        return throttled, limiter.stats()
+
+    throttled, recovered = asyncio.run(main())
+
+    assert throttled["throttled"] > 0
+    assert throttled["limit"] < 8
+    assert throttled["in_flight"] == 0 and throttled["queued"] == 0
+    assert recovered["throttled"] == throttled["throttled"]
+    assert recovered["limit"] > throttled["limit"] * 2
+
+
+def test_full_queue_is_rejected_with_retry_after():
+    async def main():
+        limiter = ModelLimiter(max_limit=1, max_queue=1, queue_timeout=60)
+        slot = await limiter.acquire("u1")
+        waiting = asyncio.create_task(limiter.acquire("u2"))
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as rejected:
+            await limiter.acquire("u3")
+        slot.release("success")
+        (await waiting).release("success")
+        return rejected.value, limiter.stats()
+
+    rejection, stats = asyncio.run(main())
+
+    assert rejection.status_code == 429
+    assert int(rejection.headers["Retry-After"]) >= 1
+    assert stats["rejected"] == 1
+    assert stats["in_flight"] == 0 and stats["queued"] == 0
+
+
+def test_request_waiting_too_long_is_rejected():
+    async def main():
+        limiter = ModelLimiter(max_limit=1, max_queue=10, queue_timeout=0.05)
+        slot = await limiter.acquire("u1")
+        with pytest.raises(HTTPException) as rejected:
+            await limiter.acquire("u2")
+        stats = limiter.stats()
+        slot.release("success")
+        return rejected.value, stats
+
+    rejection, stats = asyncio.run(main())
+
+    assert rejection.status_code == 429
+    assert stats["queued"] == 0
+    assert stats["rejected"] == 1
@@ -0,0 +1,32 @@
+from cache import ResponseCache
+from codec import loads
+from models.chat import ChatMessage
+from serialization import MessageEncoder
+
+
+def test_edited_message_is_encoded_again():
+    encoder = MessageEncoder()
+    encoder.claude("c1", [ChatMessage(role="user", content="What is 2+2?")])
+    encoded = encoder.claude("c1", [ChatMessage(role="user", content="Tell me a joke")])
+
+    assert [loads(message)["content"] for message in encoded] == ["Tell me a joke"]
+
+
+def test_edited_message_changes_the_response_cache_key():
+    encoder = MessageEncoder()
+    keys = [
+        ResponseCache.key("claude", b"".join(encoder.claude("c1", [ChatMessage(role="user", content=text)])))
+        for text in ("What is 2+2?", "Tell me a joke", "What is 2+2?")
+    ]
+
+    assert keys[0] != keys[1]
+    assert keys[0] == keys[2]
+
+
+def test_unchanged_messages_reuse_their_bytes():
+    encoder = MessageEncoder()
+    messages = [ChatMessage(role="user", content="hi"), ChatMessage(role="assistant", content="hello")]
+    first = encoder.claude("c1", messages)
+    second = encoder.claude("c1", [m.model_copy() for m in messages] + [ChatMessage(role="user", content="more")])
+
+    assert second[0] is first[0] and second[1] is first[1]
@@ -0,0 +1,88 @@
+import asyncio
+import json
+
+from models.write_behind import WriteBehindQueue
+from server import (
+    SHARED_LIMITS,
+    adopt_orphaned_logs,
+    shutdown_timeout,
+    worker_count,
+    worker_environment
+)
+
+
+def write_log(directory, userid, content):
+    """
+    Leave one unflushed write in a write-behind log, like a worker killed
+    before its queue drained.
+    """
+    async def main():
+        queue = WriteBehindQueue(None, str(directory))
+        await queue.start()
+        await queue.put([{"user_id": userid, "sk": "c1#0", "message": content}])
+        queue.segment.close()
+
+    asyncio.run(main())
+
+
+def test_orphaned_logs_are_replayed_by_worker_zero(dynamodb_service, tmp_path):
+    write_log(tmp_path, "u0", "before the launcher")
+    write_log(tmp_path / "worker-0", "u1", "worker 0")
+    write_log(tmp_path / "worker-1", "u2", "worker 1")
+    write_log(tmp_path / "worker-3", "u3", "worker 3 of 4")
+    (tmp_path / "worker-3" / "dead_letter.jsonl").write_text('{"item": {}}\n')
+
+    moved = adopt_orphaned_logs(str(tmp_path), 2)
+
+    assert moved == 2
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["worker-0", "worker-1"]
+    assert (tmp_path / "worker-0" / "dead_letter.jsonl").read_text() == '{"item": {}}\n'
+
+    async def replay():
+        queue = WriteBehindQueue(dynamodb_service, str(tmp_path / "worker-0"))
+        await queue.start()
+        items = [item for _, _, item in queue.pending]
+        await queue.stop()
+        return items
+
+    assert sorted(item["user_id"] for item in asyncio.run(replay())) == ["u0", "u1", "u3"]
+    # The log of a worker still in the pool is left to it
+    with open(next((tmp_path / "worker-1").glob("*.log"))) as f:
+        assert [json.loads(line)["items"][0]["user_id"] for line in f] == ["u2"]
+
+
+def test_nothing_to_adopt(tmp_path):
+    assert adopt_orphaned_logs(str(tmp_path / "missing"), 2) == 0
+    write_log(tmp_path / "worker-0", "u1", "worker 0")
+
+    assert adopt_orphaned_logs(str(tmp_path), 1) == 0
+    assert [path.name for path in tmp_path.iterdir()] == ["worker-0"]
+
+
+def test_workers_are_killed_after_every_shutdown_step(monkeypatch):
+    monkeypatch.setenv("BACKGROUND_DRAIN_TIMEOUT", "45")
+
+    # Streams, replies being saved, the write-behind drain and a margin
+    assert shutdown_timeout(30) == 30 + 45 + 10 + 10
+
+
+def test_limits_are_shared_out_to_the_total(monkeypatch):
+    monkeypatch.setenv("REDIS_MAX_CONNECTIONS", "10")
+    monkeypatch.setenv("BEDROCK_LIMIT_TITAN", "3")
+
+    shares = [worker_environment(index, 3) for index in range(3)]
+
+    assert [int(share["REDIS_MAX_CONNECTIONS"]) for share in shares] == [4, 3, 3]
+    assert [int(share["BEDROCK_LIMIT_TITAN"]) for share in shares] == [1, 1, 1]
+    assert shares[2]["WRITE_BEHIND_LOG_DIR"].endswith("worker-2")
+
+
+def test_workers_are_capped_at_the_smallest_limit(monkeypatch, caplog):
+    for name in SHARED_LIMITS:
+        monkeypatch.setenv(name, "8")
+    monkeypatch.setenv("BEDROCK_LIMIT_DAISII", "2")
+
+    assert worker_count(4) == 2
+    assert "BEDROCK_LIMIT_DAISII is 2, starting 2 workers instead of 4" in caplog.text
+    assert worker_count(2) == 2
+    assert [int(worker_environment(index, 2)["BEDROCK_LIMIT_DAISII"]) for index in range(2)] == [1, 1]
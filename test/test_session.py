@@ -0,0 +1,59 @@
+import time
+
+from datetime import timedelta
+
+from models.session import Session
+
+
+def test_verified_token_is_cached_until_its_expiry():
+    session = Session("secret", "HS256")
+    token = session.create_access_token({"sub": "ann@example.com"}, timedelta(minutes=5))
+    expire = session.decode(token)["exp"]
+
+    assert session.get_token_data(token).email == "ann@example.com"
+    (expires_at, _), = session.verified_tokens._entries.values()
+    # The entry lives as long as the token does, measured from now
+    assert abs((expires_at - time.monotonic()) - (expire - time.time())) < 1
+
+
+def test_expired_token_is_not_accepted_from_the_cache():
+    session = Session("secret", "HS256")
+    token = session.create_access_token({"sub": "ann@example.com"}, timedelta(seconds=1))
+
+    assert session.get_token_data(token) is not None
+    time.sleep(max(0, session.decode(token)["exp"] - time.time()) + 0.1)
+
+    assert session.get_token_data(token) is None
+    assert len(session.verified_tokens) == 0
+
+
+def test_only_valid_tokens_are_cached_within_the_bound():
+    session = Session("secret", "HS256", max_cached_tokens=10)
+    forged = Session("other secret", "HS256")
+    for i in range(50):
+        assert session.get_token_data(forged.create_access_token({"sub": f"user{i}@example.com"})) is None
+    assert session.get_token_data("not a token") is None
+    assert len(session.verified_tokens) == 0
+
+    for i in range(50):
+        session.get_token_data(session.create_access_token({"sub": f"user{i}@example.com"}))
+    assert len(session.verified_tokens) == 10
+
+
+def test_disabled_user_is_refused_despite_a_cached_token(api, client):
+    email = "bench1@example.com"
+    token = client.post("/token", data={"username": email, "password": "benchmark"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    assert client.get("/chat/revoked", headers=headers).status_code == 200
+
+    # Disabling the account is how access is revoked, the token stays valid
+    api.user_database.db.db.execute("UPDATE users SET disabled = 1 WHERE email = ?", (email,))
+    client.portal.call(api.user_cache.invalidate, email)
+    try:
+        response = client.get("/chat/revoked", headers=headers)
+    finally:
+        api.user_database.db.db.execute("UPDATE users SET disabled = 0 WHERE email = ?", (email,))
+        client.portal.call(api.user_cache.invalidate, email)
+
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Inactive user"
@@ -0,0 +1,133 @@
+import asyncio
+import random
+import time
+
+import fakeredis
+
+from cache import SingleFlight
+
+
+def test_concurrent_loads_share_one_call():
+    calls = []
+
+    async def load():
+        calls.append(True)
+        await asyncio.sleep(0.05)
+        return "value"
+
+    async def main():
+        loads = SingleFlight()
+        return loads, await asyncio.gather(*(loads.do("k", load) for _ in range(10)))
+
+    loads, values = asyncio.run(main())
+
+    assert values == ["value"] * 10
+    assert len(calls) == 1
+    assert loads.stats()["coalesced"] == 9
+
+
+def test_waiting_worker_reads_what_the_lock_holder_cached():
+    server = fakeredis.FakeServer()
+    calls = []
+
+    async def main():
+        redis = fakeredis.FakeAsyncRedis(server=server)
+        workers = [SingleFlight(fakeredis.FakeAsyncRedis(server=server), poll_interval=0.01) for _ in range(2)]
+
+        async def load():
+            calls.append(True)
+            await asyncio.sleep(0.1)
+            await redis.set("entry", "value")
+            return b"value"
+
+        async def cached():
+            return await redis.get("entry")
+
+        values = await asyncio.gather(*(worker.do("entry", load, cached) for worker in workers))
+        return values, await redis.get("lock:entry")
+
+    values, lock = asyncio.run(main())
+
+    assert values == [b"value", b"value"]
+    assert len(calls) == 1
+    assert lock is None
+
+
+def test_worker_loads_itself_once_the_lock_wait_runs_out():
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        # Held by a worker that died before filling the cache
+        await redis.set("lock:entry", "other", px=5000)
+        loads = SingleFlight(redis, lock_wait=0.2, poll_interval=0.01)
+
+        async def load():
+            return "loaded"
+
+        async def cached():
+            return None
+
+        start = time.monotonic()
+        value = await loads.do("entry", load, cached)
+        return value, time.monotonic() - start, await redis.get("lock:entry")
+
+    value, elapsed, lock = asyncio.run(main())
+
+    assert value == "loaded"
+    assert 0.2 <= elapsed < 1
+    # Another worker's lock is left to expire
+    assert lock == b"other"
+
+
+def test_lock_is_released_when_the_load_fails():
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        loads = SingleFlight(redis)
+
+        async def load():
+            raise RuntimeError("DynamoDB is down")
+
+        async def cached():
+            return None
+
+        try:
+            await loads.do("entry", load, cached)
+        except RuntimeError:
+            pass
+        return await redis.get("lock:entry")
+
+    assert asyncio.run(main()) is None
+
+
+def test_refresh_probability_rises_near_expiry():
+    loads = SingleFlight(beta=1.0)
+    loads.load_time = 1.0
+    random.seed(7)
+
+    def refreshed(ttl_remaining, reads=2000):
+        return sum(loads.should_refresh(ttl_remaining) for _ in range(reads)) / reads
+
+    far, near, closer = refreshed(5.0), refreshed(1.0), refreshed(0.1)
+
+    assert far < near < closer
+    # P(-ln(1 - U) >= t) = e^-t
+    assert abs(near - 0.37) < 0.05
+    assert not loads.should_refresh(0)
+    assert not loads.should_refresh(-1)
+
+
+def test_load_time_follows_the_loads():
+    async def main():
+        loads = SingleFlight()
+        before = loads.load_time
+
+        async def slow():
+            await asyncio.sleep(0.2)
+
+        for i in range(5):
+            await loads.do(f"k{i}", slow)
+        return before, loads.load_time
+
+    before, after = asyncio.run(main())
+
+    # Slower loads make refreshes start earlier
+    assert before < after < 0.2
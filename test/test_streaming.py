@@ -0,0 +1,89 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+import utils
+
+from aws_services.bedrock import BedrockService
+from benchmarks.fakes import FakeBedrockRuntime, ReplayedStream, recorded_events
+from config import CLAUDE, DAISII, TITAN
+
+
+async def consume(service: BedrockService) -> str:
+    stream = await service.invoke_model_claude("", [b'{"role":"user","content":"hi"}'], 100, 0.5, 0.9, 50)
+    return "".join([chunk async for chunk in utils.process_stream(stream, CLAUDE)])
+
+
+async def ticks_while(coroutine, interval: float = 0.005):
+    """
+    Run `coroutine` and return its result with the longest gap between
+    ticks of a timer running alongside it.
+    """
+    gaps = []
+
+    async def ticker():
+        last = time.perf_counter()
+        while True:
+            await asyncio.sleep(interval)
+            now = time.perf_counter()
+            gaps.append(now - last)
+            last = now
+
+    task = asyncio.create_task(ticker())
+    try:
+        result = await coroutine
+    finally:
+        task.cancel()
+    return result, max(gaps)
+
+
+def test_slow_stream_does_not_block_the_event_loop():
+    service = BedrockService("us-east-1", max_streams=8)
+    # 20 tokens at 50 per second, each read blocks for 20 ms
+    service.bedrock_runtime = FakeBedrockRuntime(tokens_per_second=50, first_token=0.1, tokens=20)
+
+    text, longest_gap = asyncio.run(ticks_while(consume(service)))
+
+    assert text.startswith("Xin chào!")
+    assert longest_gap < 0.05
+
+
+def test_concurrent_streams_interleave():
+    service = BedrockService("us-east-1", max_streams=8)
+    service.bedrock_runtime = FakeBedrockRuntime(tokens_per_second=50, first_token=0.1, tokens=20)
+
+    async def main():
+        started = time.perf_counter()
+        texts = await asyncio.gather(*(consume(service) for _ in range(8)))
+        return texts, time.perf_counter() - started
+
+    texts, elapsed = asyncio.run(main())
+
+    assert len(set(texts)) == 1
+    # One stream takes about 0.5 s, read one after the other they take 4 s
+    assert elapsed < 1.5
+    assert service.bedrock_runtime.invocations == 8
+
+
+@pytest.mark.parametrize("model_type", [CLAUDE, DAISII, TITAN])
+def test_metrics_are_read_from_the_parsed_event(model_type):
+    events = recorded_events(model_type, 3)
+    # The model writing about the metrics is text, not metrics
+    text = ' "amazon-bedrock-invocationMetrics" and invocationMetrics'
+    events[1 if model_type == CLAUDE else 0] = {
+        CLAUDE: {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": text}},
+        DAISII: {"generation": text, "stop_reason": None},
+        TITAN: {"outputText": text, "completionReason": None},
+    }[model_type]
+    events = [event if isinstance(event, bytes) else json.dumps(event).encode() for event in events]
+
+    async def main():
+        stream = utils.AsyncEventStream(ReplayedStream(events, 0, 0))
+        return "".join([chunk async for chunk in utils.process_stream(stream, model_type)]), stream
+
+    reply, stream = asyncio.run(main())
+
+    assert text in reply
+    assert stream.output_tokens == 3
@@ -0,0 +1,68 @@
+def login(client, email="bench0@example.com"):
+    token = client.post("/token", data={"username": email, "password": "benchmark"}).json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+
+def turn(client, headers, conversation_id, content, last_seq=None):
+    return client.post(
+        f"/chat/{conversation_id}/turn?model=Titan",
+        json={"message": {"role": "user", "content": content}, "last_seq": last_seq},
+        headers=headers
+    )
+
+
+def lock_key(api, client, conversation_id):
+    key, = client.portal.call(api.redis_client.keys, f"chat:*:{conversation_id}:messages")
+    return key.decode() + ":turn"
+
+
+def test_stale_last_seq_is_refused_with_the_newest_seq(client):
+    headers = login(client)
+
+    first = turn(client, headers, "turn-c1", "one")
+    stale = turn(client, headers, "turn-c1", "two")
+    second = turn(client, headers, "turn-c1", "two", last_seq=1)
+    ahead = turn(client, headers, "turn-c1", "three", last_seq=7)
+
+    assert (first.status_code, first.headers["X-Message-Seq"]) == (200, "0")
+    assert stale.status_code == 409
+    assert stale.json()["detail"] == {"message": "The conversation has changed", "last_seq": 1}
+    assert (second.status_code, second.headers["X-Message-Seq"]) == (200, "2")
+    assert ahead.status_code == 409 and ahead.json()["detail"]["last_seq"] == 3
+
+
+def test_turn_is_refused_while_another_holds_the_lock(api, client):
+    headers = login(client)
+    assert turn(client, headers, "turn-c2", "one").status_code == 200
+    key = lock_key(api, client, "turn-c2")
+    # The lock is released once the reply is saved
+    assert client.portal.call(api.redis_client.get, key) is None
+
+    client.portal.call(api.redis_client.set, key, "another request")
+    try:
+        held = turn(client, headers, "turn-c2", "two", last_seq=1)
+    finally:
+        client.portal.call(api.redis_client.delete, key)
+
+    assert held.status_code == 409
+    assert held.json()["detail"] == {"message": "A reply is still being generated", "last_seq": None}
+    assert turn(client, headers, "turn-c2", "two", last_seq=1).status_code == 200
+
+
+def test_lock_is_released_when_the_turn_fails(api, client, monkeypatch):
+    headers = login(client)
+    assert turn(client, headers, "turn-c3", "one").status_code == 200
+
+    async def unavailable(*args, **kwargs):
+        raise RuntimeError("Bedrock is unavailable")
+
+    with monkeypatch.context() as patched:
+        patched.setattr(api, "invoke_model", unavailable)
+        failed = turn(client, headers, "turn-c3", "two", last_seq=1)
+    stale = turn(client, headers, "turn-c3", "two")
+
+    assert failed.status_code == 500
+    assert stale.status_code == 409
+    assert client.portal.call(api.redis_client.get, lock_key(api, client, "turn-c3")) is None
+    # Nothing of the failed turn was stored
+    assert turn(client, headers, "turn-c3", "two", last_seq=1).headers["X-Message-Seq"] == "2"
@@ -0,0 +1,109 @@
+import asyncio
+import time
+
+import fakeredis
+
+from cache import CircuitBreaker, GuardedRedis, UserCache
+from models.user import UserInDB
+
+
+async def wait_for(predicate, timeout: float = 2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.01)
+
+
+def user(email: str = "ann@example.com") -> UserInDB:
+    return UserInDB(id="u1", email=email, username="ann", password="hash", disabled=False)
+
+
+def test_missing_user_is_remembered_for_the_negative_ttl():
+    cache = UserCache(None, ttl=60, negative_ttl=0.05)
+    cache.set("ann@example.com", None)
+    cache.set("bob@example.com", user("bob@example.com"))
+
+    assert cache.get("ann@example.com") is False
+    time.sleep(0.06)
+    # Gone, the next lookup asks the database again
+    assert cache.get("ann@example.com") is None
+    assert cache.get("bob@example.com").email == "bob@example.com"
+
+
+def test_invalidation_reaches_every_worker():
+    server = fakeredis.FakeServer()
+
+    async def main():
+        workers = [UserCache(fakeredis.FakeAsyncRedis(server=server)) for _ in range(2)]
+        listeners = [asyncio.create_task(worker.listen()) for worker in workers]
+        await asyncio.sleep(0.05)
+        await workers[0].redis.set("user:ann@example.com", user().model_dump_json())
+        for worker in workers:
+            # A worker remembered the account as missing before it was registered
+            worker.set("ann@example.com", None)
+            worker.set("bob@example.com", user("bob@example.com"))
+
+        await workers[0].invalidate("ann@example.com")
+        await asyncio.sleep(0.05)
+        for listener in listeners:
+            listener.cancel()
+        await asyncio.gather(*listeners, return_exceptions=True)
+        return workers
+
+    workers = asyncio.run(main())
+
+    for worker in workers:
+        assert worker.get("ann@example.com") is None
+        assert worker.get("bob@example.com").email == "bob@example.com"
+    # The shared copy is dropped too
+    assert asyncio.run(fakeredis.FakeAsyncRedis(server=server).get("user:ann@example.com")) is None
+
+
+def test_primed_users_replace_a_remembered_miss():
+    server = fakeredis.FakeServer()
+
+    async def main():
+        cache = UserCache(fakeredis.FakeAsyncRedis(server=server))
+        listener = asyncio.create_task(cache.listen())
+        await asyncio.sleep(0.05)
+        cache.set("ann@example.com", None)
+        await cache.prime([user()])
+        await asyncio.sleep(0.05)
+        listener.cancel()
+        await asyncio.gather(listener, return_exceptions=True)
+        return cache, await cache.redis.get("user:ann@example.com")
+
+    cache, shared = asyncio.run(main())
+
+    assert cache.get("ann@example.com") is None
+    assert UserInDB.model_validate_json(shared).email == "ann@example.com"
+
+
+def test_local_copies_serve_until_the_subscription_is_back():
+    server = fakeredis.FakeServer()
+    server.connected = False
+
+    async def main():
+        redis = fakeredis.FakeAsyncRedis(server=server)
+        breaker = CircuitBreaker(redis.ping, failure_threshold=2, probe_interval=0.05)
+        cache = UserCache(GuardedRedis(redis, breaker))
+        cache.set("bob@example.com", user("bob@example.com"))
+        listener = asyncio.create_task(cache.listen(backoff=0.01, max_backoff=0.02))
+        await asyncio.sleep(0.2)
+        down = cache.get("bob@example.com"), breaker.stats()
+
+        server.connected = True
+        await wait_for(lambda: breaker.state == "closed")
+        await asyncio.sleep(0.1)
+        back = cache.get("bob@example.com")
+        listener.cancel()
+        await asyncio.gather(listener, return_exceptions=True)
+        return down, back
+
+    (cached, stats), back = asyncio.run(main())
+
+    assert cached.email == "bob@example.com"
+    # Retries stop reaching Redis once the circuit opens
+    assert stats["open"] and stats["rejected"] > 0
+    # Invalidations may have been missed meanwhile
+    assert back is None
@@ -0,0 +1,101 @@
+import asyncio
+import json
+
+from botocore.exceptions import ClientError
+
+from models.write_behind import WriteBehindQueue
+
+
+def items(dynamodb_service, userid, content):
+    return dynamodb_service.message_items("c1", userid, 0, [json.dumps({"role": "user", "content": content})])
+
+
+def test_rejected_item_is_dead_lettered_without_blocking_others(dynamodb_service, tmp_path):
+    async def main():
+        queue = WriteBehindQueue(dynamodb_service, str(tmp_path))
+        await queue.start()
+        # Over the 400 KB item limit, DynamoDB rejects the whole batch
+        await queue.put(items(dynamodb_service, "u1", "x" * 450 * 1024))
+        await queue.put(items(dynamodb_service, "u2", "hello"))
+        await queue.flush()
+        stats = queue.stats()
+        await queue.stop()
+        return stats
+
+    stats = asyncio.run(main())
+
+    assert stats["depth"] == 0
+    assert stats["flushed_items"] == 1
+    assert stats["dead_letters"] == 1
+    assert [item["user_id"] for item in dynamodb_service.get_chat_history("u2", "c1")] == ["u2"]
+    assert dynamodb_service.get_chat_history("u1", "c1") == []
+    with open(tmp_path / "dead_letter.jsonl") as f:
+        dead = [json.loads(line) for line in f]
+    assert [record["item"]["user_id"] for record in dead] == ["u1"]
+    # Nothing is left to replay
+    assert all(path.stat().st_size == 0 for path in tmp_path.glob("*.log"))
+
+
+class ThrottledDynamoDB:
+    """
+    Throttles the first `failures` batch writes, then delegates.
+    """
+
+    def __init__(self, service, failures: int):
+        self.service = service
+        self.failures = failures
+        self.calls = 0
+
+
+    def batch_write(self, items):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise ClientError(
+                {"Error": {"Code": "ProvisionedThroughputExceededException", "Message": "Slow down"}},
+                "BatchWriteItem"
+            )
+        return self.service.batch_write(items)
+
+
+def test_throttled_batch_is_retried_whole(dynamodb_service, tmp_path):
+    dynamodb = ThrottledDynamoDB(dynamodb_service, failures=2)
+
+    async def main():
+        queue = WriteBehindQueue(dynamodb, str(tmp_path))
+        await queue.start()
+        await queue.put(items(dynamodb_service, "u1", "one") + items(dynamodb_service, "u2", "two"))
+        await queue.flush()
+        stats = queue.stats()
+        await queue.stop()
+        return stats
+
+    stats = asyncio.run(main())
+
+    assert stats["dead_letters"] == 0
+    assert stats["failed_batches"] == 2
+    assert stats["flushed_items"] == 2
+    # Retried as a batch, not item by item
+    assert dynamodb.calls == 3
+
+
+def test_concurrent_puts_share_one_fsync(dynamodb_service, tmp_path, monkeypatch):
+    synced = []
+    monkeypatch.setattr("models.write_behind.os.fsync", synced.append)
+
+    async def main():
+        queue = WriteBehindQueue(dynamodb_service, str(tmp_path), flush_interval=60, fsync=True)
+        await queue.start()
+        await asyncio.gather(*(
+            queue.put(items(dynamodb_service, f"u{i}", "hello")) for i in range(20)
+        ))
+        await queue.stop(timeout=0)
+
+    asyncio.run(main())
+
+    assert 1 <= len(synced) < 20
+    lines = [line for path in tmp_path.glob("*.log") for line in path.read_bytes().splitlines()]
+    assert len(lines) == 20
+
+
+def test_stop_without_start(dynamodb_service, tmp_path):
+    asyncio.run(WriteBehindQueue(dynamodb_service, str(tmp_path)).stop())